@@ -0,0 +1,120 @@
+"""Long-lived agent that runs the cluster script for many requests
+
+Copy this file next to the cluster script and start it once per backend process:
+
+    ssh cluster python3 agent.py /path/to/cluster/main.py
+
+Requests arrive on stdin and responses leave on stdout, one JSON object per line:
+
+    {"id": 1, "action": "check", "parameters": {...}}
+    {"id": 1, "result": {...}}     or     {"id": 1, "error": "..."}
+
+Each request runs the cluster script in this interpreter, with the request as its
+stdin and its stdout parsed as the result, exactly as if it had been started with
+`python3 main.py`. Requests run in parallel and may be answered out of order, the
+id pairs them up. Only the standard library is used so the file can run on the
+cluster as is.
+"""
+import io
+import json
+import os
+import runpy
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _ThreadStream:
+    """Sends reads and writes to the stream of the current thread, if it has one"""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def set(self, stream):
+        self._local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, "stream", None) or self._default, name)
+
+
+def run_script(script, request, stdin, stdout, stderr):
+    """Runs the cluster script with the request on its stdin
+
+    Returns:
+        dict: The response line for the request
+    """
+    request_stdin = io.StringIO(
+        json.dumps({"action": request.get("action"), "parameters": request.get("parameters")})
+    )
+    request_stdout = io.StringIO()
+    request_stderr = io.StringIO()
+    stdin.set(request_stdin)
+    stdout.set(request_stdout)
+    stderr.set(request_stderr)
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        # sys.exit("message") exits with 1 after printing the message, like python3 does
+        if isinstance(e.code, int):
+            exit_code = e.code
+        elif e.code is not None:
+            exit_code = 1
+            request_stderr.write(str(e.code))
+    except BaseException:
+        exit_code = 1
+        request_stderr.write(traceback.format_exc())
+    finally:
+        stdin.set(None)
+        stdout.set(None)
+        stderr.set(None)
+
+    if exit_code != 0:
+        return {"id": request.get("id"), "error": request_stderr.getvalue() or f"exit code {exit_code}"}
+    try:
+        return {"id": request.get("id"), "result": json.loads(request_stdout.getvalue())}
+    except ValueError:
+        return {"id": request.get("id"), "error": "invalid output: " + request_stdout.getvalue()[:1000]}
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: agent.py CLUSTER_SCRIPT\n")
+        return 2
+    script = os.path.abspath(sys.argv[1])
+    sys.path.insert(0, os.path.dirname(script))
+
+    requests_in = sys.stdin
+    responses_out = sys.stdout
+    write_lock = threading.Lock()
+    sys.stdin = stdin = _ThreadStream(io.StringIO())
+    sys.stdout = stdout = _ThreadStream(sys.stderr)
+    sys.stderr = stderr = _ThreadStream(sys.stderr)
+
+    def handle(request):
+        response = run_script(script, request, stdin, stdout, stderr)
+        line = json.dumps(response, default=str) + "\n"
+        with write_lock:
+            responses_out.write(line)
+            responses_out.flush()
+
+    workers = int(os.environ.get("CLUSTER_AGENT_WORKERS", 8))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for line in requests_in:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                with write_lock:
+                    responses_out.write(json.dumps({"id": None, "error": "invalid request"}) + "\n")
+                    responses_out.flush()
+                continue
+            executor.submit(handle, request)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
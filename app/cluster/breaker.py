@@ -0,0 +1,104 @@
+"""Circuit breaker for the calls to the cluster
+
+While the cluster head node is unreachable every call would wait for ssh or its
+deadline to give up, and requests and the poller pile up behind the calls. After
+failure_threshold calls in a row fail the circuit opens and calls are refused
+straight away. Once reset_timeout seconds have passed the circuit is half open:
+up to half_open_calls probe calls go through, and the first answer closes the
+circuit again while a failed probe opens it for another reset_timeout seconds.
+"""
+import asyncio
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Tracks the outcome of calls and decides whether the next one may go through
+
+    Args:
+        failure_threshold (int): Failures in a row that open the circuit
+        reset_timeout (float): Seconds the circuit stays open before probe calls
+        half_open_calls (int): Probe calls allowed at a time while half open
+    """
+
+    def __init__(
+        self, failure_threshold: int = 5, reset_timeout: float = 30, half_open_calls: int = 1
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._probes = 0
+
+    def _open(self):
+        self.state = OPEN
+        self.opens += 1
+        self._opened_at = time.monotonic()
+        self._probes = 0
+
+    def _update(self):
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probes = 0
+
+    def allow(self) -> bool:
+        """Checks whether a call may go through, and counts it as a probe if half open
+
+        Returns:
+            bool: False if the call has to be refused
+        """
+        self._update()
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and self._probes < self.half_open_calls:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        """The cluster answered, even if the action itself failed"""
+        self.failures = 0
+        self.state = CLOSED
+        self._probes = 0
+
+    def record_failure(self):
+        """The cluster could not be reached or did not answer in time"""
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self._open()
+        elif self.state == CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def release(self):
+        """A call ended without an outcome, e.g. it was cancelled, and frees its probe"""
+        if self.state == HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def retry_after(self) -> float:
+        """Seconds until a call may go through again, 0 unless the circuit is open"""
+        self._update()
+        if self.state != OPEN:
+            return 0
+        return max(self.reset_timeout - (time.monotonic() - self._opened_at), 0)
+
+    async def wait(self):
+        """Waits until the circuit is no longer open"""
+        while (delay := self.retry_after()) > 0:
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_after": self.retry_after(),
+        }
@@ -0,0 +1,443 @@
+"""Persistent channel to the cluster agent
+
+One agent process (see agent.py), usually started over ssh, serves every cluster
+call of the event loop. Requests carry an id and a reader task hands each response
+to the caller waiting for that id.
+"""
+import asyncio
+import itertools
+import json
+import os
+import shlex
+import weakref
+from collections import deque
+from typing import Dict, List, Optional
+
+from .breaker import CircuitBreaker
+
+# Longest response line read from an asyncio subprocess
+RESPONSE_LINE_LIMIT = 64 * 1024 * 1024
+
+# Deadline of each action in seconds, the others get CLUSTER_CALL_TIMEOUT. Actions
+# behind a request or a status poll should give up long before uploads. The result
+# pipeline adds time to the upload deadline for the size of the artifact.
+DEFAULT_ACTION_TIMEOUTS = {
+    "cancel": 30,
+    "check": 120,
+    "check_since": 60,
+    "clean": 60,
+    "result_sizes": 30,
+    "submit_batch": 120,
+    "upload": 600,
+}
+
+# Exit code of ssh when it could not connect
+SSH_CONNECTION_ERROR = 255
+
+
+class ClusterError(Exception):
+    """A cluster call failed, or the agent could not be reached"""
+
+
+class ClusterUnavailableError(ClusterError):
+    """The cluster could not be reached or did not answer in time"""
+
+
+class CircuitOpenError(ClusterUnavailableError):
+    """The call was not sent because the cluster has been failing"""
+
+
+class ClusterBusyError(ClusterError):
+    """The call was not sent because no slot became free in time"""
+
+
+async def wait_for(awaitable, timeout: Optional[float]):
+    """asyncio.wait_for that never loses a cancellation
+
+    Before Python 3.12 asyncio.wait_for returns the result when it is cancelled just
+    as the awaitable finishes, and the cancelled task carries on. Background loops
+    then never stop.
+
+    Raises:
+        asyncio.TimeoutError: If the awaitable did not finish in time, it is cancelled
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        await asyncio.wait({task}, timeout=timeout)
+    finally:
+        if not task.done():
+            task.cancel()
+            # Lets the awaitable clean up first, as asyncio.wait_for does
+            await asyncio.wait({task})
+    if task.cancelled():
+        raise asyncio.TimeoutError
+    return task.result()
+
+
+class AsyncClusterChannel:
+    """Sends requests to a long-lived agent process and matches up the responses
+
+    The agent is an asyncio subprocess of the event loop. It is started on the first
+    call and started again on the next call after it exits, so a dropped ssh
+    connection costs one failed call at most. A request whose write fails is sent
+    again on a new connection. A request already sent when the connection drops is
+    failed rather than resent, it may have run on the cluster.
+    """
+
+    def __init__(self, command: List[str]):
+        self.command = command
+        self.connects = 0
+        self._process = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        self._stderr = deque(maxlen=20)
+        self._readers = set()
+
+    async def call(self, action: str, parameters: dict):
+        """Runs an action of the cluster script
+
+        Cancelling the call stops waiting for the response, the agent still finishes
+        the action.
+
+        Args:
+            action (str): Action, e.g. "submit_batch" or "check"
+            parameters (dict): Parameters of the action
+
+        Returns:
+            The JSON output of the cluster script
+
+        Raises:
+            ClusterError: If the action failed or the agent could not be reached
+        """
+        request_id = next(self._ids)
+        line = (json.dumps({"id": request_id, "action": action, "parameters": parameters}) + "\n").encode()
+        future = asyncio.get_running_loop().create_future()
+
+        for attempt in range(2):
+            process = await self._connect()
+            self._pending[request_id] = (process, future)
+            try:
+                process.stdin.write(line)
+                await process.stdin.drain()
+                break
+            except (ConnectionError, OSError) as e:
+                self._pending.pop(request_id, None)
+                self._disconnect(process)
+                if attempt:
+                    raise ClusterUnavailableError(f"Could not send to the cluster agent: {e}")
+
+        try:
+            response = await future
+        finally:
+            self._pending.pop(request_id, None)
+
+        if "error" in response:
+            if response.get("unavailable"):
+                raise ClusterUnavailableError(response["error"])
+            raise ClusterError(response["error"])
+        return response["result"]
+
+    async def close(self):
+        """Stops the agent, the next call starts a new one"""
+        process = self._process
+        if process is not None:
+            self._disconnect(process)
+            await process.wait()
+
+    async def _connect(self) -> asyncio.subprocess.Process:
+        async with self._connect_lock:
+            if self._process is not None and self._process.returncode is None:
+                return self._process
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *self.command,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    # One response holds the status of every running job
+                    limit=RESPONSE_LINE_LIMIT,
+                )
+            except OSError as e:
+                raise ClusterUnavailableError(f"Could not start the cluster agent: {e}")
+            self._process = process
+            self.connects += 1
+        for reader in (self._read_responses(process), self._read_stderr(process)):
+            task = asyncio.create_task(reader)
+            self._readers.add(task)
+            task.add_done_callback(self._readers.discard)
+        return process
+
+    def _disconnect(self, process: asyncio.subprocess.Process):
+        if self._process is process:
+            self._process = None
+        process.stdin.close()
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+
+    async def _read_responses(self, process: asyncio.subprocess.Process):
+        while line := await process.stdout.readline():
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            entry = self._pending.pop(response.get("id"), None)
+            if entry is not None and not entry[1].done():
+                entry[1].set_result(response)
+
+        # The agent is gone, fail the requests that were waiting on it
+        await process.wait()
+        self._disconnect(process)
+        detail = "".join(self._stderr).strip()
+        for request_id, (owner, future) in list(self._pending.items()):
+            if owner is process:
+                del self._pending[request_id]
+                if not future.done():
+                    future.set_result({
+                        "error": f"Cluster agent exited with code {process.returncode}: {detail}",
+                        "unavailable": True,
+                    })
+
+    async def _read_stderr(self, process: asyncio.subprocess.Process):
+        while line := await process.stderr.readline():
+            self._stderr.append(line.decode(errors="replace"))
+
+
+async def run_cluster_script_async(command: List[str], action: str, parameters: dict):
+    """Runs the cluster script once in a new process, for clients without an agent
+
+    The process is killed when the call is cancelled.
+
+    Args:
+        command (List[str]): Command that starts the cluster script
+        action (str): Action
+        parameters (dict): Parameters of the action
+
+    Returns:
+        The JSON output of the cluster script
+
+    Raises:
+        ClusterError: If the script could not run or exited with an error
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        raise ClusterUnavailableError(f"Could not start the cluster script: {e}")
+    try:
+        stdout, stderr = await process.communicate(
+            json.dumps({"action": action, "parameters": parameters}).encode()
+        )
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await asyncio.shield(process.wait())
+        raise
+    if process.returncode == SSH_CONNECTION_ERROR:
+        raise ClusterUnavailableError(stderr.decode(errors="replace"))
+    if process.returncode != 0:
+        raise ClusterError(stderr.decode(errors="replace"))
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        raise ClusterError(f"Invalid output from the cluster script: {stdout[:1000]!r}")
+
+
+class AsyncClusterClient:
+    """Runs cluster calls from the event loop, at most max_concurrency at a time
+
+    Calls go through an AsyncClusterChannel when an agent command is given, otherwise
+    each call starts one_shot_command. A call waits for a free slot and then for the
+    cluster, each at most the deadline of its action in action_timeouts, or timeout
+    seconds. Calls that time out on the cluster or cannot reach it feed the breaker,
+    and while it is open calls fail at once with CircuitOpenError. A call that finds
+    no free slot in time fails with ClusterBusyError without feeding the breaker, the
+    cluster was never asked.
+    """
+
+    def __init__(
+        self,
+        agent_command: Optional[List[str]],
+        one_shot_command: List[str],
+        timeout: float = 300,
+        max_concurrency: int = 8,
+        action_timeouts: Optional[Dict[str, float]] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.channel = AsyncClusterChannel(agent_command) if agent_command else None
+        self.one_shot_command = one_shot_command
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.action_timeouts = action_timeouts or {}
+        self.breaker = breaker or CircuitBreaker()
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def call(self, action: str, parameters: dict, timeout: Optional[float] = None):
+        """Runs an action of the cluster script
+
+        Args:
+            action (str): Action, e.g. "submit" or "check"
+            parameters (dict): Parameters of the action
+            timeout (float, optional): Seconds to wait, the deadline of the action if None
+
+        Returns:
+            The JSON output of the cluster script
+
+        Raises:
+            ClusterError: If the action failed
+            ClusterUnavailableError: If the call timed out or the cluster could not be
+                reached
+            CircuitOpenError: If the call was not sent because the breaker is open
+            ClusterBusyError: If the call was not sent because no slot became free
+        """
+        if timeout is None:
+            timeout = self.action_timeouts.get(action, self.timeout)
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                f"The cluster is unavailable, {action} was not sent. "
+                f"Retry in {self.breaker.retry_after():.0f} seconds"
+            )
+        try:
+            await self._acquire(action, timeout)
+        except BaseException:
+            # Local load says nothing about the cluster
+            self.breaker.release()
+            raise
+        self.in_flight += 1
+        try:
+            result = await wait_for(self._call(action, parameters), timeout)
+        except asyncio.TimeoutError:
+            self.breaker.record_failure()
+            raise ClusterUnavailableError(f"Cluster action {action} timed out")
+        except ClusterUnavailableError:
+            self.breaker.record_failure()
+            raise
+        except ClusterError:
+            # The cluster answered, only the action failed
+            self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+        self.breaker.record_success()
+        return result
+
+    async def _acquire(self, action: str, timeout: float):
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            return
+        # Not wait_for, a slot acquired after the deadline must be handed back
+        acquire = asyncio.ensure_future(self._semaphore.acquire())
+        self.waiting += 1
+        try:
+            await asyncio.wait({acquire}, timeout=timeout)
+        except BaseException:
+            self._abandon(acquire)
+            raise
+        finally:
+            self.waiting -= 1
+        if not acquire.done():
+            self._abandon(acquire)
+            raise ClusterBusyError(
+                f"No free slot for cluster action {action} within {timeout:.0f} seconds"
+            )
+
+    def _abandon(self, acquire: asyncio.Future):
+        # A slot acquired after all is handed back
+        acquire.cancel()
+        acquire.add_done_callback(
+            lambda future: None if future.cancelled() else self._semaphore.release()
+        )
+
+    async def _call(self, action: str, parameters: dict):
+        if self.channel is not None:
+            return await self.channel.call(action, parameters)
+        return await run_cluster_script_async(self.one_shot_command, action, parameters)
+
+    async def close(self):
+        if self.channel is not None:
+            await self.channel.close()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "agent_connects": self.channel.connects if self.channel is not None else None,
+            "breaker": self.breaker.stats(),
+        }
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def agent_command() -> Optional[List[str]]:
+    """Gets the command that starts the cluster agent
+
+    CLUSTER_AGENT_COMMAND is used as is, otherwise the agent at CLUSTER_AGENT_LOC is
+    started over ssh to run the script at CLUSTER_LOC.
+
+    Returns:
+        Optional[List[str]]: The command, None if no agent is configured
+    """
+    command = os.environ.get("CLUSTER_AGENT_COMMAND")
+    if command:
+        return shlex.split(command)
+    agent_loc = os.environ.get("CLUSTER_AGENT_LOC")
+    if agent_loc:
+        return ["ssh", "cluster", "python3", agent_loc, os.environ.get("CLUSTER_LOC")]
+    return None
+
+
+def action_timeouts() -> Dict[str, float]:
+    """Gets the deadline of each action, DEFAULT_ACTION_TIMEOUTS with CLUSTER_ACTION_TIMEOUTS
+
+    Returns:
+        Dict[str, float]: Seconds by action
+    """
+    timeouts = dict(DEFAULT_ACTION_TIMEOUTS)
+    for entry in os.environ.get("CLUSTER_ACTION_TIMEOUTS", "").split(","):
+        if entry.strip():
+            action, _, seconds = entry.partition("=")
+            timeouts[action.strip()] = float(seconds)
+    return timeouts
+
+
+def get_async_cluster_client() -> AsyncClusterClient:
+    """Gets the async cluster client of the running event loop
+
+    It is configured from CLUSTER_MAX_CONCURRENCY (8 calls at a time),
+    CLUSTER_CALL_TIMEOUT (300 seconds), CLUSTER_ACTION_TIMEOUTS (deadlines on top of
+    DEFAULT_ACTION_TIMEOUTS, e.g. "check=60,cancel=10"), CLUSTER_BREAKER_FAILURES
+    (5 failures in a row open the breaker), CLUSTER_BREAKER_RESET_TIMEOUT (30 seconds)
+    and CLUSTER_BREAKER_HALF_OPEN_CALLS (1), and uses the agent when one is configured.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncClusterClient(
+            agent_command(),
+            ["ssh", "cluster", "python3", os.environ.get("CLUSTER_LOC")],
+            timeout=float(os.environ.get("CLUSTER_CALL_TIMEOUT", 300)),
+            max_concurrency=int(os.environ.get("CLUSTER_MAX_CONCURRENCY", 8)),
+            action_timeouts=action_timeouts(),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.environ.get("CLUSTER_BREAKER_FAILURES", 5)),
+                reset_timeout=float(os.environ.get("CLUSTER_BREAKER_RESET_TIMEOUT", 30)),
+                half_open_calls=int(os.environ.get("CLUSTER_BREAKER_HALF_OPEN_CALLS", 1)),
+            ),
+        )
+        _async_clients[loop] = client
+    return client
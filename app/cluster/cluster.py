@@ -1,89 +1,172 @@
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import UUID
 
 import asyncio
 from datetime import datetime
 from fastapi import HTTPException, status
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 
 from ..database.db_engine import db_engine
 from ..database.db_tables import Job
-from ..database.job_management import update_job
+from ..database.job_management import TERMINAL_STATUSES, job_status_in, update_jobs_async
 from ..models import JobStatus, UpdateJobDTO
-from ..util import cluster_call, create_presigned_post
+from ..util import cluster_call_async
+from .results import get_result_pipeline
 
-def interaction_with_cluster():
-    check_jobs_status()
+async def check_jobs_status(jobs_dict: Optional[Dict[str, str]] = None) -> int:
+    """Asks the cluster about the active jobs and applies the changes
 
-def check_jobs_status():
-    jobs_dict = process_running_jobs()
+    Args:
+        jobs_dict (Dict[str, str], optional): Status of each active job by Job ID,
+            read from the database if None
+
+    Returns:
+        int: Number of jobs that changed
+    """
+    if jobs_dict is None:
+        jobs_dict = await process_running_jobs()
     parameters = {"jobs_dict": jobs_dict}
     try:
-        return_data = cluster_call("check", parameters)
-        for job_id, details in return_data.items():
-            if details != 0:
-                update_data = UpdateJobDTO(
-                    status = JobStatus[details["status"]] if "status" in details else None,
-                    started = datetime.fromisoformat(details["started"]) if "started" in details else None,
-                    finished = datetime.fromisoformat(details["finished"]) if "finished" in details else None,
-                    error_message = details["error_message"] if "error_message" in details else None,
-                )
-                update_job(job_id, update_data)
-                if details["status"] == "COMPLETED" or "FAILED" or "CANCELLED":
-                    upload_results(job_id)            
+        return_data = await cluster_call_async("check", parameters)
+        updates = {
+            UUID(job_id): status_update(details)
+            for job_id, details in return_data.items()
+            if details != 0
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def process_running_jobs() -> Dict[UUID, int]:
-    status_values = [JobStatus.RUNNING, JobStatus.SUBMITTED]
-    jobs_dict = {}
+    return len(await apply_status_updates(updates))
+
+# Version of the check_since reply this backend understands
+CHECK_PROTOCOL_VERSION = 1
+
+async def check_job_changes(since: Any) -> Tuple[int, Any]:
+    """Asks the cluster which jobs changed since a watermark and applies the changes
+
+    The cluster answers {"version": 1, "watermark": ..., "jobs": {job_id: details}}
+    with only the jobs that changed after the watermark it sent earlier, so the call
+    stays small however many jobs are active. The watermark is opaque to the backend.
+    With since=None the cluster only sends its current watermark. A reply with
+    "reset": true means the watermark is no longer known to the cluster.
 
-    with Session(db_engine.engine) as session:
-        jobs = session.query(Job).filter(
-            Job.status.in_(status_values)
+    Args:
+        since (Any): Watermark of the previous reply, or None
+
+    Returns:
+        Tuple[int, Any]: Number of jobs that changed and the new watermark, which is
+            None if the cluster cannot answer from this watermark and a full check
+            is needed
+    """
+    try:
+        return_data = await cluster_call_async(
+            "check_since", {"since": since, "version": CHECK_PROTOCOL_VERSION}
         )
-        for job in jobs:
-            jobs_dict[job.id] = job.status
+        # Cluster scripts without check_since answer with something else
+        if (
+            not isinstance(return_data, dict)
+            or return_data.get("version") != CHECK_PROTOCOL_VERSION
+            or return_data.get("reset")
+        ):
+            return 0, None
+        updates = {
+            UUID(job_id): status_update(details)
+            for job_id, details in return_data.get("jobs", {}).items()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    return jobs_dict
+    return len(await apply_status_updates(updates)), return_data.get("watermark")
 
-async def upload_results(job_id):
-    results = await asyncio.gather(
-        upload_result(job_id, "archive"),
-        upload_result(job_id, "jobs")
+def status_update(details: dict) -> UpdateJobDTO:
+    """Reads the details the cluster sends about a job that changed
+
+    Args:
+        details (dict): status, started, finished and error_message, all optional
+
+    Returns:
+        UpdateJobDTO: The changes to apply to the job
+    """
+    return UpdateJobDTO(
+        status = JobStatus[details["status"]] if details.get("status") else None,
+        started = datetime.fromisoformat(details["started"]) if details.get("started") else None,
+        finished = datetime.fromisoformat(details["finished"]) if details.get("finished") else None,
+        error_message = details.get("error_message"),
     )
-    if all(status == 204 for status in results):
-        clean_results(job_id)   
-    else:
-        raise HTTPException(status_code=207, detail="One or more uploads did not complete successfully")
-    
-async def upload_result(job_id, path_name):
-    type_value = "zip" if path_name == "archive" else "json"
-    object_name = f'/{path_name}/{job_id}.{type_value}/' 
-    response = create_presigned_post(object_name)
-    parameters = {"type": type_value, "id": job_id, "PresignedResponse": response}
+
+async def apply_status_updates(updates: Dict[UUID, UpdateJobDTO]) -> List[UUID]:
+    """Saves job status changes reported by the cluster and queues finished results
+
+    Used by both the poller and the cluster callback. Updates that change nothing or
+    that arrive out of order are skipped, so the results of a job are only
+    collected once however often its completion is reported. Finished jobs get their
+    job_results entry in the same transaction as their status.
+
+    Args:
+        updates (Dict[UUID, UpdateJobDTO]): Changes keyed by Job ID
+
+    Returns:
+        List[UUID]: IDs of the jobs that changed
+    """
     try:
-        return_data = await cluster_call("upload", parameters)
-        return return_data["status_code"]
+        # One UPDATE per batch of jobs instead of one transaction per job
+        updated = await update_jobs_async(updates, collect_results=True)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def submit_job(job):
-    return True
+    # The leader's result pipeline uploads them in the background, in another
+    # process they are picked up by its next sweep
+    if any(updates[job_id].status in TERMINAL_STATUSES for job_id in updated):
+        get_result_pipeline().notify()
+    return updated
+
+async def process_running_jobs() -> Dict[str, str]:
+    status_values = [JobStatus.RUNNING, JobStatus.SUBMITTED]
+
+    async with db_engine.async_session() as session:
+        jobs = await session.execute(
+            select(Job.id, Job.status).filter(job_status_in(status_values))
+        )
+        jobs_dict = {str(job.id): job.status for job in jobs}
+
+    return jobs_dict
+
+async def submit_job_batch(jobs: List[dict]) -> Dict[str, Optional[str]]:
+    """Sends jobs to the cluster in one submit_batch call
+
+    Args:
+        jobs (List[dict]): Parameters of each job, parameters["id"] is its Job ID
+
+    Raises:
+        HTTPException: The call failed, none of the jobs can be assumed submitted
+
+    Returns:
+        Dict[str, Optional[str]]: For each Job ID, None if the cluster accepted the job
+            or the reason it did not
+    """
+    return_data = await cluster_call_async("submit_batch", {"jobs": jobs})
     try:
-        # print(job)
-        return_data = cluster_call("submit", job.parameters)
-    except Exception as error:
-        return False
-        # raise HTTPException(status_code=500, detail=str(error))
-    else:
-        if return_data["status"] == "SUCCESS":
-            return True
-        return False
-def cancel_job(job):
+        results = return_data["jobs"]
+    except (KeyError, TypeError):
+        raise HTTPException(status_code=500, detail="Invalid reply to submit_batch")
+
+    errors = {}
+    for job in jobs:
+        result = results.get(job["id"]) or {}
+        if result.get("status") == "SUCCESS":
+            errors[job["id"]] = None
+        else:
+            errors[job["id"]] = result.get("error_message") or "Job failed on the cluster"
+    return errors
+
+async def cancel_job(job):
     try:
-        return_data = cluster_call("cancel",job)
+        return_data = await cluster_call_async("cancel",job)
     except Exception as error:
         return False
         # raise HTTPException(status_code=500, detail=str(error))
@@ -92,12 +175,3 @@ def cancel_job(job):
             return True
             # return JSONResponse(content=return_data, status_code=200)
         return False
-    
-def clean_results(job_id):
-    parameters = {"id": job_id}
-    return_data = cluster_call("clean", parameters)
-    if return_data["status"] == "SUCCESS":
-        return True
-    else:
-        return False
-    
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""Sends the jobs queued in job_outbox to the cluster
+
+The job routes save a job and its job_outbox entry in one transaction and answer
+straight away. Dispatcher workers on the app's event loop claim the due entries in
+batches, send each batch with one submit_batch call and record the outcome. A
+failed call is retried with exponential backoff, a job the cluster rejects or that
+runs out of attempts is marked FAILED. A call refused by the circuit breaker or
+for want of a free call slot is not an attempt. Entries claimed by a process that stops are
+claimed again once their lease runs out, so the cluster may see a job twice and
+should ignore ids it already has.
+"""
+import asyncio
+import os
+import weakref
+
+from fastapi import HTTPException
+
+from ..database.job_management import (
+    claim_outbox_jobs_async,
+    finish_outbox_jobs_async,
+    get_outbox_size_async,
+    release_outbox_jobs_async,
+    retry_outbox_jobs_async,
+)
+from .channel import get_async_cluster_client, wait_for
+from .cluster import submit_job_batch
+from .poller import get_cluster_poller
+
+
+class SubmissionDispatcher:
+    """Drains job_outbox to the cluster with a fixed number of workers
+
+    Args:
+        workers (int): Batches sent at the same time
+        batch_size (int): Most jobs per submit_batch call
+        max_attempts (int): Attempts before a job is marked FAILED
+        retry_delay (float): Seconds before the first retry, doubled for every retry
+        max_retry_delay (float): Longest wait between attempts
+        lease (float): Seconds a claimed entry waits before another worker may take it
+        idle_interval (float): Seconds between looks at an empty outbox
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        batch_size: int = 50,
+        max_attempts: int = 5,
+        retry_delay: float = 10,
+        max_retry_delay: float = 600,
+        lease: float = 300,
+        idle_interval: float = 5,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease = lease
+        self.idle_interval = idle_interval
+        self.in_flight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.retried = 0
+        self.released = 0
+        self.failed = 0
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    async def dispatch_batch(self) -> int:
+        """Claims one batch of due jobs, sends it to the cluster and records the outcome
+
+        Returns:
+            int: Number of jobs claimed, 0 when none are due or the cluster is down
+        """
+        # Claiming would use up an attempt of every job while the cluster is down
+        if get_async_cluster_client().breaker.retry_after():
+            return 0
+        jobs = await claim_outbox_jobs_async(self.batch_size, self.lease)
+        if not jobs:
+            return 0
+
+        self.in_flight += len(jobs)
+        try:
+            errors = await submit_job_batch([job.parameters for job in jobs])
+        except Exception as e:
+            error = getattr(e, "detail", None) or str(e)
+            # The breaker opened after the check above or no call slot was free in
+            # time, the jobs were not tried
+            if isinstance(e, HTTPException) and e.status_code == 503:
+                await self._release(jobs, error)
+            else:
+                await self._retry(jobs, error)
+        else:
+            results = {job.jobid: errors.get(str(job.jobid)) for job in jobs}
+            await finish_outbox_jobs_async(results)
+            accepted = sum(error is None for error in results.values())
+            self.submitted += accepted
+            self.rejected += len(results) - accepted
+            if accepted:
+                get_cluster_poller().notify_job_submitted()
+        finally:
+            self.in_flight -= len(jobs)
+        return len(jobs)
+
+    async def _retry(self, jobs, error: str):
+        retry = [job.jobid for job in jobs if job.attempts < self.max_attempts]
+        failed = {
+            job.jobid: f"Job could not be sent to the cluster: {error}"
+            for job in jobs
+            if job.attempts >= self.max_attempts
+        }
+        if retry:
+            await retry_outbox_jobs_async(retry, error, self.retry_delay, self.max_retry_delay)
+        if failed:
+            await finish_outbox_jobs_async(failed)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        print(f"Error: submitting {len(jobs)} jobs failed: {error}")
+
+    async def _release(self, jobs, error: str):
+        # They keep their attempt and are due again once the breaker lets calls through
+        delay = get_async_cluster_client().breaker.retry_after() or self.retry_delay
+        await release_outbox_jobs_async([job.jobid for job in jobs], error, delay)
+        self.released += len(jobs)
+        print(f"Error: {len(jobs)} jobs were not sent to the cluster: {error}")
+
+    async def _work(self):
+        while True:
+            self._wake.clear()
+            try:
+                claimed = await self.dispatch_batch()
+            except Exception as e:
+                print(f"Error: dispatching jobs failed: {e}")
+                claimed = 0
+            if not claimed:
+                try:
+                    await wait_for(self._wake.wait(), self.idle_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def notify_jobs_queued(self):
+        """Wakes up the idle workers, for jobs that have just been queued"""
+        self._wake.set()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def stats(self) -> dict:
+        return {
+            "queued": await get_outbox_size_async(),
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "released": self.released,
+            "failed": self.failed,
+        }
+
+
+_dispatchers = weakref.WeakKeyDictionary()
+
+
+def get_submission_dispatcher() -> SubmissionDispatcher:
+    """Gets the dispatcher of the running event loop
+
+    It is configured from CLUSTER_SUBMIT_WORKERS (4), CLUSTER_SUBMIT_BATCH_SIZE (50),
+    CLUSTER_SUBMIT_MAX_ATTEMPTS (5), CLUSTER_SUBMIT_RETRY_DELAY (10 seconds) and
+    CLUSTER_SUBMIT_MAX_RETRY_DELAY (600 seconds).
+    """
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        dispatcher = SubmissionDispatcher(
+            workers=int(os.environ.get("CLUSTER_SUBMIT_WORKERS", 4)),
+            batch_size=int(os.environ.get("CLUSTER_SUBMIT_BATCH_SIZE", 50)),
+            max_attempts=int(os.environ.get("CLUSTER_SUBMIT_MAX_ATTEMPTS", 5)),
+            retry_delay=float(os.environ.get("CLUSTER_SUBMIT_RETRY_DELAY", 10)),
+            max_retry_delay=float(os.environ.get("CLUSTER_SUBMIT_MAX_RETRY_DELAY", 600)),
+        )
+        _dispatchers[loop] = dispatcher
+    return dispatcher
+
+
+def notify_jobs_queued():
+    """Wakes up the dispatcher of the running event loop after jobs were queued"""
+    get_submission_dispatcher().notify_jobs_queued()
@@ -0,0 +1,263 @@
+"""Adaptive polling of the cluster for job status changes
+
+The poller runs as a task on the app's event loop. It polls every
+CLUSTER_POLL_MIN_INTERVAL seconds while some active job is young or close to its
+expected end, backs off towards CLUSTER_POLL_MAX_INTERVAL while nothing changes and
+does not call the cluster at all while no job is active. A submitted job wakes it
+up so the first status change is picked up quickly.
+
+Polls ask the cluster only for the jobs that changed since the watermark of the
+previous poll (check_job_changes). Every CLUSTER_FULL_CHECK_INTERVAL seconds, and
+whenever the cluster cannot answer from the watermark, the status of every active
+job is checked instead (check_jobs_status) to catch anything that was missed.
+"""
+import asyncio
+import os
+import time
+import weakref
+from datetime import datetime, timezone
+from typing import Optional, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import Row
+
+from ..database.job_management import get_active_jobs_async, get_typical_job_duration_async
+from ..metrics import POLL_JOBS_UPDATED, POLL_SECONDS
+from ..models import JobStatus
+from .channel import wait_for
+from .cluster import check_job_changes, check_jobs_status
+
+# How often the typical job duration is read again, in seconds
+TYPICAL_DURATION_MAX_AGE = 3600
+
+
+class ClusterPoller:
+    """Polls the cluster at an interval that follows the active jobs
+
+    Args:
+        min_interval (float): Interval while jobs are young or close to finishing
+        max_interval (float): Longest interval, used while no job is active
+        young_job_age (float): Jobs submitted or started less than this many seconds
+            ago are young
+        near_completion (float): Running jobs past this fraction of the typical job
+            duration are close to finishing
+        backoff (float): Factor the interval grows by after a poll without changes
+        full_check_interval (float): Seconds between checks of every active job
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 30,
+        max_interval: float = 7200,
+        young_job_age: float = 600,
+        near_completion: float = 0.8,
+        backoff: float = 2,
+        full_check_interval: float = 3600,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.young_job_age = young_job_age
+        self.near_completion = near_completion
+        self.backoff = backoff
+        self.full_check_interval = full_check_interval
+        self.watermark = None
+        self.full_checks = 0
+        self.incremental_checks = 0
+        self._next_full_check = 0
+        self._next_watermark_request = 0
+        self.interval = min_interval
+        self.active_jobs = 0
+        self.young_jobs = 0
+        self.polls = 0
+        self.last_poll = None
+        self.last_changes = 0
+        self._deadline = None
+        self._typical_duration = None
+        self._typical_duration_read = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def next_interval(
+        self, jobs: Sequence[Row], typical_duration: Optional[float], changes: int
+    ) -> float:
+        """Works out how long to wait before the next poll
+
+        Args:
+            jobs (Sequence[Row]): Active jobs with status and age in seconds
+            typical_duration (Optional[float]): Median run time of a job in seconds
+            changes (int): Number of jobs the last poll changed
+
+        Returns:
+            float: Seconds until the next poll
+        """
+        if not jobs:
+            return self.max_interval
+        if changes or self._urgent_jobs(jobs, typical_duration):
+            return self.min_interval
+        return min(max(self.interval, self.min_interval) * self.backoff, self.max_interval)
+
+    def _urgent_jobs(self, jobs: Sequence[Row], typical_duration: Optional[float]) -> bool:
+        self.young_jobs = 0
+        urgent = False
+        for job in jobs:
+            # Jobs without a submission time are treated as young
+            age = job.age or 0
+            if age < self.young_job_age:
+                self.young_jobs += 1
+                urgent = True
+            elif (
+                job.status == JobStatus.RUNNING
+                and typical_duration
+                and age >= self.near_completion * typical_duration
+            ):
+                urgent = True
+        return urgent
+
+    async def _typical_job_duration(self) -> Optional[float]:
+        now = time.monotonic()
+        if (
+            self._typical_duration_read is None
+            or now - self._typical_duration_read > TYPICAL_DURATION_MAX_AGE
+        ):
+            self._typical_duration = await get_typical_job_duration_async()
+            self._typical_duration_read = now
+        return self._typical_duration
+
+    async def poll(self) -> float:
+        """Polls the cluster if a job is active and sets the next interval
+
+        Returns:
+            float: Seconds until the next poll
+        """
+        with POLL_SECONDS.time():
+            return await self._poll()
+
+    async def _poll(self) -> float:
+        jobs = await get_active_jobs_async()
+        self.active_jobs = len(jobs)
+        changes = 0
+        if jobs:
+            changes = await self._check(jobs)
+            self.polls += 1
+            self.last_poll = datetime.now(timezone.utc)
+            # Jobs that finished in this poll no longer need watching
+            if changes:
+                jobs = await get_active_jobs_async()
+                self.active_jobs = len(jobs)
+        self.last_changes = changes
+        POLL_JOBS_UPDATED.inc(changes)
+        typical_duration = await self._typical_job_duration() if jobs else None
+        self.interval = self.next_interval(jobs, typical_duration, changes)
+        return self.interval
+
+    async def _check(self, jobs: Sequence[Row]) -> int:
+        now = time.monotonic()
+        if self.watermark is not None and now < self._next_full_check:
+            changes, watermark = await check_job_changes(self.watermark)
+            if watermark is not None:
+                self.watermark = watermark
+                self.incremental_checks += 1
+                return changes
+            self.watermark = None
+
+        if now >= self._next_watermark_request:
+            # Taken before the full check, changes in between are reported again
+            # by the next incremental check and applying them twice is harmless
+            try:
+                _, self.watermark = await check_job_changes(None)
+            except HTTPException as e:
+                # The cluster cannot be reached, the full check would fail as well
+                if e.status_code == 503:
+                    raise
+                # Cluster scripts that reject the unknown check_since action
+                print(f"Error: the cluster did not send a watermark: {e.detail}")
+                self.watermark = None
+            if self.watermark is None:
+                # The cluster script has no check_since, ask again later
+                self._next_watermark_request = now + self.full_check_interval
+        changes = await check_jobs_status({str(job.id): job.status for job in jobs})
+        self.full_checks += 1
+        self._next_full_check = now + self.full_check_interval
+        return changes
+
+    def notify_job_submitted(self):
+        """Polls within min_interval seconds, for a job that has just been submitted"""
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Error: polling the cluster failed: {e}")
+                self.interval = self.min_interval
+            self._deadline = time.monotonic() + self.interval
+            while True:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await wait_for(self._wake.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self._wake.clear()
+                self._deadline = min(self._deadline, time.monotonic() + self.min_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        next_poll_in = None
+        if self._deadline is not None:
+            next_poll_in = max(self._deadline - time.monotonic(), 0)
+        return {
+            "interval": self.interval,
+            "next_poll_in": next_poll_in,
+            "active_jobs": self.active_jobs,
+            "young_jobs": self.young_jobs,
+            "polls": self.polls,
+            "last_poll": self.last_poll.isoformat() if self.last_poll else None,
+            "last_changes": self.last_changes,
+            "watermark": self.watermark,
+            "full_checks": self.full_checks,
+            "incremental_checks": self.incremental_checks,
+        }
+
+
+_pollers = weakref.WeakKeyDictionary()
+
+
+def get_cluster_poller() -> ClusterPoller:
+    """Gets the poller of the running event loop
+
+    It is configured from CLUSTER_POLL_MIN_INTERVAL (30 seconds),
+    CLUSTER_POLL_MAX_INTERVAL (7200 seconds), CLUSTER_POLL_YOUNG_JOB_AGE (600 seconds),
+    CLUSTER_POLL_BACKOFF (2) and CLUSTER_FULL_CHECK_INTERVAL (3600 seconds).
+    """
+    loop = asyncio.get_running_loop()
+    poller = _pollers.get(loop)
+    if poller is None:
+        poller = ClusterPoller(
+            min_interval=float(os.environ.get("CLUSTER_POLL_MIN_INTERVAL", 30)),
+            max_interval=float(os.environ.get("CLUSTER_POLL_MAX_INTERVAL", 7200)),
+            young_job_age=float(os.environ.get("CLUSTER_POLL_YOUNG_JOB_AGE", 600)),
+            backoff=float(os.environ.get("CLUSTER_POLL_BACKOFF", 2)),
+            full_check_interval=float(os.environ.get("CLUSTER_FULL_CHECK_INTERVAL", 3600)),
+        )
+        _pollers[loop] = poller
+    return poller
+
+
+def notify_job_submitted():
+    """Wakes up the poller of the running event loop after a job was submitted"""
+    get_cluster_poller().notify_job_submitted()
@@ -0,0 +1,430 @@
+"""Collects the results of finished jobs from the cluster into S3
+
+Every finished job has two artifacts on the cluster, the archive zip and the jobs
+JSON. The job_results table holds the finished jobs whose results are still on the
+cluster, its entries are added in the same transaction that finishes a job. The
+pipeline claims the entries that are due and a fixed number of workers have the
+cluster upload both artifacts to presigned S3 urls. Archives of
+RESULT_MULTIPART_THRESHOLD bytes or more are uploaded in parts. Each artifact is
+retried on its own with exponential backoff and checked in S3 before the job's files
+on the cluster are cleaned up. The entry is removed once the cleanup succeeded,
+otherwise the job is collected again later, also after a restart or by another
+leader, so a failed upload never loses results.
+
+Parts of a multipart upload that was neither completed nor aborted, for example
+because the process was killed, stay in the bucket until a lifecycle rule discards
+them. Add the rule once per bucket with:
+
+    python -m app.cluster.results
+"""
+import asyncio
+import os
+import random
+import time
+import weakref
+from typing import Dict, Optional
+from uuid import UUID
+
+from .channel import get_async_cluster_client, wait_for
+from ..database.job_management import (
+    claim_result_jobs_async,
+    finish_result_job_async,
+    get_pending_results_count_async,
+    release_result_jobs_async,
+    retry_result_job_async,
+)
+from ..util import (
+    abort_multipart_upload,
+    cluster_call_async,
+    complete_multipart_upload,
+    create_presigned_multipart_upload,
+    create_presigned_post,
+    ensure_multipart_lifecycle_rule,
+    get_s3_object_size,
+)
+
+# Path on S3 and file type of each artifact of a job
+ARTIFACTS = {"archive": "zip", "jobs": "json"}
+
+# The upload stage includes presigning and completing multipart uploads
+STAGES = ("size", "upload", "confirm", "clean")
+
+
+class ResultUploadError(Exception):
+    """An artifact could not be uploaded or was not found in S3 afterwards"""
+
+
+class StageStats:
+    """Counts, time and bytes of one stage of the pipeline"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "seconds": round(self.seconds, 3),
+            "per_second": round(self.succeeded / self.seconds, 3) if self.seconds else None,
+            "bytes": self.bytes,
+            "bytes_per_second": round(self.bytes / self.seconds) if self.seconds else None,
+        }
+
+
+def object_name(job_id, path_name: str) -> str:
+    return f'/{path_name}/{job_id}.{ARTIFACTS[path_name]}/'
+
+
+async def upload_result(
+    job_id,
+    path_name: str,
+    size: Optional[int] = None,
+    part_size: Optional[int] = None,
+    timeout: Optional[float] = None,
+):
+    """Has the cluster upload one artifact of a job to S3
+
+    Args:
+        job_id: Job ID
+        path_name (str): "archive" or "jobs"
+        size (int, optional): Size of the artifact in bytes, needed for a multipart upload
+        part_size (int, optional): Uploads the artifact in parts of this many bytes,
+            with one presigned PUT url per part, instead of one presigned POST
+        timeout (float, optional): Seconds the cluster has for the upload, the
+            deadline of the upload action if None
+
+    Raises:
+        ResultUploadError: S3 did not accept the upload
+    """
+    key = object_name(job_id, path_name)
+    parameters = {"type": ARTIFACTS[path_name], "id": str(job_id)}
+    if size is not None and part_size is not None:
+        multipart = await asyncio.to_thread(create_presigned_multipart_upload, key, size, part_size)
+        try:
+            return_data = await cluster_call_async(
+                "upload", {**parameters, "PresignedMultipart": multipart}, timeout
+            )
+            await asyncio.to_thread(
+                complete_multipart_upload, key, multipart["upload_id"], return_data["parts"]
+            )
+        except BaseException:
+            # Shielded, parts left behind by a cancelled abort are stored and billed
+            await asyncio.shield(
+                asyncio.to_thread(abort_multipart_upload, key, multipart["upload_id"])
+            )
+            raise
+        return
+
+    response = await asyncio.to_thread(create_presigned_post, key)
+    if response is None:
+        raise ResultUploadError(f"Could not presign the upload of {key}")
+    return_data = await cluster_call_async(
+        "upload", {**parameters, "PresignedResponse": response}, timeout
+    )
+    if return_data.get("status_code") != 204:
+        raise ResultUploadError(f"S3 answered {return_data.get('status_code')} for {key}")
+
+
+async def clean_results(job_id):
+    parameters = {"id": str(job_id)}
+    return_data = await cluster_call_async("clean", parameters)
+    if return_data["status"] == "SUCCESS":
+        return True
+    else:
+        return False
+
+
+class ResultPipeline:
+    """Uploads the results of finished jobs with a fixed number of workers
+
+    Args:
+        workers (int): Jobs processed at the same time
+        max_attempts (int): Attempts per artifact before the job is put back for later
+        retry_delay (float): Seconds before the first retry of an artifact or a job,
+            doubled for every retry
+        max_retry_delay (float): Longest wait between attempts
+        multipart_threshold (int): Artifacts this large are uploaded in parts
+        part_size (int): Size of each part of a multipart upload
+        upload_rate (float): Slowest expected upload in bytes per second, the deadline
+            of an upload grows by the time its artifact takes at this rate
+        verify (bool): Checks every artifact in S3 before cleaning up
+        sweep_interval (float): Seconds between looks for due job_results entries
+        lease (float): Seconds a claimed entry belongs to this pipeline
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_attempts: int = 5,
+        retry_delay: float = 5,
+        max_retry_delay: float = 300,
+        multipart_threshold: int = 100 * 1024 * 1024,
+        part_size: int = 64 * 1024 * 1024,
+        upload_rate: float = 1024 * 1024,
+        verify: bool = True,
+        sweep_interval: float = 60,
+        lease: float = 3600,
+    ):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.upload_rate = upload_rate
+        self.verify = verify
+        self.sweep_interval = sweep_interval
+        self.lease = lease
+        self.stages = {stage: StageStats() for stage in STAGES}
+        self.retries = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._wake = asyncio.Event()
+        self._claiming = asyncio.Lock()
+        self._tasks = []
+
+    def notify(self):
+        """Looks for due entries now, for jobs that have just finished"""
+        self._wake.set()
+
+    async def sweep(self) -> int:
+        """Claims due job_results entries for the free workers and queues them
+
+        Returns:
+            int: Number of entries claimed
+        """
+        # Claimed entries are queued before anyone else looks at _queued
+        async with self._claiming:
+            free = self.workers - len(self._queued)
+            if free <= 0:
+                return 0
+            jobs = await claim_result_jobs_async(free, self.lease)
+            for job in jobs:
+                if job.jobid not in self._queued:
+                    self._queued.add(job.jobid)
+                    self._queue.put_nowait(job.jobid)
+            return len(jobs)
+
+    async def join(self):
+        """Collects every due entry and waits until they have been processed"""
+        while True:
+            claimed = await self.sweep()
+            if not claimed and not self._queued:
+                return
+            await self._queue.join()
+
+    async def _timed(self, stage: str, awaitable, size: int = 0):
+        stats = self.stages[stage]
+        start = time.perf_counter()
+        try:
+            result = await awaitable
+        except BaseException:
+            stats.failed += 1
+            raise
+        finally:
+            stats.seconds += time.perf_counter() - start
+        stats.succeeded += 1
+        stats.bytes += size
+        return result
+
+    async def _result_sizes(self, job_id) -> Dict[str, int]:
+        # Cluster scripts without result_sizes answer with something else
+        return_data = await cluster_call_async("result_sizes", {"id": str(job_id)})
+        return {
+            path_name: size
+            for path_name, size in (return_data or {}).items()
+            if path_name in ARTIFACTS and isinstance(size, int)
+        }
+
+    def _upload_timeout(self, size: Optional[int]) -> Optional[float]:
+        # A large artifact that takes long to upload is not a cluster outage for
+        # the breaker
+        if size is None:
+            return None
+        client = get_async_cluster_client()
+        return client.action_timeouts.get("upload", client.timeout) + size / self.upload_rate
+
+    async def _upload_artifact(self, job_id, path_name: str, size: Optional[int]) -> bool:
+        part_size = None
+        if size is not None and size >= self.multipart_threshold:
+            part_size = self.part_size
+        timeout = self._upload_timeout(size)
+        for attempt in range(1, self.max_attempts + 1):
+            # An outage of the cluster does not use up the attempts
+            await get_async_cluster_client().breaker.wait()
+            try:
+                await self._timed(
+                    "upload",
+                    upload_result(job_id, path_name, size, part_size, timeout),
+                    size or 0,
+                )
+                if self.verify:
+                    await self._timed("confirm", self._confirm(job_id, path_name, size))
+                return True
+            except Exception as e:
+                error = getattr(e, "detail", None) or str(e)
+                if attempt == self.max_attempts:
+                    print(f"Error: uploading the {path_name} of job {job_id} failed: {error}")
+                    return False
+                self.retries += 1
+                delay = min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay)
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+        return False
+
+    async def _confirm(self, job_id, path_name: str, size: Optional[int]):
+        uploaded = await asyncio.to_thread(get_s3_object_size, object_name(job_id, path_name))
+        if uploaded is None:
+            raise ResultUploadError(f"The {path_name} of job {job_id} is not in S3")
+        if size is not None and uploaded != size:
+            raise ResultUploadError(
+                f"The {path_name} of job {job_id} is {uploaded} bytes in S3, expected {size}"
+            )
+
+    async def process(self, job_id) -> bool:
+        """Uploads both artifacts of a job and cleans up once both are in S3
+
+        Returns:
+            bool: True if the results were collected
+        """
+        try:
+            sizes = await self._timed("size", self._result_sizes(job_id))
+        except Exception as e:
+            # Sizes only pick the upload method, simple uploads work for any size
+            print(f"Error: getting the result sizes of job {job_id} failed: {e}")
+            sizes = {}
+        uploaded = await asyncio.gather(
+            *(self._upload_artifact(job_id, path_name, sizes.get(path_name)) for path_name in ARTIFACTS)
+        )
+        if not all(uploaded):
+            self.failed += 1
+            return False
+        if not await self._timed("clean", clean_results(job_id)):
+            print(f"Error: cleaning up the results of job {job_id} failed")
+            self.failed += 1
+            return False
+        self.completed += 1
+        return True
+
+    async def _collect(self, job_id):
+        try:
+            collected = await self.process(job_id)
+            error = "The results could not be uploaded or cleaned up"
+        except Exception as e:
+            self.failed += 1
+            collected = False
+            error = str(e)
+            print(f"Error: collecting the results of job {job_id} failed: {error}")
+        # The entry stays until the cluster's files are cleaned up
+        if collected:
+            await finish_result_job_async(job_id)
+        else:
+            await retry_result_job_async(job_id, error, self.retry_delay, self.max_retry_delay)
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self._collect(job_id)
+            except Exception as e:
+                # The entry is claimed again once its lease ends
+                print(f"Error: recording the results of job {job_id} failed: {e}")
+            finally:
+                self.in_flight -= 1
+                self._queued.discard(job_id)
+                self._queue.task_done()
+                self._wake.set()
+
+    async def _sweep(self):
+        while True:
+            self._wake.clear()
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error: looking for job results to collect failed: {e}")
+            try:
+                await wait_for(self._wake.wait(), self.sweep_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        # Taken first, cancelled workers drop their job from _queued
+        unfinished = list(self._queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queued.clear()
+        self._queue = asyncio.Queue()
+        self.in_flight = 0
+        if unfinished:
+            # Another leader can take them at once instead of after the lease
+            try:
+                await release_result_jobs_async(unfinished)
+            except Exception as e:
+                print(f"Error: releasing {len(unfinished)} job results failed: {e}")
+
+    def queued(self) -> int:
+        """Claimed jobs waiting for a worker"""
+        return self._queue.qsize()
+
+    async def stats(self) -> dict:
+        return {
+            "pending": await get_pending_results_count_async(),
+            "queued": self.queued(),
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "stages": {stage: stats.as_dict() for stage, stats in self.stages.items()},
+        }
+
+
+_pipelines = weakref.WeakKeyDictionary()
+
+
+def get_result_pipeline() -> ResultPipeline:
+    """Gets the result pipeline of the running event loop
+
+    It is configured from RESULT_UPLOAD_WORKERS (4), RESULT_UPLOAD_MAX_ATTEMPTS (5),
+    RESULT_UPLOAD_RETRY_DELAY (5 seconds), RESULT_UPLOAD_MAX_RETRY_DELAY (300 seconds),
+    RESULT_MULTIPART_THRESHOLD (100 MiB), RESULT_PART_SIZE (64 MiB),
+    RESULT_UPLOAD_MIN_RATE (1 MiB per second), RESULT_VERIFY_UPLOADS (1, set to 0 to skip the check in S3), RESULT_SWEEP_INTERVAL
+    (60 seconds) and RESULT_LEASE (3600 seconds).
+    """
+    loop = asyncio.get_running_loop()
+    pipeline = _pipelines.get(loop)
+    if pipeline is None:
+        pipeline = ResultPipeline(
+            workers=int(os.environ.get("RESULT_UPLOAD_WORKERS", 4)),
+            max_attempts=int(os.environ.get("RESULT_UPLOAD_MAX_ATTEMPTS", 5)),
+            retry_delay=float(os.environ.get("RESULT_UPLOAD_RETRY_DELAY", 5)),
+            max_retry_delay=float(os.environ.get("RESULT_UPLOAD_MAX_RETRY_DELAY", 300)),
+            multipart_threshold=int(os.environ.get("RESULT_MULTIPART_THRESHOLD", 100 * 1024 * 1024)),
+            part_size=int(os.environ.get("RESULT_PART_SIZE", 64 * 1024 * 1024)),
+            upload_rate=float(os.environ.get("RESULT_UPLOAD_MIN_RATE", 1024 * 1024)),
+            verify=os.environ.get("RESULT_VERIFY_UPLOADS", "1") != "0",
+            sweep_interval=float(os.environ.get("RESULT_SWEEP_INTERVAL", 60)),
+            lease=float(os.environ.get("RESULT_LEASE", 3600)),
+        )
+        _pipelines[loop] = pipeline
+    return pipeline
+
+
+if __name__ == "__main__":
+    days = int(os.environ.get("RESULT_MULTIPART_ABORT_DAYS", 1))
+    if ensure_multipart_lifecycle_rule(days):
+        print(f"Added the rule that aborts incomplete multipart uploads after {days} days")
+    else:
+        print("The rule that aborts incomplete multipart uploads is already in place")
@@ -0,0 +1,235 @@
+"""Local stand-in for the cluster script, for development and load tests
+
+Point CLUSTER_LOC, or the agent, at this file instead of the real cluster script:
+
+    CLUSTER_AGENT_COMMAND="python3 app/cluster/agent.py app/cluster/simulator.py"
+
+Like the cluster script it reads one request on stdin and prints the result. It
+implements submit, submit_batch, check, check_since, cancel, result_sizes, upload and
+clean. The jobs are kept in the JSON file SIMULATOR_STATE and their status follows
+from the wall clock: each job waits SIMULATOR_QUEUE_TIME seconds, runs for
+SIMULATOR_DURATION seconds and then fails with probability SIMULATOR_JOB_FAILURE_RATE.
+
+Times and sizes are distributions written as "fixed:10", "uniform:5:60",
+"exponential:30" (the mean) or "lognormal:60:0.5" (the median and sigma). Every call
+takes SIMULATOR_LATENCY seconds and fails with probability SIMULATOR_FAILURE_RATE.
+Uploads only answer as S3 would, unless SIMULATOR_UPLOAD is 1 and the results, of
+SIMULATOR_RESULT_SIZE bytes, are sent to the presigned urls. Only the standard
+library is used, like the agent.
+"""
+import fcntl
+import json
+import math
+import os
+import random
+import sys
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULTS = {
+    "SIMULATOR_STATE": "/tmp/ubcc3-simulator.json",
+    "SIMULATOR_LATENCY": "fixed:0",
+    "SIMULATOR_FAILURE_RATE": "0",
+    "SIMULATOR_QUEUE_TIME": "exponential:5",
+    "SIMULATOR_DURATION": "lognormal:60:0.5",
+    "SIMULATOR_JOB_FAILURE_RATE": "0.05",
+    "SIMULATOR_RESULT_SIZE": "uniform:1000:100000",
+    "SIMULATOR_UPLOAD": "0",
+}
+
+
+def setting(name: str) -> str:
+    return os.environ.get(name, DEFAULTS[name])
+
+
+def sample(spec: str) -> float:
+    """Draws a value from a distribution such as "uniform:5:60", never below 0"""
+    kind, _, arguments = spec.partition(":")
+    values = [float(value) for value in arguments.split(":") if value]
+    if kind == "fixed":
+        value = values[0]
+    elif kind == "uniform":
+        value = random.uniform(values[0], values[1])
+    elif kind == "exponential":
+        value = random.expovariate(1 / values[0]) if values[0] > 0 else 0
+    elif kind == "lognormal":
+        value = random.lognormvariate(math.log(values[0]), values[1])
+    else:
+        raise ValueError(f"Unknown distribution {spec}")
+    return max(value, 0)
+
+
+@contextmanager
+def jobs_state():
+    """Yields the jobs by id, saved again when the block ends, under an exclusive lock"""
+    path = setting("SIMULATOR_STATE")
+    with open(path, "a+") as state_file:
+        # The agent runs requests in parallel threads, the backend may run several agents
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        state_file.seek(0)
+        content = state_file.read()
+        jobs = json.loads(content) if content else {}
+        yield jobs
+        state_file.seek(0)
+        state_file.truncate()
+        json.dump(jobs, state_file)
+
+
+def new_job(now: float) -> dict:
+    started = now + sample(setting("SIMULATOR_QUEUE_TIME"))
+    failed = random.random() < float(setting("SIMULATOR_JOB_FAILURE_RATE"))
+    return {
+        "submitted": now,
+        "started": started,
+        "finished": started + sample(setting("SIMULATOR_DURATION")),
+        "outcome": "FAILED" if failed else "COMPLETED",
+        "cancelled": None,
+        "sizes": {
+            "archive": int(sample(setting("SIMULATOR_RESULT_SIZE"))),
+            "jobs": int(sample(setting("SIMULATOR_RESULT_SIZE"))),
+        },
+    }
+
+
+def iso(timestamp: float) -> str:
+    # The backend stores naive local times
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
+def details(job: dict, now: float) -> dict:
+    """Status of a job at a point in time, as the check action reports it"""
+    if job["cancelled"] is not None and job["cancelled"] <= now:
+        result = {"status": "CANCELLED", "finished": iso(job["cancelled"])}
+        if job["started"] < job["cancelled"]:
+            result["started"] = iso(job["started"])
+        return result
+    if now < job["started"]:
+        return {"status": "SUBMITTED"}
+    if now < job["finished"]:
+        return {"status": "RUNNING", "started": iso(job["started"])}
+    result = {
+        "status": job["outcome"],
+        "started": iso(job["started"]),
+        "finished": iso(job["finished"]),
+    }
+    if job["outcome"] == "FAILED":
+        result["error_message"] = "Simulated job failure"
+    return result
+
+
+def changed_between(job: dict, since: float, now: float) -> bool:
+    end = job["cancelled"] if job["cancelled"] is not None else job["finished"]
+    events = [job["started"], end] if job["started"] < end else [end]
+    return any(since < event <= now for event in events)
+
+
+def submit(jobs: dict, job_ids, now: float) -> dict:
+    for job_id in job_ids:
+        # A job sent twice keeps its first run
+        jobs.setdefault(job_id, new_job(now))
+    return {job_id: {"status": "SUCCESS"} for job_id in job_ids}
+
+
+def upload(parameters: dict, size: int) -> dict:
+    if "PresignedMultipart" in parameters:
+        multipart = parameters["PresignedMultipart"]
+        parts = []
+        for number, url in enumerate(multipart["urls"], 1):
+            part_size = min(multipart["part_size"], size - (number - 1) * multipart["part_size"])
+            etag = f'"{uuid.uuid4().hex}"'
+            if setting("SIMULATOR_UPLOAD") == "1":
+                request = urllib.request.Request(
+                    url, data=os.urandom(max(part_size, 0)), method="PUT"
+                )
+                with urllib.request.urlopen(request) as response:
+                    etag = response.headers["ETag"]
+            parts.append({"PartNumber": number, "ETag": etag})
+        return {"status_code": 200, "parts": parts}
+
+    if setting("SIMULATOR_UPLOAD") == "1":
+        presigned = parameters["PresignedResponse"]
+        boundary = uuid.uuid4().hex
+        body = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+            for name, value in presigned["fields"].items()
+        )
+        body += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="result"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + os.urandom(size) + f"\r\n--{boundary}--\r\n".encode()
+        request = urllib.request.Request(
+            presigned["url"],
+            data=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as response:
+            return {"status_code": response.status}
+    return {"status_code": 204}
+
+
+def handle(action: str, parameters: dict):
+    now = time.time()
+    with jobs_state() as jobs:
+        if action == "submit":
+            return submit(jobs, [parameters["id"]], now)[parameters["id"]]
+        if action == "submit_batch":
+            return {"jobs": submit(jobs, [job["id"] for job in parameters["jobs"]], now)}
+        if action == "check":
+            result = {}
+            for job_id, status in parameters["jobs_dict"].items():
+                job = jobs.get(job_id)
+                current = details(job, now) if job is not None else None
+                result[job_id] = current if current and current["status"] != status else 0
+            return result
+        if action == "check_since":
+            since = parameters.get("since")
+            return {
+                "version": 1,
+                "watermark": now,
+                "jobs": {
+                    job_id: details(job, now)
+                    for job_id, job in jobs.items()
+                    if since is not None and changed_between(job, since, now)
+                },
+            }
+        if action == "cancel":
+            job = jobs.get(parameters["id"])
+            if job is None or job["cancelled"] is not None or now >= job["finished"]:
+                return {"status": "FAILED"}
+            job["cancelled"] = now
+            return {"status": "SUCCESS"}
+        if action == "result_sizes":
+            job = jobs.get(parameters["id"])
+            return job["sizes"] if job is not None else {}
+        if action == "upload":
+            job = jobs.get(parameters["id"])
+            if job is None:
+                raise ValueError(f"No results for job {parameters['id']}")
+            path_name = "archive" if parameters["type"] == "zip" else "jobs"
+            return upload(parameters, job["sizes"][path_name])
+        if action == "clean":
+            return {"status": "SUCCESS" if jobs.pop(parameters["id"], None) else "FAILED"}
+    raise ValueError(f"Unknown action {action}")
+
+
+def main():
+    request = json.load(sys.stdin)
+    time.sleep(sample(setting("SIMULATOR_LATENCY")))
+    if random.random() < float(setting("SIMULATOR_FAILURE_RATE")):
+        sys.stderr.write("Simulated cluster failure")
+        sys.exit(1)
+    try:
+        result = handle(request["action"], request["parameters"] or {})
+    except Exception as e:
+        sys.stderr.write(str(e))
+        sys.exit(1)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
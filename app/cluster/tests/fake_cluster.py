@@ -0,0 +1,92 @@
+"""Stand-in for the cluster script, reads one request on stdin and prints the result
+
+Used by the cluster tests as CLUSTER_LOC, behind the agent or on its own.
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+
+request = json.load(sys.stdin)
+action = request["action"]
+parameters = request["parameters"] or {}
+
+if os.environ.get("FAKE_CLUSTER_LOG"):
+    with open(os.environ["FAKE_CLUSTER_LOG"], "a") as log:
+        log.write(f"{action} {parameters.get('id', '')}\n")
+
+if action in os.environ.get("FAKE_CLUSTER_UNKNOWN_ACTIONS", "").split():
+    # Like cluster scripts that exit with an error on actions they do not know
+    sys.stderr.write(f"Unknown action {action}")
+    sys.exit(1)
+elif action == "echo":
+    print(json.dumps(parameters))
+elif action == "sleep":
+    time.sleep(parameters["seconds"])
+    print(json.dumps(parameters))
+elif action == "pid":
+    print(json.dumps({"pid": os.getpid()}))
+elif action == "fail":
+    sys.stderr.write(parameters.get("message", "failed"))
+    sys.exit(1)
+elif action == "check":
+    # The jobs in FAKE_CLUSTER_STATE, a JSON file of job id to details, have changed
+    state = {}
+    if os.environ.get("FAKE_CLUSTER_STATE"):
+        with open(os.environ["FAKE_CLUSTER_STATE"]) as state_file:
+            state = json.load(state_file)
+    print(json.dumps({job_id: state.get(job_id, 0) for job_id in parameters["jobs_dict"]}))
+elif action == "check_since" and not os.environ.get("FAKE_CLUSTER_FULL_CHECK_ONLY"):
+    # Details with a "seq" changed at that point, the watermark is the latest seq
+    state = {}
+    if os.environ.get("FAKE_CLUSTER_STATE"):
+        with open(os.environ["FAKE_CLUSTER_STATE"]) as state_file:
+            state = json.load(state_file)
+    since = parameters["since"]
+    print(json.dumps({
+        "version": 1,
+        "watermark": max([details.get("seq", 0) for details in state.values()] + [0]),
+        "jobs": {
+            job_id: details for job_id, details in state.items()
+            if since is not None and details.get("seq", 0) > since
+        },
+    }))
+elif action == "submit_batch":
+    # Jobs with "reject" in their parameters are refused
+    print(json.dumps({
+        "jobs": {
+            job["id"]: {"status": "FAILED", "error_message": job["reject"]} if "reject" in job
+            else {"status": "SUCCESS"}
+            for job in parameters["jobs"]
+        }
+    }))
+elif action == "result_sizes" and os.environ.get("FAKE_CLUSTER_RESULT_SIZES"):
+    print(os.environ["FAKE_CLUSTER_RESULT_SIZES"])
+elif action == "upload":
+    time.sleep(float(os.environ.get("FAKE_CLUSTER_UPLOAD_DELAY", 0)))
+    # FAKE_CLUSTER_UPLOAD_FAILURES is a file with the number of uploads left to fail
+    if os.environ.get("FAKE_CLUSTER_UPLOAD_FAILURES"):
+        with open(os.environ["FAKE_CLUSTER_UPLOAD_FAILURES"], "r+") as failures_file:
+            # The agent runs uploads in parallel threads
+            fcntl.flock(failures_file, fcntl.LOCK_EX)
+            failures = int(failures_file.read() or 0)
+            if failures > 0:
+                failures_file.seek(0)
+                failures_file.truncate()
+                failures_file.write(str(failures - 1))
+                sys.stderr.write("Connection reset by S3")
+                sys.exit(1)
+    if "PresignedMultipart" in parameters:
+        urls = parameters["PresignedMultipart"]["urls"]
+        print(json.dumps({
+            "status_code": 200,
+            "parts": [{"PartNumber": i, "ETag": f'"etag{i}"'} for i in range(1, len(urls) + 1)],
+        }))
+    else:
+        print(json.dumps({"status_code": 204}))
+elif action == "crash":
+    # Takes the agent down with it, like a dropped ssh connection
+    os._exit(3)
+else:
+    print(json.dumps({"status": "SUCCESS"}))
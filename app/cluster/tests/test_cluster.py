@@ -0,0 +1,1126 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+import uuid
+from types import SimpleNamespace
+
+from botocore.stub import Stubber
+
+import httpx
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.orm import Session
+
+from .. import channel
+from ..breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from ..channel import (
+    AsyncClusterChannel,
+    AsyncClusterClient,
+    CircuitOpenError,
+    ClusterBusyError,
+    ClusterError,
+    ClusterUnavailableError,
+    run_cluster_script_async,
+    wait_for,
+)
+from ..cluster import check_jobs_status
+from ..dispatcher import SubmissionDispatcher
+from ..poller import ClusterPoller
+from ..results import ResultPipeline, get_result_pipeline, upload_result
+from ..worker import ClusterWorker
+from ...database.db_engine import db_engine
+from ...database.db_tables import Job, Job_Outbox, Job_Result
+from ...database.job_management import post_new_jobs_async
+from ...models import CreateJobDTO, JobStatus, StructureOrigin
+from ... import util
+from ...util import sign_cluster_callback
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT = os.path.join(os.path.dirname(TESTS_DIR), "agent.py")
+FAKE_CLUSTER = os.path.join(TESTS_DIR, "fake_cluster.py")
+AGENT_COMMAND = [sys.executable, AGENT, FAKE_CLUSTER]
+SIMULATOR = os.path.join(os.path.dirname(TESTS_DIR), "simulator.py")
+
+
+class TestAsyncClusterChannel(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.channel = AsyncClusterChannel(AGENT_COMMAND)
+
+    async def asyncTearDown(self):
+        await self.channel.close()
+
+    async def test_calls_share_one_agent(self):
+        pids = {(await self.channel.call("pid", {}))["pid"] for _ in range(20)}
+
+        self.assertEqual(len(pids), 1)
+        self.assertEqual(self.channel.connects, 1)
+
+    async def test_concurrent_calls_are_multiplexed(self):
+        await self.channel.call("echo", {})
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(self.channel.call("sleep", {"seconds": 0.5, "i": i}) for i in range(8))
+        )
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual([result["i"] for result in results], list(range(8)))
+        self.assertEqual(self.channel.connects, 1)
+
+    async def test_agent_cannot_start(self):
+        broken = AsyncClusterChannel(["/no/such/command"])
+
+        with self.assertRaises(ClusterUnavailableError):
+            await broken.call("echo", {})
+
+
+class TestAsyncClusterClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = AsyncClusterClient(
+            AGENT_COMMAND, [sys.executable, FAKE_CLUSTER], timeout=10, max_concurrency=2
+        )
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_concurrency_is_bounded(self):
+        await self.client.call("echo", {})
+        start = time.monotonic()
+        calls = [
+            asyncio.create_task(self.client.call("sleep", {"seconds": 0.3, "i": i}))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.client.stats()["in_flight"], 2)
+        self.assertEqual(self.client.stats()["waiting"], 4)
+
+        results = await asyncio.gather(*calls)
+
+        # Three rounds of two calls
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+        self.assertLess(time.monotonic() - start, 1.8)
+        self.assertEqual([result["i"] for result in results], list(range(6)))
+        self.assertEqual(self.client.stats()["in_flight"], 0)
+        self.assertEqual(self.client.channel.connects, 1)
+
+    async def test_call_times_out_and_frees_its_slot(self):
+        with self.assertRaisesRegex(ClusterError, "timed out"):
+            await self.client.call("sleep", {"seconds": 2}, timeout=0.2)
+
+        self.assertEqual(self.client.stats()["in_flight"], 0)
+        self.assertEqual(await self.client.call("echo", {"ok": True}), {"ok": True})
+
+    async def test_failed_action_and_restart(self):
+        with self.assertRaisesRegex(ClusterError, "no such job"):
+            await self.client.call("fail", {"message": "no such job"})
+        with self.assertRaisesRegex(ClusterError, "exited"):
+            await self.client.call("crash", {})
+
+        self.assertEqual(await self.client.call("echo", {"ok": True}), {"ok": True})
+        self.assertEqual(self.client.channel.connects, 2)
+
+    async def test_one_shot_calls_without_agent(self):
+        client = AsyncClusterClient(None, [sys.executable, FAKE_CLUSTER], max_concurrency=4)
+
+        results = await asyncio.gather(*(client.call("echo", {"i": i}) for i in range(4)))
+
+        self.assertEqual([result["i"] for result in results], list(range(4)))
+        with self.assertRaisesRegex(ClusterError, "no such job"):
+            await client.call("fail", {"message": "no such job"})
+
+    async def test_actions_have_their_own_deadlines(self):
+        client = AsyncClusterClient(
+            AGENT_COMMAND, [sys.executable, FAKE_CLUSTER], action_timeouts={"sleep": 0.2}
+        )
+        try:
+            with self.assertRaisesRegex(ClusterUnavailableError, "timed out"):
+                await client.call("sleep", {"seconds": 2})
+            self.assertEqual(await client.call("sleep", {"seconds": 0.3}, timeout=5), {"seconds": 0.3})
+        finally:
+            await client.close()
+
+    async def test_breaker_fails_fast_while_the_cluster_is_down(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.3)
+        client = AsyncClusterClient(["/no/such/command"], [], breaker=breaker)
+        for _ in range(2):
+            with self.assertRaises(ClusterUnavailableError):
+                await client.call("echo", {})
+        self.assertEqual(breaker.state, OPEN)
+
+        with self.assertRaisesRegex(CircuitOpenError, "not sent"):
+            await client.call("echo", {})
+        self.assertEqual(client.channel.connects, 0)
+        self.assertEqual(client.stats()["breaker"]["rejected"], 1)
+
+        # A failed probe opens the circuit again, an answered one closes it
+        await asyncio.sleep(0.3)
+        with self.assertRaises(ClusterUnavailableError):
+            await client.call("echo", {})
+        self.assertEqual(breaker.state, OPEN)
+        await asyncio.sleep(0.3)
+        client.channel.command = AGENT_COMMAND
+        self.assertEqual(await client.call("echo", {"ok": True}), {"ok": True})
+        self.assertEqual(breaker.state, CLOSED)
+        await client.close()
+
+    async def test_waiting_for_a_slot_does_not_open_the_breaker(self):
+        self.client.breaker.failure_threshold = 1
+        busy = [
+            asyncio.create_task(self.client.call("sleep", {"seconds": 1}, timeout=5))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.1)
+
+        with self.assertRaisesRegex(ClusterBusyError, "No free slot"):
+            await self.client.call("echo", {}, timeout=0.2)
+        await asyncio.gather(*busy)
+
+        self.assertEqual((self.client.breaker.state, self.client.breaker.failures), (CLOSED, 0))
+        self.assertEqual((self.client.stats()["in_flight"], self.client.stats()["waiting"]), (0, 0))
+
+    async def test_failed_actions_do_not_open_the_breaker(self):
+        self.client.breaker.failure_threshold = 1
+        with self.assertRaisesRegex(ClusterError, "no such job"):
+            await self.client.call("fail", {"message": "no such job"})
+        self.assertEqual(self.client.breaker.state, CLOSED)
+
+    async def test_wait_for_keeps_a_cancellation(self):
+        done = asyncio.get_running_loop().create_future()
+        waiter = asyncio.create_task(wait_for(done, 10))
+        await asyncio.sleep(0)
+
+        # Cancelled as the awaitable finishes, asyncio.wait_for would return 1
+        done.set_result(1)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await wait_for(asyncio.sleep(1), 0.1)
+        self.assertEqual(await wait_for(asyncio.sleep(0, "result"), 1), "result")
+
+    async def test_cancelled_one_shot_call_kills_the_script(self):
+        call = asyncio.create_task(
+            run_cluster_script_async([sys.executable, FAKE_CLUSTER], "sleep", {"seconds": 30})
+        )
+        await asyncio.sleep(0.5)
+        start = time.monotonic()
+        call.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await call
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_half_open_allows_limited_probes(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.1, half_open_calls=2)
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 0)
+
+        time.sleep(0.1)
+        self.assertEqual(breaker.retry_after(), 0)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.stats()["opens"], 1)
+        self.assertEqual(breaker.stats()["rejected"], 2)
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class TestPoller(unittest.IsolatedAsyncioTestCase):
+    email = "testpoller@testdomain.com"
+
+    async def asyncSetUp(self):
+        self.job_ids = [uuid.uuid4() for _ in range(3)]
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == self.email))
+            session.add_all(
+                Job(id=job_id, userid=self.email, job_name="job", status=JobStatus.RUNNING)
+                for job_id in self.job_ids
+            )
+            session.commit()
+
+        self.state = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump(
+            {
+                str(self.job_ids[0]): {"status": "COMPLETED", "finished": "2024-01-01T12:00:00"},
+                str(self.job_ids[1]): {"status": "FAILED", "error_message": "SCF did not converge"},
+            },
+            self.state,
+        )
+        self.state.close()
+        self.log = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+        self.log.close()
+
+        self.environ = dict(os.environ)
+        os.environ.update(
+            {
+                "CLUSTER_AGENT_COMMAND": " ".join(AGENT_COMMAND),
+                "FAKE_CLUSTER_STATE": self.state.name,
+                "FAKE_CLUSTER_LOG": self.log.name,
+                "AWS_ACCESS_KEY_ID": "test",
+                "AWS_SECRET_ACCESS_KEY": "test",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "S3_BUCKET": "test-bucket",
+                # There is no S3 to check the uploads in
+                "RESULT_VERIFY_UPLOADS": "0",
+            }
+        )
+
+    async def asyncTearDown(self):
+        await get_result_pipeline().stop()
+        await channel.get_async_cluster_client().close()
+        await db_engine.async_engine.dispose()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.unlink(self.state.name)
+        os.unlink(self.log.name)
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == self.email))
+            session.commit()
+
+    async def collect_results(self):
+        pipeline = get_result_pipeline()
+        pipeline.start()
+        await pipeline.join()
+
+    async def test_check_jobs_status(self):
+        await check_jobs_status()
+        await self.collect_results()
+
+        with Session(db_engine.engine) as session:
+            jobs = dict(
+                session.execute(
+                    select(Job.id, Job.status).filter(Job.userid == self.email)
+                ).all()
+            )
+        self.assertEqual(
+            jobs,
+            {
+                self.job_ids[0]: JobStatus.COMPLETED,
+                self.job_ids[1]: JobStatus.FAILED,
+                self.job_ids[2]: JobStatus.RUNNING,
+            },
+        )
+
+        with open(self.log.name) as log:
+            calls = sorted(log.read().splitlines())
+        finished = sorted(str(job_id) for job_id in self.job_ids[:2])
+        self.assertEqual(
+            calls,
+            ["check "]
+            + [f"clean {job_id}" for job_id in finished]
+            + [f"result_sizes {job_id}" for job_id in finished]
+            + sorted(f"upload {job_id}" for job_id in finished for _ in range(2)),
+        )
+
+    async def test_check_jobs_status_keeps_the_503_of_an_open_breaker(self):
+        breaker = channel.get_async_cluster_client().breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        with self.assertRaises(HTTPException) as error:
+            await check_jobs_status()
+        self.assertEqual(error.exception.status_code, 503)
+
+    async def callback(self, body, timestamp=None, secret="callback secret"):
+        from ...main import app
+
+        body = json.dumps(body).encode()
+        timestamp = str(timestamp or time.time())
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            return await client.post(
+                "/cluster/callback",
+                content=body,
+                headers={
+                    "X-Cluster-Timestamp": timestamp,
+                    "X-Cluster-Signature": sign_cluster_callback(body, timestamp, secret),
+                },
+            )
+
+    def job_statuses(self):
+        with Session(db_engine.engine) as session:
+            return dict(
+                session.execute(
+                    select(Job.id, Job.status).filter(Job.userid == self.email)
+                ).all()
+            )
+
+    async def test_callback_is_idempotent(self):
+        os.environ["CLUSTER_CALLBACK_SECRET"] = "callback secret"
+        completed = {
+            "jobs": {
+                str(self.job_ids[0]): {"status": "COMPLETED", "finished": "2024-01-01T12:00:00"},
+                str(self.job_ids[1]): {"status": "RUNNING", "started": "2024-01-01T11:00:00"},
+            }
+        }
+
+        first = await self.callback(completed)
+        repeated = await self.callback(completed)
+        late = await self.callback({"jobs": {str(self.job_ids[0]): {"status": "RUNNING"}}})
+        await self.collect_results()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), {"received": 2, "updated": 2})
+        self.assertEqual(repeated.json(), {"received": 2, "updated": 0})
+        self.assertEqual(late.json(), {"received": 1, "updated": 0})
+        self.assertEqual(
+            self.job_statuses(),
+            {
+                self.job_ids[0]: JobStatus.COMPLETED,
+                self.job_ids[1]: JobStatus.RUNNING,
+                self.job_ids[2]: JobStatus.RUNNING,
+            },
+        )
+        # The results of the completed job are collected once, without a check call
+        with open(self.log.name) as log:
+            calls = sorted(log.read().splitlines())
+        job_id = str(self.job_ids[0])
+        self.assertEqual(
+            calls,
+            [f"clean {job_id}", f"result_sizes {job_id}", f"upload {job_id}", f"upload {job_id}"],
+        )
+
+    async def test_callback_signature_is_checked(self):
+        body = {"jobs": {str(self.job_ids[0]): {"status": "COMPLETED"}}}
+
+        not_configured = await self.callback(body)
+        os.environ["CLUSTER_CALLBACK_SECRET"] = "callback secret"
+        wrong_secret = await self.callback(body, secret="guess")
+        expired = await self.callback(body, timestamp=time.time() - 3600)
+        invalid = await self.callback({"jobs": {"not a uuid": {"status": "DONE"}}})
+
+        self.assertEqual(not_configured.status_code, 503)
+        self.assertEqual(wrong_secret.status_code, 401)
+        self.assertEqual(expired.status_code, 401)
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(self.job_statuses()[self.job_ids[0]], JobStatus.RUNNING)
+
+    async def test_poller_polls_again_soon_after_changes(self):
+        poller = ClusterPoller(min_interval=5, max_interval=60, young_job_age=0)
+
+        interval = await poller.poll()
+
+        self.assertEqual(poller.last_changes, 2)
+        self.assertEqual(poller.polls, 1)
+        self.assertGreaterEqual(poller.active_jobs, 1)
+        self.assertEqual(interval, 5)
+        self.assertEqual(poller.stats()["interval"], 5)
+
+    def write_state(self, state):
+        with open(self.state.name, "w") as state_file:
+            json.dump(state, state_file)
+
+    def cluster_calls(self):
+        with open(self.log.name) as log:
+            return [line.split()[0] for line in log.read().splitlines()]
+
+    async def test_poller_only_asks_for_changes_since_its_watermark(self):
+        poller = ClusterPoller(min_interval=5, max_interval=60, full_check_interval=3600)
+
+        await poller.poll()
+        self.assertEqual((poller.full_checks, poller.watermark, poller.last_changes), (1, 0, 2))
+
+        self.write_state(
+            {str(self.job_ids[2]): {"status": "COMPLETED", "finished": "2024-01-01T12:00:00", "seq": 1}}
+        )
+        await poller.poll()
+        self.assertEqual((poller.incremental_checks, poller.watermark, poller.last_changes), (1, 1, 1))
+        await poller.poll()
+        self.assertEqual((poller.incremental_checks, poller.watermark, poller.last_changes), (2, 1, 0))
+
+        self.assertNotIn(JobStatus.RUNNING, self.job_statuses().values())
+        calls = [call for call in self.cluster_calls() if call.startswith("check")]
+        self.assertEqual(calls, ["check_since", "check", "check_since", "check_since"])
+        self.assertEqual(poller.stats()["full_checks"], 1)
+
+    async def test_poller_reconciles_all_jobs_periodically(self):
+        poller = ClusterPoller(min_interval=5, max_interval=60, full_check_interval=0)
+
+        await poller.poll()
+        await poller.poll()
+
+        self.assertEqual(poller.full_checks, 2)
+        self.assertEqual(poller.incremental_checks, 0)
+
+    async def test_poller_falls_back_to_full_checks(self):
+        os.environ["FAKE_CLUSTER_FULL_CHECK_ONLY"] = "1"
+        poller = ClusterPoller(min_interval=5, max_interval=60, full_check_interval=3600)
+
+        await poller.poll()
+        await poller.poll()
+
+        self.assertIsNone(poller.watermark)
+        self.assertEqual(poller.full_checks, 2)
+        calls = [call for call in self.cluster_calls() if call.startswith("check")]
+        self.assertEqual(calls, ["check_since", "check", "check"])
+
+    async def test_poller_falls_back_to_full_checks_when_check_since_fails(self):
+        os.environ["FAKE_CLUSTER_UNKNOWN_ACTIONS"] = "check_since"
+        poller = ClusterPoller(min_interval=5, max_interval=60, full_check_interval=3600)
+
+        await poller.poll()
+        await poller.poll()
+
+        self.assertIsNone(poller.watermark)
+        self.assertEqual((poller.full_checks, poller.last_changes), (2, 0))
+        self.assertEqual(self.job_statuses()[self.job_ids[0]], JobStatus.COMPLETED)
+        calls = [call for call in self.cluster_calls() if call.startswith("check")]
+        self.assertEqual(calls, ["check_since", "check", "check"])
+
+
+class TestResultPipeline(unittest.IsolatedAsyncioTestCase):
+    email = "testresults@testdomain.com"
+
+    async def asyncSetUp(self):
+        self.job_id = uuid.uuid4()
+        self.log = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+        self.log.close()
+        self.environ = dict(os.environ)
+        os.environ.update(
+            {
+                "CLUSTER_AGENT_COMMAND": " ".join(AGENT_COMMAND),
+                "FAKE_CLUSTER_LOG": self.log.name,
+                "AWS_ACCESS_KEY_ID": "test",
+                "AWS_SECRET_ACCESS_KEY": "test",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "S3_BUCKET": "test-bucket",
+            }
+        )
+        util._s3_client = None
+        self.s3 = Stubber(util.get_s3_client())
+        self.s3.activate()
+
+    async def asyncTearDown(self):
+        self.s3.deactivate()
+        util._s3_client = None
+        await channel.get_async_cluster_client().close()
+        await db_engine.async_engine.dispose()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.unlink(self.log.name)
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == self.email))
+            session.commit()
+
+    def cluster_calls(self):
+        with open(self.log.name) as log:
+            return sorted(line.split()[0] for line in log.read().splitlines())
+
+    def add_finished_job(self):
+        with Session(db_engine.engine) as session:
+            session.add(
+                Job(id=self.job_id, userid=self.email, job_name="job", status=JobStatus.COMPLETED)
+            )
+            session.flush()
+            session.add(Job_Result(jobid=self.job_id))
+            session.commit()
+
+    def pending_result(self):
+        with Session(db_engine.engine) as session:
+            return session.execute(
+                select(Job_Result.attempts, Job_Result.last_error).filter(
+                    Job_Result.jobid == self.job_id
+                )
+            ).first()
+
+    async def test_results_are_confirmed_before_cleanup(self):
+        self.add_finished_job()
+        self.s3.add_response("head_object", {"ContentLength": 10})
+        self.s3.add_response("head_object", {"ContentLength": 20})
+        pipeline = ResultPipeline(workers=2)
+
+        pipeline.start()
+        await pipeline.join()
+        await pipeline.stop()
+
+        self.s3.assert_no_pending_responses()
+        self.assertEqual(self.cluster_calls(), ["clean", "result_sizes", "upload", "upload"])
+        self.assertIsNone(self.pending_result())
+        stats = await pipeline.stats()
+        self.assertEqual((stats["completed"], stats["failed"], stats["queued"]), (1, 0, 0))
+        self.assertEqual(stats["stages"]["upload"]["succeeded"], 2)
+        self.assertEqual(stats["stages"]["confirm"]["succeeded"], 2)
+        self.assertEqual(stats["stages"]["clean"]["succeeded"], 1)
+
+    async def test_results_missing_from_s3_are_not_cleaned_up(self):
+        self.s3.add_response("head_object", {"ContentLength": 10})
+        for _ in range(2):
+            self.s3.add_client_error("head_object", "404", http_status_code=404)
+        pipeline = ResultPipeline(max_attempts=2, retry_delay=0)
+
+        self.assertFalse(await pipeline.process(self.job_id))
+
+        self.assertEqual(self.cluster_calls(), ["result_sizes", "upload", "upload", "upload"])
+        self.assertEqual((pipeline.retries, pipeline.failed), (1, 1))
+        self.assertEqual((await pipeline.stats())["stages"]["confirm"]["failed"], 2)
+
+    async def test_failed_collection_is_kept_for_a_later_attempt(self):
+        self.add_finished_job()
+        failures = tempfile.NamedTemporaryFile("w", delete=False)
+        failures.write("1")
+        failures.close()
+        os.environ["FAKE_CLUSTER_UPLOAD_FAILURES"] = failures.name
+        pipeline = ResultPipeline(max_attempts=1, retry_delay=3600, verify=False)
+
+        pipeline.start()
+        try:
+            await pipeline.join()
+        finally:
+            await pipeline.stop()
+            os.unlink(failures.name)
+
+        attempts, error = self.pending_result()
+        self.assertEqual(attempts, 1)
+        self.assertEqual(error, "The results could not be uploaded or cleaned up")
+        self.assertEqual((await pipeline.stats())["failed"], 1)
+        # Nothing was cleaned up on the cluster
+        self.assertNotIn("clean", self.cluster_calls())
+
+    async def test_stopped_pipeline_releases_its_claims(self):
+        self.add_finished_job()
+        os.environ["FAKE_CLUSTER_UPLOAD_DELAY"] = "5"
+        pipeline = ResultPipeline(verify=False)
+
+        pipeline.start()
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if pipeline.in_flight:
+                break
+        await pipeline.stop()
+
+        self.assertEqual(self.pending_result().attempts, 0)
+        with Session(db_engine.engine) as session:
+            due = session.scalar(
+                select(Job_Result.next_attempt <= func.localtimestamp()).filter(
+                    Job_Result.jobid == self.job_id
+                )
+            )
+        self.assertTrue(due)
+
+    async def test_failed_upload_is_retried_alone(self):
+        failures = tempfile.NamedTemporaryFile("w", delete=False)
+        failures.write("1")
+        failures.close()
+        os.environ["FAKE_CLUSTER_UPLOAD_FAILURES"] = failures.name
+        pipeline = ResultPipeline(retry_delay=0, verify=False)
+
+        try:
+            self.assertTrue(await pipeline.process(self.job_id))
+        finally:
+            os.unlink(failures.name)
+
+        self.assertEqual(pipeline.retries, 1)
+        self.assertEqual((await pipeline.stats())["stages"]["upload"]["failed"], 1)
+        self.assertEqual(
+            self.cluster_calls(), ["clean", "result_sizes", "upload", "upload", "upload"]
+        )
+
+    async def test_upload_deadline_grows_with_the_artifact(self):
+        os.environ.update(
+            {
+                "FAKE_CLUSTER_RESULT_SIZES": json.dumps({"archive": 100, "jobs": 1}),
+                "FAKE_CLUSTER_UPLOAD_DELAY": "0.5",
+                "CLUSTER_ACTION_TIMEOUTS": "upload=0.2",
+            }
+        )
+        pipeline = ResultPipeline(max_attempts=1, upload_rate=100, verify=False)
+
+        # 0.2 + 100 / 100 seconds for the archive, the small jobs JSON times out
+        self.assertFalse(await pipeline.process(self.job_id))
+
+        stages = (await pipeline.stats())["stages"]["upload"]
+        self.assertEqual((stages["succeeded"], stages["failed"], stages["bytes"]), (1, 1, 100))
+
+    async def test_large_archive_is_uploaded_in_parts(self):
+        os.environ["FAKE_CLUSTER_RESULT_SIZES"] = json.dumps({"archive": 25, "jobs": 3})
+        key = f"/archive/{self.job_id}.zip/"
+        self.s3.add_response(
+            "create_multipart_upload",
+            {"UploadId": "upload-1", "Bucket": "test-bucket", "Key": key},
+            {"Bucket": "test-bucket", "Key": key},
+        )
+        self.s3.add_response(
+            "complete_multipart_upload",
+            {},
+            {
+                "Bucket": "test-bucket",
+                "Key": key,
+                "UploadId": "upload-1",
+                "MultipartUpload": {
+                    "Parts": [{"PartNumber": i, "ETag": f'"etag{i}"'} for i in range(1, 4)]
+                },
+            },
+        )
+        pipeline = ResultPipeline(multipart_threshold=10, part_size=10, verify=False)
+
+        self.assertTrue(await pipeline.process(self.job_id))
+
+        self.s3.assert_no_pending_responses()
+        self.assertEqual((await pipeline.stats())["stages"]["upload"]["bytes"], 28)
+
+    async def test_cancelled_multipart_upload_is_aborted(self):
+        os.environ["FAKE_CLUSTER_UPLOAD_DELAY"] = "1"
+        key = f"/archive/{self.job_id}.zip/"
+        self.s3.add_response(
+            "create_multipart_upload",
+            {"UploadId": "upload-1", "Bucket": "test-bucket", "Key": key},
+            {"Bucket": "test-bucket", "Key": key},
+        )
+        self.s3.add_response(
+            "abort_multipart_upload",
+            {},
+            {"Bucket": "test-bucket", "Key": key, "UploadId": "upload-1"},
+        )
+        upload = asyncio.create_task(upload_result(self.job_id, "archive", 25, 10))
+        await asyncio.sleep(0.3)
+
+        # A second cancellation while aborting does not stop the abort
+        upload.cancel()
+        await asyncio.sleep(0)
+        upload.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await upload
+        for _ in range(50):
+            if not self.s3._queue:
+                break
+            await asyncio.sleep(0.1)
+        self.s3.assert_no_pending_responses()
+
+    def test_multipart_lifecycle_rule_keeps_other_rules(self):
+        expire = {"ID": "expire-logs", "Filter": {"Prefix": "logs/"}, "Status": "Enabled", "Expiration": {"Days": 30}}
+        rule = {
+            "ID": "abort-incomplete-multipart-uploads",
+            "Filter": {"Prefix": ""},
+            "Status": "Enabled",
+            "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+        }
+        self.s3.add_response(
+            "get_bucket_lifecycle_configuration", {"Rules": [expire]}, {"Bucket": "test-bucket"}
+        )
+        self.s3.add_response(
+            "put_bucket_lifecycle_configuration",
+            {},
+            {"Bucket": "test-bucket", "LifecycleConfiguration": {"Rules": [expire, rule]}},
+        )
+        self.s3.add_response(
+            "get_bucket_lifecycle_configuration", {"Rules": [expire, rule]}, {"Bucket": "test-bucket"}
+        )
+
+        self.assertTrue(util.ensure_multipart_lifecycle_rule())
+        self.assertFalse(util.ensure_multipart_lifecycle_rule())
+        self.s3.assert_no_pending_responses()
+
+
+class TestClusterPollerInterval(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.poller = ClusterPoller(min_interval=30, max_interval=7200, young_job_age=600)
+
+    def job(self, status, age):
+        return SimpleNamespace(id=uuid.uuid4(), status=status, age=age)
+
+    async def test_no_active_jobs(self):
+        self.assertEqual(self.poller.next_interval([], 3600, 0), 7200)
+
+    async def test_young_jobs(self):
+        jobs = [self.job(JobStatus.SUBMITTED, 60), self.job(JobStatus.RUNNING, 5000)]
+
+        self.assertEqual(self.poller.next_interval(jobs, 36000, 0), 30)
+        self.assertEqual(self.poller.young_jobs, 1)
+
+    async def test_jobs_near_completion(self):
+        jobs = [self.job(JobStatus.RUNNING, 3000)]
+
+        self.assertEqual(self.poller.next_interval(jobs, 3600, 0), 30)
+        # Only running jobs are expected to finish
+        self.assertEqual(
+            self.poller.next_interval([self.job(JobStatus.SUBMITTED, 3000)], 3600, 0), 60
+        )
+
+    async def test_backs_off_while_nothing_changes(self):
+        jobs = [self.job(JobStatus.RUNNING, 1000)]
+        intervals = []
+        for _ in range(10):
+            self.poller.interval = self.poller.next_interval(jobs, 36000, 0)
+            intervals.append(self.poller.interval)
+
+        self.assertEqual(intervals, [60, 120, 240, 480, 960, 1920, 3840, 7200, 7200, 7200])
+        self.assertEqual(self.poller.next_interval(jobs, 36000, 1), 30)
+
+    async def test_submitted_job_wakes_the_poller(self):
+        polls = []
+
+        class IdlePoller(ClusterPoller):
+            async def poll(self):
+                polls.append(time.monotonic())
+                self.interval = self.max_interval
+                return self.interval
+
+        poller = IdlePoller(min_interval=0.2, max_interval=60)
+        poller.start()
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(polls), 1)
+        self.assertGreater(poller.stats()["next_poll_in"], 50)
+
+        poller.notify_job_submitted()
+        await asyncio.sleep(0.1)
+        self.assertLessEqual(poller.stats()["next_poll_in"], 0.2)
+        await asyncio.sleep(0.3)
+        await poller.stop()
+
+        self.assertEqual(len(polls), 2)
+
+
+class TestSubmissionDispatcher(unittest.IsolatedAsyncioTestCase):
+    email = "testdispatcher@testdomain.com"
+
+    async def asyncSetUp(self):
+        self.environ = dict(os.environ)
+        self.log = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+        self.log.close()
+        os.environ["CLUSTER_AGENT_COMMAND"] = " ".join(AGENT_COMMAND)
+        os.environ["FAKE_CLUSTER_LOG"] = self.log.name
+
+        self.job_ids = [uuid.uuid4() for _ in range(5)]
+        jobs = [
+            (
+                job_id,
+                CreateJobDTO(
+                    job_name="job",
+                    parameters={"source": StructureOrigin.CALCULATED, "id": str(job_id)},
+                ),
+                None,
+            )
+            for job_id in self.job_ids
+        ]
+        jobs[3][1].parameters["reject"] = "Unknown basis set"
+        self.assertTrue(await post_new_jobs_async(self.email, jobs))
+
+    async def asyncTearDown(self):
+        await channel.get_async_cluster_client().close()
+        await db_engine.async_engine.dispose()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.unlink(self.log.name)
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == self.email))
+            session.commit()
+
+    def jobs(self):
+        with Session(db_engine.engine) as session:
+            return {
+                job.id: job
+                for job in session.execute(
+                    select(Job.id, Job.status, Job.error_message).filter(Job.userid == self.email)
+                )
+            }
+
+    def queued(self):
+        with Session(db_engine.engine) as session:
+            return set(
+                session.scalars(
+                    select(Job_Outbox.jobid).filter(Job_Outbox.jobid.in_(self.job_ids))
+                )
+            )
+
+    async def test_queued_jobs_are_submitted_in_batches(self):
+        dispatcher = SubmissionDispatcher(workers=2, batch_size=2, idle_interval=0.1)
+        dispatcher.start()
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            # The outbox empties just before the outcome is counted
+            if dispatcher.submitted + dispatcher.rejected == 5:
+                break
+        await dispatcher.stop()
+
+        jobs = self.jobs()
+        self.assertEqual(self.queued(), set())
+        self.assertEqual(jobs[self.job_ids[3]].status, JobStatus.FAILED)
+        self.assertEqual(jobs[self.job_ids[3]].error_message, "Unknown basis set")
+        self.assertEqual(
+            [jobs[job_id].status for job_id in self.job_ids if job_id != self.job_ids[3]],
+            [JobStatus.SUBMITTED] * 4,
+        )
+        stats = await dispatcher.stats()
+        self.assertEqual((stats["submitted"], stats["rejected"], stats["in_flight"]), (4, 1, 0))
+        with open(self.log.name) as log:
+            self.assertEqual(log.read().splitlines(), ["submit_batch "] * 3)
+
+    async def test_jobs_stay_queued_while_the_breaker_is_open(self):
+        breaker = channel.get_async_cluster_client().breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        dispatcher = SubmissionDispatcher(batch_size=10)
+
+        self.assertEqual(await dispatcher.dispatch_batch(), 0)
+        with Session(db_engine.engine) as session:
+            attempts = session.scalars(
+                select(Job_Outbox.attempts).filter(Job_Outbox.jobid.in_(self.job_ids))
+            ).all()
+        self.assertEqual(attempts, [0] * 5)
+
+    async def test_refused_submissions_keep_their_attempts(self):
+        dispatcher = SubmissionDispatcher(batch_size=10, max_attempts=1)
+        refused = HTTPException(status_code=503, detail="The cluster circuit breaker is open")
+
+        with unittest.mock.patch(
+            "app.cluster.dispatcher.submit_job_batch", side_effect=refused
+        ):
+            self.assertEqual(await dispatcher.dispatch_batch(), 5)
+
+        self.assertEqual(self.queued(), set(self.job_ids))
+        self.assertEqual((dispatcher.released, dispatcher.failed), (5, 0))
+        with Session(db_engine.engine) as session:
+            entries = session.execute(
+                select(Job_Outbox.attempts, Job_Outbox.next_attempt > func.localtimestamp())
+                .filter(Job_Outbox.jobid.in_(self.job_ids))
+            ).all()
+        self.assertEqual([tuple(entry) for entry in entries], [(0, True)] * 5)
+
+    async def test_failed_submissions_are_retried_then_failed(self):
+        os.environ["CLUSTER_AGENT_COMMAND"] = "/no/such/command"
+        dispatcher = SubmissionDispatcher(
+            batch_size=10, max_attempts=2, retry_delay=0, max_retry_delay=0
+        )
+
+        self.assertEqual(await dispatcher.dispatch_batch(), 5)
+        self.assertEqual(self.queued(), set(self.job_ids))
+        self.assertEqual(dispatcher.retried, 5)
+
+        self.assertEqual(await dispatcher.dispatch_batch(), 5)
+        self.assertEqual(self.queued(), set())
+        self.assertEqual(dispatcher.failed, 5)
+        for job in self.jobs().values():
+            self.assertEqual(job.status, JobStatus.FAILED)
+            self.assertRegex(job.error_message, "could not be sent to the cluster")
+
+
+class FakeComponent:
+    def __init__(self):
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+
+class TestClusterWorker(unittest.IsolatedAsyncioTestCase):
+    lock_id = 735299
+
+    async def asyncSetUp(self):
+        self.components = [FakeComponent(), FakeComponent()]
+        self.queued = asyncio.Event()
+        self.workers = [
+            ClusterWorker([component], self.queued.set, self.lock_id, retry_interval=0.1)
+            for component in self.components
+        ]
+
+    async def asyncTearDown(self):
+        for worker in self.workers:
+            await worker.stop()
+        await db_engine.async_engine.dispose()
+
+    async def wait_for(self, condition):
+        for _ in range(50):
+            if condition():
+                return
+            await asyncio.sleep(0.1)
+        self.fail("condition not met")
+
+    def leaders(self):
+        return [worker for worker in self.workers if worker.is_leader]
+
+    async def test_one_leader_with_failover(self):
+        for worker in self.workers:
+            worker.start()
+        await self.wait_for(lambda: self.leaders())
+        await asyncio.sleep(0.5)
+        leader, = self.leaders()
+        self.assertEqual([component.running for component in self.components].count(True), 1)
+        self.assertTrue(leader.components[0].running)
+
+        await leader.stop()
+        self.assertFalse(leader.components[0].running)
+        await self.wait_for(lambda: self.leaders())
+        follower, = self.leaders()
+        self.assertIsNot(follower, leader)
+        self.assertTrue(follower.components[0].running)
+        self.assertEqual(follower.stats()["elections"], 1)
+
+    async def test_leadership_is_regained_after_a_lost_connection(self):
+        worker = self.workers[0]
+        worker.start()
+        await self.wait_for(lambda: worker.is_leader)
+
+        async with db_engine.async_engine.connect() as conn:
+            await conn.execute(
+                select(func.pg_terminate_backend(text("pid"))).select_from(text("pg_locks"))
+                .where(text("locktype = 'advisory' AND objid = :lock_id"))
+                .params(lock_id=self.lock_id)
+            )
+        await self.wait_for(lambda: not worker.is_leader)
+        self.assertFalse(self.components[0].running)
+        await self.wait_for(lambda: worker.is_leader)
+        self.assertTrue(self.components[0].running)
+        self.assertEqual(worker.stats()["elections"], 2)
+
+    async def test_queued_jobs_wake_the_leader(self):
+        worker = self.workers[0]
+        worker.start()
+        await self.wait_for(lambda: worker.is_leader)
+
+        email = "testworker@testdomain.com"
+        job_id = uuid.uuid4()
+        job = CreateJobDTO(job_name="job", parameters={"source": StructureOrigin.CALCULATED})
+        try:
+            self.assertTrue(await post_new_jobs_async(email, [(job_id, job, None)]))
+            await asyncio.wait_for(self.queued.wait(), 5)
+
+            # The pooled connection no longer calls back once the worker stops
+            await worker.stop()
+            self.queued.clear()
+            self.assertTrue(await post_new_jobs_async(email, [(uuid.uuid4(), job, None)]))
+            await asyncio.sleep(0.5)
+            self.assertFalse(self.queued.is_set())
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+
+class TestSimulator(unittest.IsolatedAsyncioTestCase):
+    email = "testsimulator@testdomain.com"
+
+    async def asyncSetUp(self):
+        self.state = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        self.state.close()
+        self.environ = dict(os.environ)
+        os.environ.update(
+            {
+                "CLUSTER_AGENT_COMMAND": f"{sys.executable} {AGENT} {SIMULATOR}",
+                "SIMULATOR_STATE": self.state.name,
+                "SIMULATOR_QUEUE_TIME": "fixed:0.3",
+                "SIMULATOR_DURATION": "fixed:0.5",
+                "SIMULATOR_JOB_FAILURE_RATE": "0",
+                "AWS_ACCESS_KEY_ID": "test",
+                "AWS_SECRET_ACCESS_KEY": "test",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "S3_BUCKET": "test-bucket",
+                "RESULT_VERIFY_UPLOADS": "0",
+            }
+        )
+        self.client = channel.get_async_cluster_client()
+
+    async def asyncTearDown(self):
+        await get_result_pipeline().stop()
+        await self.client.close()
+        await db_engine.async_engine.dispose()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.unlink(self.state.name)
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == self.email))
+            session.commit()
+
+    async def test_jobs_run_through_their_lifecycle(self):
+        await self.client.call("submit_batch", {"jobs": [{"id": "a"}, {"id": "b"}]})
+        since = await self.client.call("check_since", {"since": None, "version": 1})
+        watermark = since["watermark"]
+        jobs_dict = {"a": "SUBMITTED", "b": "SUBMITTED"}
+        self.assertEqual(await self.client.call("check", {"jobs_dict": jobs_dict}), {"a": 0, "b": 0})
+        self.assertEqual(await self.client.call("cancel", {"id": "b"}), {"status": "SUCCESS"})
+
+        await asyncio.sleep(0.4)
+        changes = await self.client.call("check_since", {"since": watermark, "version": 1})
+        self.assertEqual(changes["jobs"]["a"]["status"], "RUNNING")
+        self.assertEqual(changes["jobs"]["b"]["status"], "CANCELLED")
+        await asyncio.sleep(0.5)
+        result = await self.client.call("check", {"jobs_dict": {"a": "RUNNING", "b": "CANCELLED"}})
+        self.assertEqual(result["a"]["status"], "COMPLETED")
+        self.assertEqual(result["b"], 0)
+        self.assertEqual(await self.client.call("cancel", {"id": "a"}), {"status": "FAILED"})
+
+        sizes = await self.client.call("result_sizes", {"id": "a"})
+        self.assertEqual(sorted(sizes), ["archive", "jobs"])
+        self.assertEqual(await self.client.call("clean", {"id": "a"}), {"status": "SUCCESS"})
+        self.assertEqual(await self.client.call("result_sizes", {"id": "a"}), {})
+
+    async def test_calls_fail_at_the_configured_rate(self):
+        os.environ["SIMULATOR_FAILURE_RATE"] = "1"
+        with self.assertRaisesRegex(ClusterError, "Simulated cluster failure"):
+            await self.client.call("check", {"jobs_dict": {}})
+        self.assertEqual(self.client.breaker.state, CLOSED)
+
+    async def test_jobs_are_submitted_polled_and_collected(self):
+        job_ids = [uuid.uuid4() for _ in range(5)]
+        jobs = [
+            (
+                job_id,
+                CreateJobDTO(
+                    job_name="job",
+                    parameters={"source": StructureOrigin.CALCULATED, "id": str(job_id)},
+                ),
+                None,
+            )
+            for job_id in job_ids
+        ]
+        self.assertTrue(await post_new_jobs_async(self.email, jobs))
+        dispatcher = SubmissionDispatcher(idle_interval=0.1)
+        poller = ClusterPoller(min_interval=0.2)
+        dispatcher.start()
+        poller.start()
+        get_result_pipeline().start()
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.1)
+                with Session(db_engine.engine) as session:
+                    statuses = session.scalars(
+                        select(Job.status).filter(Job.userid == self.email)
+                    ).all()
+                # The poller queues the results once the statuses are saved
+                collected = get_result_pipeline().completed
+                if statuses == [JobStatus.COMPLETED] * 5 and collected == 5:
+                    break
+        finally:
+            await poller.stop()
+            await dispatcher.stop()
+
+        self.assertEqual(statuses, [JobStatus.COMPLETED] * 5)
+        self.assertGreater(poller.incremental_checks, 0)
+        self.assertEqual(get_result_pipeline().completed, 5)
+        with open(self.state.name) as state:
+            self.assertEqual(json.load(state), {})
+        with Session(db_engine.engine) as session:
+            pending = session.scalar(
+                select(func.count()).select_from(Job_Result).filter(Job_Result.jobid.in_(job_ids))
+            )
+        self.assertEqual(pending, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
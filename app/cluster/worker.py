@@ -0,0 +1,205 @@
+"""Runs the cluster poller, the job dispatcher and the result pipeline in one process of the deployment
+
+Every process that runs a ClusterWorker takes part in an election: the one that
+holds the Postgres advisory lock CLUSTER_LEADER_LOCK_ID is the leader and runs the
+poller, the dispatcher, the result pipeline and the daily job status count
+reconciliation, the others wait. The lock belongs to the leader's database session, so when the leader stops
+or loses its connection Postgres releases it and another process takes over within
+CLUSTER_LEADER_RETRY_INTERVAL seconds.
+
+The app runs a ClusterWorker in each uvicorn worker unless CLUSTER_WORKER_IN_APP is
+0. The background work can instead run in its own process with:
+
+    python -m app.cluster.worker
+"""
+import asyncio
+import os
+import signal
+import weakref
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import func, select, text
+
+from ..database.db_engine import db_engine
+from ..database.job_management import JOB_OUTBOX_CHANNEL, reconcile_job_status_counts
+from .channel import get_async_cluster_client
+from .dispatcher import get_submission_dispatcher
+from .poller import get_cluster_poller
+from .results import get_result_pipeline
+
+# Key of the advisory lock held by the leader
+CLUSTER_LEADER_LOCK_ID = 735202
+
+
+class StatusCountReconciler:
+    """Repairs the job status counters once a day"""
+
+    def __init__(self):
+        self._scheduler = None
+
+    def start(self):
+        # Plain functions such as reconcile_job_status_counts run in a worker thread
+        self._scheduler = AsyncIOScheduler()
+        self._scheduler.add_job(reconcile_job_status_counts, 'interval', hours=24)
+        self._scheduler.start()
+
+    async def stop(self):
+        if self._scheduler is not None:
+            self._scheduler.shutdown()
+            self._scheduler = None
+
+
+class ClusterWorker:
+    """Runs the background components while this process is the elected leader
+
+    Args:
+        components (List, optional): Objects with start() and async stop(), by
+            default the poller, the dispatcher, the result pipeline and a
+            StatusCountReconciler
+        on_jobs_queued (Callable, optional): Called when any process queues jobs,
+            by default wakes the dispatcher
+        lock_id (int): Key of the advisory lock
+        retry_interval (float): Seconds between attempts to become the leader, and
+            between checks that the leader still holds the lock
+    """
+
+    def __init__(
+        self,
+        components: Optional[List] = None,
+        on_jobs_queued: Optional[Callable[[], None]] = None,
+        lock_id: int = CLUSTER_LEADER_LOCK_ID,
+        retry_interval: float = 10,
+    ):
+        if components is None:
+            dispatcher = get_submission_dispatcher()
+            components = [
+                get_cluster_poller(),
+                dispatcher,
+                get_result_pipeline(),
+                StatusCountReconciler(),
+            ]
+            on_jobs_queued = on_jobs_queued or dispatcher.notify_jobs_queued
+        self.components = components
+        self.on_jobs_queued = on_jobs_queued
+        self.lock_id = lock_id
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self.leader_since = None
+        self.elections = 0
+        self._task = None
+        self._listener = None
+
+    async def _lead(self):
+        """Takes the lock if it is free and leads for as long as it is held"""
+        conn = await db_engine.async_engine.connect()
+        try:
+            acquired = await conn.scalar(select(func.pg_try_advisory_lock(self.lock_id)))
+            await conn.commit()
+            if not acquired:
+                return
+
+            if self.on_jobs_queued is not None:
+                raw = await conn.get_raw_connection()
+                # Kept to remove the same callback when the lock is released
+                self._listener = lambda *args: self.on_jobs_queued()
+                await raw.driver_connection.add_listener(JOB_OUTBOX_CHANNEL, self._listener)
+            self.is_leader = True
+            self.leader_since = datetime.now(timezone.utc)
+            self.elections += 1
+            for component in self.components:
+                component.start()
+            try:
+                # A broken connection has lost the lock along with its session
+                while True:
+                    await asyncio.sleep(self.retry_interval)
+                    await conn.execute(text("SELECT 1"))
+                    await conn.commit()
+            finally:
+                self.is_leader = False
+                self.leader_since = None
+                for component in reversed(self.components):
+                    await component.stop()
+        finally:
+            try:
+                await asyncio.shield(self._release(conn))
+            except Exception:
+                # The lock must not stay with a pooled connection
+                await conn.invalidate()
+            await conn.close()
+
+    async def _release(self, conn):
+        await conn.rollback()
+        await conn.execute(select(func.pg_advisory_unlock_all()))
+        await conn.commit()
+        if self._listener is not None:
+            # Sends UNLISTEN once no callback is left on the channel
+            raw = await conn.get_raw_connection()
+            listener, self._listener = self._listener, None
+            await raw.driver_connection.remove_listener(JOB_OUTBOX_CHANNEL, listener)
+
+    async def run(self):
+        while True:
+            try:
+                await self._lead()
+            except Exception as e:
+                print(f"Error: the cluster worker lost its database connection: {e}")
+            await asyncio.sleep(self.retry_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "is_leader": self.is_leader,
+            "leader_since": self.leader_since.isoformat() if self.leader_since else None,
+            "elections": self.elections,
+        }
+
+
+_workers = weakref.WeakKeyDictionary()
+
+
+def get_cluster_worker() -> ClusterWorker:
+    """Gets the cluster worker of the running event loop
+
+    It tries to become the leader every CLUSTER_LEADER_RETRY_INTERVAL (10 seconds).
+    """
+    loop = asyncio.get_running_loop()
+    worker = _workers.get(loop)
+    if worker is None:
+        worker = ClusterWorker(
+            retry_interval=float(os.environ.get("CLUSTER_LEADER_RETRY_INTERVAL", 10))
+        )
+        _workers[loop] = worker
+    return worker
+
+
+async def main():
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    worker = get_cluster_worker()
+    worker.start()
+    print("Cluster worker started, waiting to become the leader")
+    await stopping.wait()
+    await worker.stop()
+    await get_async_cluster_client().close()
+    await db_engine.async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,50 +1,127 @@
 from .db_engine import db_engine
+from ..metrics import DB_OPERATION_SECONDS, timed
 
 from .db_tables import Available_Basis_Sets, Available_Calculations, Available_Methods, Available_Solvent_Effects
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import asc
+from sqlalchemy import asc, select
 
-from typing import List
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, List, Optional
 from ..models import (
     CalculationOptionModel
 )
 
+# The available_* tables almost never change, so their rows are kept in memory for
+# CALCULATION_OPTIONS_CACHE_TTL seconds. invalidate_calculation_options_cache() only
+# clears the cache of the current process, other workers pick up edits after the TTL.
+CALCULATION_OPTIONS_CACHE_TTL = float(os.environ.get("CALCULATION_OPTIONS_CACHE_TTL", 300))
 
-def get_all_available_calculations() -> List[CalculationOptionModel]:
-    with Session(db_engine.engine) as session:
-        available_calculations = (
-            session.query(Available_Calculations)
-            .order_by(asc(Available_Calculations.id))
-            .all()
-        )
+_options_cache: Dict[str, tuple] = {}
+_options_cache_lock = threading.Lock()
 
-    return available_calculations
 
+def invalidate_calculation_options_cache():
+    """Drops the cached calculation options, call it after editing an available_* table"""
+    with _options_cache_lock:
+        _options_cache.clear()
 
-def get_all_available_basis_sets() -> List[CalculationOptionModel]:
-    with Session(db_engine.engine) as session:
-        available_basis_sets = (
-            session.query(Available_Basis_Sets)
-            .order_by(asc(Available_Basis_Sets.id))
-            .all()
-        )
 
-    return available_basis_sets
+def _cached_options(table) -> Optional[List[CalculationOptionModel]]:
+    with _options_cache_lock:
+        entry = _options_cache.get(table.__table__.name)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
 
 
-def get_all_available_methods() -> List[CalculationOptionModel]:
-    with Session(db_engine.engine) as session:
-        available_methods = (
-            session.query(Available_Methods).order_by(asc(Available_Methods.id)).all()
+def _cache_options(table, rows) -> List[CalculationOptionModel]:
+    options = [CalculationOptionModel(id=row.id, name=row.name) for row in rows]
+    with _options_cache_lock:
+        _options_cache[table.__table__.name] = (
+            time.monotonic() + CALCULATION_OPTIONS_CACHE_TTL,
+            options,
         )
+    return options
+
+
+def _get_options(table) -> List[CalculationOptionModel]:
+    options = _cached_options(table)
+    if options is None:
+        with Session(db_engine.engine) as session:
+            rows = session.query(table).order_by(asc(table.id)).all()
+        options = _cache_options(table, rows)
+    return options
+
+
+async def _get_options_async(table) -> List[CalculationOptionModel]:
+    options = _cached_options(table)
+    if options is None:
+        async with db_engine.async_session() as session:
+            rows = (await session.scalars(select(table).order_by(asc(table.id)))).all()
+        options = _cache_options(table, rows)
+    return options
+
+
+@timed(DB_OPERATION_SECONDS)
+def get_all_available_calculations() -> List[CalculationOptionModel]:
+    return _get_options(Available_Calculations)
+
+
+@timed(DB_OPERATION_SECONDS)
+def get_all_available_basis_sets() -> List[CalculationOptionModel]:
+    return _get_options(Available_Basis_Sets)
 
-    return available_methods
 
+@timed(DB_OPERATION_SECONDS)
+def get_all_available_methods() -> List[CalculationOptionModel]:
+    return _get_options(Available_Methods)
+
+@timed(DB_OPERATION_SECONDS)
 def get_all_available_solvent_effects() -> List[CalculationOptionModel]:
-    with Session(db_engine.engine) as session:
-        available_solvent_effects = (
-            session.query(Available_Solvent_Effects).order_by(asc(Available_Solvent_Effects.id)).all()
-        )
-        
-    return available_solvent_effects
\ No newline at end of file
+    return _get_options(Available_Solvent_Effects)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_available_calculations_async() -> List[CalculationOptionModel]:
+    return await _get_options_async(Available_Calculations)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_available_basis_sets_async() -> List[CalculationOptionModel]:
+    return await _get_options_async(Available_Basis_Sets)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_available_methods_async() -> List[CalculationOptionModel]:
+    return await _get_options_async(Available_Methods)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_available_solvent_effects_async() -> List[CalculationOptionModel]:
+    return await _get_options_async(Available_Solvent_Effects)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_calculation_options_catalog_async() -> Dict[str, List[CalculationOptionModel]]:
+    """Gets every kind of calculation option at once
+
+    Returns:
+        Dict[str, List[CalculationOptionModel]]: Options keyed by "calculations",
+            "basis_sets", "methods" and "solvent_effects"
+    """
+    calculations, basis_sets, methods, solvent_effects = await asyncio.gather(
+        get_all_available_calculations_async(),
+        get_all_available_basis_sets_async(),
+        get_all_available_methods_async(),
+        get_all_available_solvent_effects_async(),
+    )
+    return {
+        "calculations": calculations,
+        "basis_sets": basis_sets,
+        "methods": methods,
+        "solvent_effects": solvent_effects,
+    }
@@ -1,18 +1,69 @@
-from sqlalchemy import Engine, create_engine, text
+from sqlalchemy import Engine, Row, create_engine, event, exc, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from pydantic import BaseModel, PrivateAttr
 
 from .entity_names import DB_NAME
+from ..metrics import DB_POOL_WAIT_SECONDS, DB_QUERY_SECONDS, registry
+import atexit
 import logging
 import os
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 from os.path import join, dirname
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import AsyncIterator
 
 dotenv_path = os.getcwd()+"/.env"
 load_dotenv(dotenv_path)
 
+# Rows fetched per round trip from a server-side cursor by DB_Engine.stream()
+STREAM_BATCH_SIZE = int(os.environ.get("DB_STREAM_BATCH_SIZE", 1000))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how often and how long callers wait for a connection"""
+
+    engine_name = "sync"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            DB_POOL_WAIT_SECONDS.observe(waited, engine=self.engine_name)
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """InstrumentedQueuePool for the asyncio engine"""
+
+    engine_name = "async"
+
+
 class DB_Engine(BaseModel):
     _engine: Engine = PrivateAttr()
+    _async_engine: AsyncEngine = PrivateAttr()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -21,21 +72,164 @@ class DB_Engine(BaseModel):
         db_passwd = os.environ.get("RDS_PASSWORD")
 
         db_url = f"postgresql://{db_username}:{db_passwd}@{host}/{DB_NAME}"
-        self._engine = create_engine(db_url, echo=True)
+        self._engine = create_engine(
+            db_url,
+            poolclass=InstrumentedQueuePool,
+            connect_args=_connect_args(),
+            **_pool_settings(),
+        )
+        _log_sql(self._engine, "sync")
+
+        async_db_url = f"postgresql+asyncpg://{db_username}:{db_passwd}@{host}/{DB_NAME}"
+        self._async_engine = create_async_engine(
+            async_db_url,
+            poolclass=InstrumentedAsyncAdaptedQueuePool,
+            connect_args=_async_connect_args(),
+            **_pool_settings(),
+        )
+        _log_sql(self._async_engine.sync_engine, "async")
 
     @property
     def engine(self) -> Engine:
         return self._engine
 
+    @property
+    def async_engine(self) -> AsyncEngine:
+        return self._async_engine
+
+    def async_session(self) -> AsyncSession:
+        # Objects stay loaded after commit, lazy loads are not possible with asyncio
+        return AsyncSession(self._async_engine, expire_on_commit=False)
+
+    async def stream(self, statement, batch_size: int = STREAM_BATCH_SIZE) -> AsyncIterator[Row]:
+        """Yields the rows of a query while they are read from a server-side cursor
+
+        Only batch_size rows are held in memory at a time. The connection stays
+        checked out until the iteration ends or the iterator is closed.
+
+        Args:
+            statement: SELECT statement
+            batch_size (int): Rows fetched from the cursor at a time
+
+        Yields:
+            Row: Rows of the query
+        """
+        async with self.async_session() as session:
+            result = await session.stream(statement.execution_options(yield_per=batch_size))
+            async for row in result:
+                yield row
+
     def validate_connection(self):
         with self.engine.connect() as conn:
             result = conn.execute(text("select 'test'"))
 
+    def pool_stats(self) -> dict:
+        """Reports pool usage so that saturation is visible
 
-handler = logging.FileHandler("/tmp/ubcc3-sql.log")
-handler.setLevel(logging.DEBUG)
-logger = logging.getLogger("sqlalchemy.engine")
+        Returns:
+            dict: Pool size, connections in use, overflow, and checkout wait statistics
+                of the "sync" and "async" engines
+        """
+        return {
+            "sync": _pool_stats(self._engine.pool),
+            "async": _pool_stats(self._async_engine.pool),
+        }
+
+
+def _pool_stats(pool: InstrumentedQueuePool) -> dict:
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": pool.checkouts,
+        "timeouts": pool.timeouts,
+        "wait_seconds_total": pool.wait_seconds_total,
+        "wait_seconds_max": pool.wait_seconds_max,
+    }
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _pool_settings() -> dict:
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": _env_flag("DB_POOL_PRE_PING", True),
+    }
+
+
+def _connect_args() -> dict:
+    statement_timeout_ms = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+    if statement_timeout_ms <= 0:
+        return {}
+    return {"options": f"-c statement_timeout={statement_timeout_ms}"}
+
+
+def _async_connect_args() -> dict:
+    statement_timeout_ms = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+    if statement_timeout_ms <= 0:
+        return {}
+    return {"server_settings": {"statement_timeout": str(statement_timeout_ms)}}
+
+
+# SQL statements are logged from a background thread so the request path only
+# pays for putting a record on a queue. DB_SQL_LOG selects what is logged:
+# "off", "all", "sample" (DB_SQL_LOG_SAMPLE_RATE of the statements) or "slow"
+# (statements slower than DB_SQL_SLOW_MS). The "sqlalchemy.engine" logger is left
+# alone because enabling it makes SQLAlchemy format every statement itself.
+# Statement times are also recorded in db_query_duration_seconds, by first keyword.
+logger = logging.getLogger("ubcc3.sql")
 logger.propagate = False
-logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+_sql_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_sql_log_queue))
+
+handler = logging.FileHandler(os.environ.get("DB_SQL_LOG_FILE", "/tmp/ubcc3-sql.log"), delay=True)
+handler.setLevel(logging.DEBUG)
+handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+_sql_log_listener = QueueListener(_sql_log_queue, handler)
+_sql_log_listener.start()
+atexit.register(_sql_log_listener.stop)
+
+
+def _log_sql(engine: Engine, engine_name: str):
+    mode = os.environ.get("DB_SQL_LOG", "slow").strip().lower()
+    if mode == "off" and registry.mode == "0":
+        return
+    sample_rate = float(os.environ.get("DB_SQL_LOG_SAMPLE_RATE", 0.01))
+    slow_seconds = float(os.environ.get("DB_SQL_SLOW_MS", 500)) / 1000
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        if registry.enabled:
+            keyword = (statement.split(None, 1) or [""])[0].upper()
+            DB_QUERY_SECONDS.observe(elapsed, engine=engine_name, statement=keyword)
+        if mode == "off":
+            return
+        if mode == "slow" and elapsed < slow_seconds:
+            return
+        if mode == "sample" and random.random() >= sample_rate:
+            return
+        logger.info("%.1f ms %s %r", elapsed * 1000, statement, parameters)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
 
 db_engine = DB_Engine()
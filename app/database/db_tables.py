@@ -1,4 +1,18 @@
-from sqlalchemy import Table
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Engine,
+    Integer,
+    String,
+    Table,
+    Text,
+    func,
+    inspect,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.ext.declarative import declarative_base
 from .entity_names import (
     USERS_TABLE_NAME,
@@ -9,52 +23,203 @@ from .entity_names import (
     AVAILABLE_BASIS_SETS,
     AVAILABLE_CALCULATIONS,
     AVAILABLE_METHODS,
-    AVAILABLE_SOLVENT_EFFECTS
+    AVAILABLE_SOLVENT_EFFECTS,
+    JOB_STATUS_COUNTS_TABLE_NAME,
+    JOB_OUTBOX_TABLE_NAME,
+    JOB_RESULTS_TABLE_NAME,
 )
 from .db_engine import db_engine
 
 
 Base = declarative_base()
 
+# Tables are declared instead of reflected so that importing the models does not
+# need the database. check_schema() compares them against a live database.
+
 
 class User(Base):
-    __table__ = Table(USERS_TABLE_NAME, Base.metadata, autoload_with=db_engine.engine)
+    __table__ = Table(
+        USERS_TABLE_NAME,
+        Base.metadata,
+        Column("email", String, primary_key=True),
+        Column("created", DateTime, server_default=func.now()),
+        Column("lastlogin", DateTime),
+        Column("active", Boolean),
+        Column("admin", Boolean),
+    )
 
 
 class Job(Base):
-    __table__ = Table(JOBS_TABLE_NAME, Base.metadata, autoload_with=db_engine.engine)
+    __table__ = Table(
+        JOBS_TABLE_NAME,
+        Base.metadata,
+        Column("id", UUID(as_uuid=True), primary_key=True),
+        Column("created", DateTime, server_default=func.now()),
+        Column("userid", String),
+        Column("job_name", String),
+        Column("submitted", DateTime),
+        Column("started", DateTime),
+        Column("finished", DateTime),
+        Column("status", String, server_default=text("'SUBMITTED'")),
+        Column("error_message", Text),
+        Column("parameters", JSONB),
+    )
+
+
+class Job_Status_Count(Base):
+    """Number of jobs per user and status, maintained by a trigger on jobs (migration 3)"""
+    __table__ = Table(
+        JOB_STATUS_COUNTS_TABLE_NAME,
+        Base.metadata,
+        Column("userid", String, primary_key=True),
+        Column("status", String, primary_key=True),
+        Column("count", BigInteger, nullable=False, server_default=text("0")),
+    )
+
+
+class Job_Outbox(Base):
+    """Jobs saved but not yet accepted by the cluster, drained by the dispatcher (migration 4)"""
+    __table__ = Table(
+        JOB_OUTBOX_TABLE_NAME,
+        Base.metadata,
+        Column("jobid", UUID(as_uuid=True), primary_key=True),
+        Column("created", DateTime, server_default=func.now()),
+        Column("attempts", Integer, nullable=False, server_default=text("0")),
+        Column("next_attempt", DateTime, nullable=False, server_default=func.now()),
+        Column("last_error", Text),
+    )
+
+
+class Job_Result(Base):
+    """Finished jobs whose results are not in S3 yet, drained by the result pipeline (migration 5)"""
+    __table__ = Table(
+        JOB_RESULTS_TABLE_NAME,
+        Base.metadata,
+        Column("jobid", UUID(as_uuid=True), primary_key=True),
+        Column("created", DateTime, server_default=func.now()),
+        Column("attempts", Integer, nullable=False, server_default=text("0")),
+        Column("next_attempt", DateTime, nullable=False, server_default=func.now()),
+        Column("last_error", Text),
+    )
 
 
 class Structure(Base):
-    __table__ = Table(STRUCTURES_TABLE_NAME, Base.metadata, autoload_with=db_engine.engine)
+    __table__ = Table(
+        STRUCTURES_TABLE_NAME,
+        Base.metadata,
+        Column("id", UUID(as_uuid=True), primary_key=True),
+        Column("source", String),
+        Column("name", String),
+        Column("jobid", UUID(as_uuid=True)),
+        Column("created", DateTime, server_default=func.now()),
+        Column("userid", String),
+        # S3 key of the uploaded file, shared by the jobs of a batch (migration 6)
+        Column("file_key", String),
+    )
 
 
 class Structure_Property(Base):
     __table__ = Table(
-        STRUCTURE_PROPERTIES_TABLE_NAME, Base.metadata, autoload_with=db_engine.engine
+        STRUCTURE_PROPERTIES_TABLE_NAME,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("structureid", UUID(as_uuid=True)),
+        Column("name", String),
+        Column("value", String),
     )
 
 
 class Job_Tags(Base):
     __table__ = Table(
-        JOB_TAGS_TABLE_NAME, Base.metadata, autoload_with=db_engine.engine
+        JOB_TAGS_TABLE_NAME,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("jobid", UUID(as_uuid=True)),
+        Column("tag", String),
     )
 
 
 class Available_Calculations(Base):
     __table__ = Table(
-        AVAILABLE_CALCULATIONS, Base.metadata, autoload_with=db_engine.engine
+        AVAILABLE_CALCULATIONS,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String),
     )
 
 
 class Available_Basis_Sets(Base):
     __table__ = Table(
-        AVAILABLE_BASIS_SETS, Base.metadata, autoload_with=db_engine.engine
+        AVAILABLE_BASIS_SETS,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String),
     )
 
 
 class Available_Methods(Base):
-    __table__ = Table(AVAILABLE_METHODS, Base.metadata, autoload_with=db_engine.engine)
+    __table__ = Table(
+        AVAILABLE_METHODS,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String),
+    )
 
 class Available_Solvent_Effects(Base):
-    __table__ = Table(AVAILABLE_SOLVENT_EFFECTS, Base.metadata, autoload_with=db_engine.engine)
\ No newline at end of file
+    __table__ = Table(
+        AVAILABLE_SOLVENT_EFFECTS,
+        Base.metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String),
+    )
+
+
+def check_schema(engine: Engine = db_engine.engine) -> dict:
+    """Compares the declared tables with the tables in the database
+
+    Args:
+        engine (Engine): Engine of the database to compare with
+
+    Returns:
+        dict: For each table that differs, the declared columns "missing" from the
+            database, the database columns "undeclared" in the models, the "types"
+            and "nullable" settings of the columns in both that differ, each as
+            {"declared": ..., "database": ...}, and the "primary_key" columns if
+            they differ
+    """
+    inspector = inspect(engine)
+    dialect = engine.dialect
+    differences = {}
+    for table in Base.metadata.sorted_tables:
+        declared = {column.name: column for column in table.columns}
+        if inspector.has_table(table.name):
+            existing = {column["name"]: column for column in inspector.get_columns(table.name)}
+            primary_key = inspector.get_pk_constraint(table.name)["constrained_columns"]
+        else:
+            existing = {}
+            primary_key = []
+        types = {}
+        nullable = {}
+        for name in declared.keys() & existing.keys():
+            declared_type = declared[name].type.compile(dialect)
+            existing_type = existing[name]["type"].compile(dialect)
+            if declared_type != existing_type:
+                types[name] = {"declared": declared_type, "database": existing_type}
+            if declared[name].nullable != existing[name]["nullable"]:
+                nullable[name] = {
+                    "declared": declared[name].nullable,
+                    "database": existing[name]["nullable"],
+                }
+        declared_key = sorted(column.name for column in table.primary_key)
+        key = {}
+        if declared_key != sorted(primary_key):
+            key = {"declared": declared_key, "database": sorted(primary_key)}
+        if declared.keys() != existing.keys() or types or nullable or key:
+            differences[table.name] = {
+                "missing": sorted(declared.keys() - existing.keys()),
+                "undeclared": sorted(existing.keys() - declared.keys()),
+                "types": dict(sorted(types.items())),
+                "nullable": dict(sorted(nullable.items())),
+                "primary_key": key,
+            }
+    return differences
@@ -15,3 +15,6 @@ AVAILABLE_CALCULATIONS = "available_calculations"
 AVAILABLE_BASIS_SETS = "available_basis_sets"
 AVAILABLE_METHODS = "available_methods"
 AVAILABLE_SOLVENT_EFFECTS = 'available_solvent_effects'
+JOB_STATUS_COUNTS_TABLE_NAME = 'job_status_counts'
+JOB_OUTBOX_TABLE_NAME = 'job_outbox'
+JOB_RESULTS_TABLE_NAME = 'job_results'
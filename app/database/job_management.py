@@ -1,186 +1,804 @@
 from .db_engine import db_engine
+from ..metrics import DB_OPERATION_SECONDS, timed
 
-from .db_tables import Job, Structure
+from .db_tables import Job, Job_Outbox, Job_Result, Job_Status_Count, Structure
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import desc, func
-from typing import List, Union
+from sqlalchemy import (
+    BigInteger,
+    DateTime,
+    Float,
+    String,
+    Text,
+    and_,
+    bindparam,
+    cast,
+    column,
+    delete,
+    exists,
+    func,
+    insert,
+    literal_column,
+    or_,
+    select,
+    text,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import JSONB, UUID as PG_UUID, array, insert as pg_insert
+from sqlalchemy.engine import Row
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from ..models import JobModel, JobStatus, CreateJobDTO, UpdateJobDTO, StructureOrigin
-from fastapi import File, UploadFile
+from fastapi import UploadFile
 
-from ..util import upload_to_s3, item_to_dict
+from ..util import upload_to_s3, structure_file_key
 
 from uuid import UUID
+from datetime import datetime, timedelta
+import asyncio
+
+# Jobs that never finished sort last. The same expression is indexed by migration 2.
+NO_FINISHED_TIME = literal_column("'-infinity'")
+FINISHED_SORT_KEY = func.coalesce(Job.finished, NO_FINISHED_TIME)
+
+# parameters keys that can be large, such as the converted XYZ geometry. The job
+# listings leave them out unless they are asked for.
+HEAVY_PARAMETER_KEYS = ("job_structure",)
+
+
+# Statuses of the completed job listings for each filter, the count and the pages
+# use the same ones
+COMPLETED_STATUS_FILTERS = {
+    "All": (JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED),
+    "Completed": (JobStatus.COMPLETED,),
+    "Failed": (JobStatus.FAILED,),
+    "Cancelled": (JobStatus.CANCELLED,),
+}
+
+
+def _status_values(filter: str) -> List[JobStatus]:
+    try:
+        return list(COMPLETED_STATUS_FILTERS[filter])
+    except KeyError:
+        raise ValueError(
+            f"Unknown filter {filter}, expected one of {', '.join(COMPLETED_STATUS_FILTERS)}"
+        )
+
 
-def get_all_jobs() -> List[JobModel]:
-    """Gets all jobs
+def job_status_in(status_values: Iterable[JobStatus]):
+    """Filters jobs on some statuses, written into the SQL instead of bound
+
+    asyncpg runs the queries as prepared statements, and the generic plan that
+    PostgreSQL caches for them cannot use the partial indexes on
+    WHERE status IN (...) when the statuses are parameters.
+
+    Args:
+        status_values (Iterable[JobStatus]): Statuses to keep
 
     Returns:
-        List[JobModel]: Array of Jobs
+        Filter on Job.status
+    """
+    return Job.status.in_(
+        bindparam(
+            "status_values",
+            list(status_values),
+            expanding=True,
+            literal_execute=True,
+            unique=True,
+        )
+    )
+
+
+def job_columns(fields: Optional[Iterable[str]] = None) -> tuple:
+    """Builds the columns that the job listings select for some JobModel fields
+
+    The listings select plain rows, no ORM objects are built. parameters is selected
+    without the HEAVY_PARAMETER_KEYS, Postgres removes them from the JSON so they
+    are never sent to the API. A field such as "parameters.job_structure" keeps
+    that key (and selects parameters).
+
+    Args:
+        fields (Iterable[str], optional): JobModel field names, all fields if None
+
+    Returns:
+        tuple: Columns in the order of the JobModel fields
+
+    Raises:
+        ValueError: If a field is not a JobModel field
+    """
+    names = set(JobModel.model_fields if fields is None else fields)
+    kept_keys = {name.split(".", 1)[1] for name in names if name.startswith("parameters.")}
+    if kept_keys:
+        names = {name for name in names if not name.startswith("parameters.")} | {"parameters"}
+    unknown = names - set(JobModel.model_fields)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    columns = []
+    for name in JobModel.model_fields:
+        if name not in names:
+            continue
+        column = Job.__table__.c[name]
+        removed_keys = [key for key in HEAVY_PARAMETER_KEYS if key not in kept_keys]
+        if name == "parameters" and removed_keys:
+            column = column.op("-", return_type=JSONB)(array(removed_keys, type_=Text)).label(name)
+        columns.append(column)
+    return tuple(columns)
+
+
+def _job_status_count_query(email: str, status_values: List[JobStatus]):
+    # Reads the counters kept up to date by the jobs trigger instead of counting rows,
+    # sum() of a bigint is numeric so it is cast back to return an int
+    total = cast(func.coalesce(func.sum(Job_Status_Count.count), 0), BigInteger)
+    return select(total).filter(
+        Job_Status_Count.userid == email, Job_Status_Count.status.in_(status_values)
+    )
+
+
+@timed(DB_OPERATION_SECONDS)
+def reconcile_job_status_counts() -> int:
+    """Recomputes the job status counters from the jobs table and repairs any drift
+
+    Writes to jobs are blocked while the counts are recomputed, so no update is
+    lost in between.
+
+    Returns:
+        int: Number of counters that were repaired
     """
     with Session(db_engine.engine) as session:
-        jobs = session.query(Job).all()
+        session.execute(text("LOCK TABLE jobs IN SHARE MODE"))
+        repaired = session.execute(
+            text(
+                """
+                WITH actual AS (
+                    SELECT userid, status, count(*) AS count FROM jobs
+                    WHERE userid IS NOT NULL AND status IS NOT NULL
+                    GROUP BY userid, status
+                ), fixed AS (
+                    INSERT INTO job_status_counts (userid, status, count)
+                    SELECT userid, status, count FROM actual
+                    ON CONFLICT (userid, status) DO UPDATE SET count = EXCLUDED.count
+                    WHERE job_status_counts.count <> EXCLUDED.count
+                    RETURNING 1
+                ), cleared AS (
+                    UPDATE job_status_counts SET count = 0
+                    WHERE count <> 0 AND NOT EXISTS (
+                        SELECT 1 FROM actual
+                        WHERE actual.userid = job_status_counts.userid
+                        AND actual.status = job_status_counts.status
+                    )
+                    RETURNING 1
+                )
+                SELECT (SELECT count(*) FROM fixed) + (SELECT count(*) FROM cleared)
+                """
+            )
+        ).scalar()
+        session.commit()
+
+    if repaired:
+        print(f"Repaired {repaired} job status counters")
+    return repaired
+
+
+# Channel notified when jobs are added to job_outbox
+JOB_OUTBOX_CHANNEL = "job_outbox"
+
+# A job in one of these states has stopped for good
+TERMINAL_STATUSES = (JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+def _update_jobs_statements(updates: Dict[UUID, UpdateJobDTO], batch_size: int):
+    rows = [
+        (job_id, dto.status, dto.started, dto.finished, dto.error_message)
+        for job_id, dto in updates.items()
+    ]
+    for start in range(0, len(rows), batch_size):
+        changes = values(
+            column("id", PG_UUID(as_uuid=True)),
+            column("status", String),
+            column("started", DateTime),
+            column("finished", DateTime),
+            column("error_message", Text),
+            name="changes",
+        ).data(rows[start:start + batch_size])
+        # Casts type the columns of the VALUES list even when they only hold NULL
+        new_values = {
+            "status": func.coalesce(cast(changes.c.status, String), Job.status),
+            "started": func.coalesce(cast(changes.c.started, DateTime), Job.started),
+            "finished": func.coalesce(cast(changes.c.finished, DateTime), Job.finished),
+            "error_message": func.coalesce(cast(changes.c.error_message, Text), Job.error_message),
+        }
+        new_status = cast(changes.c.status, String)
+        yield (
+            update(Job)
+            .where(
+                Job.id == cast(changes.c.id, PG_UUID(as_uuid=True)),
+                # Status only moves forward: a finished job stays finished and a
+                # running job is not sent back to SUBMITTED by a late update
+                or_(
+                    new_status.is_(None),
+                    and_(
+                        Job.status.not_in(TERMINAL_STATUSES),
+                        or_(new_status != JobStatus.SUBMITTED, Job.status == JobStatus.SUBMITTED),
+                    ),
+                ),
+                # A repeated update matches no row
+                or_(
+                    *(
+                        value.is_distinct_from(getattr(Job, name))
+                        for name, value in new_values.items()
+                    )
+                ),
+            )
+            .values(**new_values)
+            .returning(Job.id)
+            .execution_options(synchronize_session=False)
+        )
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_jobs_async(fields: Optional[Iterable[str]] = None) -> Sequence[Row]:
+    """Gets all jobs without blocking the event loop
+
+    Args:
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns
+
+    Returns:
+        Sequence[Row]: Rows with the JobModel columns
+    """
+    async with db_engine.async_session() as session:
+        jobs = (await session.execute(select(*job_columns(fields)))).all()
 
     return jobs
 
 
-def get_all_running_jobs(email: str) -> List[JobModel]:
-    """Gets all jobs that are running or submitted
+@timed(DB_OPERATION_SECONDS)
+async def get_all_running_jobs_async(
+    email: str, fields: Optional[Iterable[str]] = None
+) -> Sequence[Row]:
+    """Gets all jobs that are running or submitted without blocking the event loop
 
     Args:
         email (str): email
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns
 
     Returns:
-        List[JobModel]: Array of Jobs
+        Sequence[Row]: Rows with the JobModel columns
     """
     status_values = [JobStatus.RUNNING, JobStatus.SUBMITTED]
 
-    with Session(db_engine.engine) as session:
-        jobs = session.query(Job).filter(
-            Job.userid == email, Job.status.in_(status_values)
-        )
+    async with db_engine.async_session() as session:
+        jobs = (
+            await session.execute(
+                select(*job_columns(fields)).filter(
+                    Job.userid == email, job_status_in(status_values)
+                )
+            )
+        ).all()
 
     return jobs
 
-def get_all_completed_jobs(email: str) -> List[JobModel]:
-    """Gets all the jobs that are not running or submitted
+
+@timed(DB_OPERATION_SECONDS)
+async def get_all_completed_jobs_async(
+    email: str, fields: Optional[Iterable[str]] = None
+) -> Sequence[Row]:
+    """Gets all the jobs that are not running or submitted without blocking the event loop
 
     Args:
         email (str): email
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns
 
     Returns:
-        List[JobModel]: Array of Jobs
+        Sequence[Row]: Rows with the JobModel columns
     """
+    async with db_engine.async_session() as session:
+        jobs = (await session.execute(_all_completed_jobs_query(email, fields))).all()
+
+    return jobs
+
+
+def _all_completed_jobs_query(email: str, fields: Optional[Iterable[str]] = None):
     status_values = [JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED]
+    return select(*job_columns(fields)).filter(
+        Job.userid == email, job_status_in(status_values)
+    )
 
-    with Session(db_engine.engine) as session:
+
+def stream_all_jobs_async(fields: Optional[Iterable[str]] = None) -> AsyncIterator[Row]:
+    """Streams all jobs from a server-side cursor, see DB_Engine.stream
+
+    Args:
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns
+
+    Returns:
+        AsyncIterator[Row]: Rows with the JobModel columns
+    """
+    return db_engine.stream(select(*job_columns(fields)))
+
+
+def stream_all_completed_jobs_async(
+    email: str, fields: Optional[Iterable[str]] = None
+) -> AsyncIterator[Row]:
+    """Streams all the jobs that are not running or submitted from a server-side cursor
+
+    Args:
+        email (str): email
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns
+
+    Returns:
+        AsyncIterator[Row]: Rows with the JobModel columns
+    """
+    return db_engine.stream(_all_completed_jobs_query(email, fields))
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_active_jobs_async() -> Sequence[Row]:
+    """Gets the id, status and age of every running or submitted job on the cluster
+
+    The age is the number of seconds since the job started, or since it was
+    submitted if it has not started yet, measured by the database clock like the
+    timestamps themselves.
+
+    Returns:
+        Sequence[Row]: Rows with id, status and age
+    """
+    status_values = [JobStatus.RUNNING, JobStatus.SUBMITTED]
+    age = func.extract(
+        "epoch", func.localtimestamp() - func.coalesce(Job.started, Job.submitted)
+    )
+
+    async with db_engine.async_session() as session:
         jobs = (
-            session.query(Job)
-            .filter(Job.userid == email, Job.status.in_(status_values))
-            .all()
-        )
+            await session.execute(
+                select(Job.id, Job.status, cast(age, Float).label("age")).filter(
+                    job_status_in(status_values),
+                    # Jobs still in the outbox are not on the cluster yet
+                    ~exists().where(Job_Outbox.jobid == Job.id),
+                )
+            )
+        ).all()
 
     return jobs
 
 
-def get_completed_jobs_count(email: str, filter: str) -> int:
-    """Gets the count of jobs for a specific status
+@timed(DB_OPERATION_SECONDS)
+async def get_typical_job_duration_async(sample_size: int = 100) -> Optional[float]:
+    """Gets the median run time of the most recently completed jobs
+
+    Args:
+        sample_size (int): Number of recent jobs to take the median of
+
+    Returns:
+        Optional[float]: Median run time in seconds, None if no job has completed yet
+    """
+    recent = (
+        select((func.extract("epoch", Job.finished - Job.started)).label("duration"))
+        .filter(
+            Job.status == JobStatus.COMPLETED,
+            Job.started.is_not(None),
+            Job.finished.is_not(None),
+        )
+        .order_by(Job.finished.desc())
+        .limit(sample_size)
+        .subquery()
+    )
+    async with db_engine.async_session() as session:
+        duration = await session.scalar(
+            select(func.percentile_cont(0.5).within_group(recent.c.duration))
+        )
+
+    return float(duration) if duration is not None else None
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_completed_jobs_count_async(email: str, filter: str) -> int:
+    """Gets the count of jobs for a specific status without blocking the event loop
 
     Args:
         email (str): email
-        filter (str): Status of jobs to get count for
+        filter (str): All, Completed, Failed or Cancelled
 
     Returns:
         int: Number of jobs
+
+    Raises:
+        ValueError: If the filter is unknown
     """
-    if filter == "All":
-        status_values = [JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED]
-    elif filter == "Completed":
-        status_values = [JobStatus.COMPLETED]
-    elif filter == "Failed":
-        status_values = [JobStatus.FAILED, JobStatus.CANCELLED]
-    elif filter == "Cancelled":
-        status_values = [JobStatus.CANCELLED]
+    status_values = _status_values(filter)
 
-    with Session(db_engine.engine) as session:
-        total_count = (
-            session.query(Job)
-            .filter(Job.userid == email, Job.status.in_(status_values))
-            .count()
-        )
+    async with db_engine.async_session() as session:
+        total_count = await session.scalar(_job_status_count_query(email, status_values))
 
     return total_count
 
 
-def get_paginated_completed_jobs(
-    email: str, limit: int, offset: int, filter: str
-) -> List[Job]:
-    """Gets the paginated data for completed jobs
+@timed(DB_OPERATION_SECONDS)
+async def get_paginated_completed_jobs_async(
+    email: str,
+    limit: int,
+    offset: int,
+    filter: str,
+    after: Optional[Tuple[Optional[datetime], UUID]] = None,
+    fields: Optional[Iterable[str]] = None,
+) -> Sequence[Row]:
+    """Gets the paginated data for completed jobs without blocking the event loop
+
+    Jobs are ordered by finished time then id, newest first. With ``after`` the page
+    starts right after that (finished, id) key, which is an index range scan that
+    costs the same for every page. The offset is only applied without ``after``.
 
     Args:
         email (str): email
-        limit (int): How many entries to fetch 
+        limit (int): How many entries to fetch
         offset (int): Starting at which index
-        filter (str): Job status
+        filter (str): All, Completed, Failed or Cancelled
+        after (Tuple[Optional[datetime], UUID], optional): Key of the last job of the previous page
+        fields (Iterable[str], optional): JobModel fields to select, see job_columns.
+            finished and id are always selected, they make up the page key
 
     Returns:
-        List[Job]: Array of Jobs
-    """
-    if filter == "All":
-        status_values = [JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED]
-    elif filter == "Completed":
-        status_values = [JobStatus.COMPLETED]
-    elif filter == "Failed":
-        status_values = [JobStatus.FAILED]
-    elif filter == "Cancelled":
-        status_values = [JobStatus.CANCELLED]
+        Sequence[Row]: Rows with the JobModel columns
 
-    with Session(db_engine.engine) as session:
-        jobs = (
-            session.query(Job)
-            .filter(Job.userid == email, Job.status.in_(status_values))
-            .order_by(desc(Job.finished))
-            .offset(offset)
-            .limit(limit)
-            .all()
+    Raises:
+        ValueError: If the filter is unknown
+    """
+    status_values = _status_values(filter)
+
+    if fields is not None:
+        fields = {*fields, "finished", "id"}
+    query = (
+        select(*job_columns(fields))
+        .filter(Job.userid == email, job_status_in(status_values))
+        .order_by(FINISHED_SORT_KEY.desc(), Job.id.desc())
+        .limit(limit)
+    )
+    if after is not None:
+        finished, job_id = after
+        query = query.filter(
+            tuple_(FINISHED_SORT_KEY, Job.id)
+            < tuple_(finished if finished is not None else NO_FINISHED_TIME, job_id)
         )
+    else:
+        query = query.offset(offset)
+
+    async with db_engine.async_session() as session:
+        jobs = (await session.execute(query)).all()
 
     return jobs
 
-#TODO: Log errors to an error file
-def post_new_job(
-    email: str, job: CreateJobDTO, db_job_id: UUID,file: UploadFile = File(None)
-) -> Union[JobModel, bool]:
-    """Create new job entry
+
+@timed(DB_OPERATION_SECONDS)
+async def post_new_jobs_async(
+    email: str, jobs: List[Tuple[UUID, CreateJobDTO, Optional[UploadFile]]]
+) -> bool:
+    """Creates many job entries in one transaction without blocking the event loop
+
+    Uploaded structures get a structures row and their file is stored in S3. The
+    uploads run in parallel before the transaction, so no connection is held while
+    they run, and no job is created if one of them fails. Jobs given the same
+    UploadFile share one upload, under the ID of the first of them. Every job also
+    gets a job_outbox entry in the same transaction, the dispatcher then sends it
+    to the cluster.
 
     Args:
         email (str): email
-        job (CreateJobDTO): DTO of job
-        file (UploadFile, optional): File of chemical structure. NOTE file might be required
+        jobs (List[Tuple[UUID, CreateJobDTO, Optional[UploadFile]]]): ID, DTO and
+            structure file of each job
 
     Returns:
-        Union[JobModel, bool]: Returns a Job or false if fails
+        bool: Returns True if all jobs were created or False if none were
     """
-    with Session(db_engine.engine) as session:
+    job_rows = []
+    structure_rows = []
+    uploads = {}
+    for db_job_id, job, file in jobs:
+        job_rows.append(
+            {
+                "id": db_job_id,
+                "userid": email,
+                "job_name": job.job_name,
+                "submitted": func.now(),
+                "parameters": job.parameters,
+            }
+        )
+        if job.parameters["source"] == StructureOrigin.UPLOADED:
+            _, structure_id = uploads.setdefault(id(file), (file, db_job_id))
+            structure_rows.append(
+                {
+                    "id": db_job_id,
+                    "jobid": db_job_id,
+                    "userid": email,
+                    "name": job.job_name,
+                    "source": job.parameters["source"],
+                    "file_key": structure_file_key(structure_id, file.filename),
+                }
+            )
+
+    # boto3 is blocking, so the uploads run in worker threads
+    uploaded = await asyncio.gather(
+        *(
+            asyncio.to_thread(upload_to_s3, file, structure_id)
+            for file, structure_id in uploads.values()
+        )
+    )
+    if not all(uploaded):
+        print(f"Error: {uploaded.count(False)} of {len(uploaded)} structure uploads failed")
+        return False
+
+    async with db_engine.async_session() as session:
         try:
-            # create new row in job table
-            # TODO: ensure auth0 makes the email accessible.
-            job = Job(
-                id=db_job_id,
-                userid=email,
-                job_name=job.job_name,
-                submitted= func.now(),
-                parameters=job.parameters,
+            # One multi-row INSERT per table
+            await session.execute(insert(Job).values(job_rows))
+            if structure_rows:
+                await session.execute(insert(Structure).values(structure_rows))
+            await session.execute(
+                insert(Job_Outbox).values([{"jobid": row["id"]} for row in job_rows])
             )
-            session.add(job)
-            session.commit()
-            # if source is upload, create new row in structure table
-            if job.parameters["source"] == StructureOrigin.UPLOADED:
-                structure = Structure(
-                    id=db_job_id,
-                    jobid=job.id,
-                    userid=email,
-                    name=job.job_name,
-                    source=job.parameters["source"],
-                )
-                
-                 # upload structure file to s3
-                # s3 structure 
-                upload_to_s3(file, structure.id)
-            
-                session.add(structure)
-                session.commit()
-
-            session.refresh(job)
-            return item_to_dict(job)
+            # Delivered on commit, wakes the dispatcher in whichever process runs it
+            await session.execute(select(func.pg_notify(JOB_OUTBOX_CHANNEL, "")))
+            await session.commit()
+            return True
         except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             print(f"Error: {str(e)}")
             return False
 
-def update_job(job_id: UUID, update_job_dto: UpdateJobDTO) -> bool:
-    """Updates a job
+
+@timed(DB_OPERATION_SECONDS)
+async def claim_outbox_jobs_async(limit: int, lease: float) -> Sequence[Row]:
+    """Takes the job_outbox entries that are due, for one dispatcher worker
+
+    The entries are locked with SKIP LOCKED, so workers in any process claim
+    different jobs, and their next attempt is moved lease seconds ahead. An entry
+    whose worker stops before recording the outcome is claimed again after that.
+
+    Args:
+        limit (int): Most entries to claim
+        lease (float): Seconds the entries belong to the caller
+
+    Returns:
+        Sequence[Row]: Rows with the jobid, attempts so far, including this one,
+            and parameters of the job
+    """
+    # Materialised so the locking SELECT runs once, a subquery can be run again
+    # for every row and then claims more than limit entries
+    due = (
+        select(Job_Outbox.jobid)
+        .where(Job_Outbox.next_attempt <= func.localtimestamp())
+        .order_by(Job_Outbox.next_attempt)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .cte("due")
+        .prefix_with("MATERIALIZED")
+    )
+    claimed = (
+        update(Job_Outbox)
+        .where(Job_Outbox.jobid == due.c.jobid)
+        .values(
+            attempts=Job_Outbox.attempts + 1,
+            next_attempt=func.localtimestamp() + timedelta(seconds=lease),
+        )
+        .returning(Job_Outbox.jobid, Job_Outbox.attempts)
+        .cte("claimed")
+    )
+    async with db_engine.async_session() as session:
+        jobs = (
+            await session.execute(
+                select(claimed.c.jobid, claimed.c.attempts, Job.parameters).join(
+                    Job, Job.id == claimed.c.jobid
+                )
+            )
+        ).all()
+        await session.commit()
+
+    return jobs
+
+
+@timed(DB_OPERATION_SECONDS)
+async def finish_outbox_jobs_async(results: Dict[UUID, Optional[str]]) -> None:
+    """Removes job_outbox entries the cluster has answered for
+
+    Args:
+        results (Dict[UUID, Optional[str]]): None for each job the cluster accepted,
+            or why it failed. Failed jobs are marked FAILED with the reason.
+    """
+    failed = {
+        job_id: UpdateJobDTO(
+            status=JobStatus.FAILED, finished=datetime.now(), error_message=error
+        )
+        for job_id, error in results.items()
+        if error is not None
+    }
+    async with db_engine.async_session() as session:
+        await session.execute(delete(Job_Outbox).where(Job_Outbox.jobid.in_(list(results))))
+        for statement in _update_jobs_statements(failed, 500):
+            await session.execute(statement)
+        await session.commit()
+
+
+@timed(DB_OPERATION_SECONDS)
+async def retry_outbox_jobs_async(
+    job_ids: List[UUID], error: str, delay: float, max_delay: float
+) -> None:
+    """Schedules another attempt for job_outbox entries whose submission failed
+
+    The wait doubles with every attempt, from delay up to max_delay seconds, and is
+    shortened by up to half at random so retries of many jobs spread out.
+
+    Args:
+        job_ids (List[UUID]): Job IDs
+        error (str): Why the attempt failed
+        delay (float): Seconds to wait after the first attempt
+        max_delay (float): Longest wait in seconds
+    """
+    async with db_engine.async_session() as session:
+        await session.execute(
+            update(Job_Outbox)
+            .where(Job_Outbox.jobid.in_(job_ids))
+            .values(
+                next_attempt=_next_retry(Job_Outbox.attempts, delay, max_delay),
+                last_error=error,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+@timed(DB_OPERATION_SECONDS)
+async def release_outbox_jobs_async(job_ids: List[UUID], error: str, delay: float) -> None:
+    """Puts claimed job_outbox entries back without using up an attempt
+
+    For submissions the cluster refused before trying them, such as while its
+    circuit breaker is open.
+
+    Args:
+        job_ids (List[UUID]): Job IDs
+        error (str): Why the entries were not sent
+        delay (float): Seconds before the entries are due again
+    """
+    async with db_engine.async_session() as session:
+        await session.execute(
+            update(Job_Outbox)
+            .where(Job_Outbox.jobid.in_(job_ids))
+            .values(
+                attempts=Job_Outbox.attempts - 1,
+                next_attempt=func.localtimestamp() + timedelta(seconds=delay),
+                last_error=error,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+def _next_retry(attempts, delay: float, max_delay: float):
+    wait = func.least(delay * func.power(2, attempts - 1), max_delay) * (
+        0.5 + func.random() * 0.5
+    )
+    return func.localtimestamp() + func.make_interval(0, 0, 0, 0, 0, 0, wait)
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_outbox_size_async() -> int:
+    """Gets the number of jobs waiting to be sent to the cluster
+
+    Returns:
+        int: Number of job_outbox entries
+    """
+    async with db_engine.async_session() as session:
+        return await session.scalar(select(func.count()).select_from(Job_Outbox))
+
+
+@timed(DB_OPERATION_SECONDS)
+async def claim_result_jobs_async(limit: int, lease: float) -> Sequence[Row]:
+    """Takes the job_results entries that are due, for the result pipeline
+
+    Like claim_outbox_jobs_async, the entries are locked with SKIP LOCKED and their
+    next attempt is moved lease seconds ahead, so an entry whose collection never
+    records an outcome is taken again after that.
+
+    Args:
+        limit (int): Most entries to claim
+        lease (float): Seconds the entries belong to the caller
+
+    Returns:
+        Sequence[Row]: Rows with the jobid and attempts so far, including this one
+    """
+    due = (
+        select(Job_Result.jobid)
+        .where(Job_Result.next_attempt <= func.localtimestamp())
+        .order_by(Job_Result.next_attempt)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .cte("due")
+        .prefix_with("MATERIALIZED")
+    )
+    async with db_engine.async_session() as session:
+        jobs = (
+            await session.execute(
+                update(Job_Result)
+                .where(Job_Result.jobid == due.c.jobid)
+                .values(
+                    attempts=Job_Result.attempts + 1,
+                    next_attempt=func.localtimestamp() + timedelta(seconds=lease),
+                )
+                .returning(Job_Result.jobid, Job_Result.attempts)
+            )
+        ).all()
+        await session.commit()
+
+    return jobs
+
+
+@timed(DB_OPERATION_SECONDS)
+async def finish_result_job_async(job_id: UUID) -> None:
+    """Removes the job_results entry of a job whose results are in S3 and cleaned up
+
+    Args:
+        job_id (uuid.UUID): Job ID
+    """
+    async with db_engine.async_session() as session:
+        await session.execute(delete(Job_Result).where(Job_Result.jobid == job_id))
+        await session.commit()
+
+
+@timed(DB_OPERATION_SECONDS)
+async def retry_result_job_async(
+    job_id: UUID, error: str, delay: float, max_delay: float
+) -> None:
+    """Schedules another collection of a job's results, backing off like retry_outbox_jobs_async
+
+    Args:
+        job_id (uuid.UUID): Job ID
+        error (str): Why the collection failed
+        delay (float): Seconds to wait after the first attempt
+        max_delay (float): Longest wait in seconds
+    """
+    async with db_engine.async_session() as session:
+        await session.execute(
+            update(Job_Result)
+            .where(Job_Result.jobid == job_id)
+            .values(
+                next_attempt=_next_retry(Job_Result.attempts, delay, max_delay),
+                last_error=error,
+            )
+        )
+        await session.commit()
+
+
+@timed(DB_OPERATION_SECONDS)
+async def release_result_jobs_async(job_ids: List[UUID]) -> None:
+    """Makes claimed job_results entries due again, for a pipeline that stops before collecting them
+
+    Args:
+        job_ids (List[UUID]): Job IDs
+    """
+    async with db_engine.async_session() as session:
+        await session.execute(
+            update(Job_Result)
+            .where(Job_Result.jobid.in_(job_ids))
+            .values(attempts=Job_Result.attempts - 1, next_attempt=func.localtimestamp())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_pending_results_count_async() -> int:
+    """Gets the number of finished jobs whose results are still on the cluster
+
+    Returns:
+        int: Number of job_results entries
+    """
+    async with db_engine.async_session() as session:
+        return await session.scalar(select(func.count()).select_from(Job_Result))
+
+
+@timed(DB_OPERATION_SECONDS)
+async def update_job_async(job_id: UUID, update_job_dto: UpdateJobDTO) -> bool:
+    """Updates a job without blocking the event loop
 
     Args:
         job_id (uuid.UUID): Job ID
@@ -189,9 +807,9 @@ def update_job(job_id: UUID, update_job_dto: UpdateJobDTO) -> bool:
     Returns:
         bool: Returns True if successful update or False on fail
     """
-    with Session(db_engine.engine) as session:
+    async with db_engine.async_session() as session:
         try:
-            job = session.query(Job).filter_by(id=job_id).first()
+            job = await session.get(Job, job_id)
 
             if not job:
                 return False
@@ -200,17 +818,62 @@ def update_job(job_id: UUID, update_job_dto: UpdateJobDTO) -> bool:
             job.finished = update_job_dto.finished
             job.status = update_job_dto.status
 
-            session.commit()
+            await session.commit()
 
             return True
         except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             print(f"Error: {str(e)}")
             return False
 
 
-def remove_job(job_id: UUID) -> bool:
-    """Removes a Job from the Job Table
+@timed(DB_OPERATION_SECONDS)
+async def update_jobs_async(
+    updates: Dict[UUID, UpdateJobDTO], batch_size: int = 500, collect_results: bool = False
+) -> List[UUID]:
+    """Updates the status, start, finish and error message of many jobs
+
+    Each batch is applied with a single UPDATE joined to a VALUES list, in one
+    transaction, instead of a SELECT and an UPDATE per job, without blocking the
+    event loop. Fields that are None keep their current value. Updates that change
+    nothing, or that would move a job back to an earlier status, are skipped, so
+    applying the same updates twice is harmless.
+
+    Args:
+        updates (Dict[UUID, UpdateJobDTO]): DTO to apply, keyed by Job ID
+        batch_size (int): Number of jobs per statement
+        collect_results (bool): Adds a job_results entry, in the same transaction,
+            for every job that this update finishes
+
+    Returns:
+        List[UUID]: IDs of the jobs that changed
+    """
+    updated = []
+    async with db_engine.async_session() as session:
+        try:
+            for statement in _update_jobs_statements(updates, batch_size):
+                updated += (await session.execute(statement)).scalars().all()
+            finished = [
+                job_id for job_id in updated if updates[job_id].status in TERMINAL_STATUSES
+            ]
+            if collect_results and finished:
+                await session.execute(
+                    pg_insert(Job_Result)
+                    .values([{"jobid": job_id} for job_id in finished])
+                    .on_conflict_do_nothing()
+                )
+            await session.commit()
+        except SQLAlchemyError as e:
+            await session.rollback()
+            print(f"Error: {str(e)}")
+            return []
+
+    return updated
+
+
+@timed(DB_OPERATION_SECONDS)
+async def remove_job_async(job_id: UUID) -> bool:
+    """Removes a Job from the Job Table without blocking the event loop
 
     Args:
         job_id (uuid.UUID): Job ID
@@ -218,21 +881,22 @@ def remove_job(job_id: UUID) -> bool:
     Returns:
         bool: Returns True if successful delete or False on fail
     """
-    with Session(db_engine.engine) as session:
+    async with db_engine.async_session() as session:
         try:
-            job_record = session.get(Job, job_id)
-            session.delete(job_record)
-            session.flush()
-            session.commit()
+            job_record = await session.get(Job, job_id)
+            await session.delete(job_record)
+            await session.commit()
 
             return True
         except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             print(f"Error: {str(e)}")
             return False
 
-def get_job_by_id(job_id: UUID) -> JobModel:
-    """Gets the job by job id
+
+@timed(DB_OPERATION_SECONDS)
+async def get_job_by_id_async(job_id: UUID) -> JobModel:
+    """Gets the job by job id without blocking the event loop
 
     Args:
         id (str): job id
@@ -240,9 +904,6 @@ def get_job_by_id(job_id: UUID) -> JobModel:
     Returns:
         JobModel: Job
     """
-
-    with Session(db_engine.engine) as session:
-        job = session.query(Job).filter(
-            Job.id == job_id
-        ).first()
+    async with db_engine.async_session() as session:
+        job = await session.get(Job, job_id)
     return job
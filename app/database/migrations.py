@@ -0,0 +1,307 @@
+"""Versioned schema migrations
+
+Each migration has a version, a description and the SQL statements to run. The
+versions already applied are recorded in the schema_migrations table, so running
+the migrations again only applies the new ones. Run with:
+
+    python -m app.database.migrations [--check]
+"""
+import sys
+from typing import Dict, List, NamedTuple, Optional
+
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import Engine, select, text, tuple_
+from sqlalchemy.dialects.postgresql.asyncpg import dialect as asyncpg_dialect
+
+from .db_engine import db_engine
+from .db_tables import Job, Structure
+from .job_management import FINISHED_SORT_KEY, job_status_in
+from ..models import JobStatus
+
+MIGRATIONS_TABLE_NAME = "schema_migrations"
+
+# Serialises migration runs started at the same time by several workers
+MIGRATIONS_LOCK_ID = 735201
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: List[str]
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "Index the job listing and poller queries",
+        [
+            # get_paginated_completed_jobs_async, get_completed_jobs_count_async,
+            # get_all_running_jobs_async
+            "CREATE INDEX IF NOT EXISTS ix_jobs_userid_status_finished "
+            "ON jobs (userid, status, finished DESC)",
+            # process_running_jobs only looks at the few jobs that are still active
+            "CREATE INDEX IF NOT EXISTS ix_jobs_active_status "
+            "ON jobs (status) WHERE status IN ('SUBMITTED', 'RUNNING')",
+        ],
+    ),
+    Migration(
+        2,
+        "Index the keyset pagination of completed jobs and structures",
+        [
+            # get_paginated_completed_jobs_async, sorts on job_management.FINISHED_SORT_KEY
+            "CREATE INDEX IF NOT EXISTS ix_jobs_userid_finished_id "
+            "ON jobs (userid, (coalesce(finished, '-infinity')) DESC, id DESC) "
+            "WHERE status IN ('FAILED', 'CANCELLED', 'COMPLETED')",
+            # get_paginated_structures_async, with and without a user
+            "CREATE INDEX IF NOT EXISTS ix_structures_userid_created_id "
+            "ON structures (userid, created DESC, id DESC)",
+            "CREATE INDEX IF NOT EXISTS ix_structures_created_id "
+            "ON structures (created DESC, id DESC)",
+        ],
+    ),
+    Migration(
+        3,
+        "Maintain per-user job status counters",
+        [
+            "CREATE TABLE IF NOT EXISTS job_status_counts ("
+            "userid varchar NOT NULL, "
+            "status varchar NOT NULL, "
+            "count bigint NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (userid, status))",
+            # The counters change in the same transaction as the job rows
+            """
+            CREATE OR REPLACE FUNCTION count_job_status() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.userid IS NOT NULL AND OLD.status IS NOT NULL THEN
+                    UPDATE job_status_counts SET count = count - 1
+                    WHERE userid = OLD.userid AND status = OLD.status;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.userid IS NOT NULL AND NEW.status IS NOT NULL THEN
+                    INSERT INTO job_status_counts (userid, status, count)
+                    VALUES (NEW.userid, NEW.status, 1)
+                    ON CONFLICT (userid, status) DO UPDATE SET count = job_status_counts.count + 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE TRIGGER jobs_count_status_insert_delete "
+            "AFTER INSERT OR DELETE ON jobs "
+            "FOR EACH ROW EXECUTE FUNCTION count_job_status()",
+            "CREATE TRIGGER jobs_count_status_update "
+            "AFTER UPDATE OF userid, status ON jobs FOR EACH ROW "
+            "WHEN (OLD.userid IS DISTINCT FROM NEW.userid OR OLD.status IS DISTINCT FROM NEW.status) "
+            "EXECUTE FUNCTION count_job_status()",
+            "INSERT INTO job_status_counts (userid, status, count) "
+            "SELECT userid, status, count(*) FROM jobs "
+            "WHERE userid IS NOT NULL AND status IS NOT NULL GROUP BY userid, status "
+            "ON CONFLICT (userid, status) DO UPDATE SET count = EXCLUDED.count",
+        ],
+    ),
+    Migration(
+        4,
+        "Queue job submissions in an outbox",
+        [
+            "CREATE TABLE IF NOT EXISTS job_outbox ("
+            "jobid uuid PRIMARY KEY REFERENCES jobs (id) ON DELETE CASCADE, "
+            "created timestamp DEFAULT now(), "
+            "attempts integer NOT NULL DEFAULT 0, "
+            "next_attempt timestamp NOT NULL DEFAULT now(), "
+            "last_error text)",
+            # claim_outbox_jobs_async takes the entries that are due first
+            "CREATE INDEX IF NOT EXISTS ix_job_outbox_next_attempt "
+            "ON job_outbox (next_attempt)",
+        ],
+    ),
+    Migration(
+        5,
+        "Record the finished jobs whose results are still on the cluster",
+        [
+            "CREATE TABLE IF NOT EXISTS job_results ("
+            "jobid uuid PRIMARY KEY REFERENCES jobs (id) ON DELETE CASCADE, "
+            "created timestamp DEFAULT now(), "
+            "attempts integer NOT NULL DEFAULT 0, "
+            "next_attempt timestamp NOT NULL DEFAULT now(), "
+            "last_error text)",
+            # claim_result_jobs_async takes the entries that are due first
+            "CREATE INDEX IF NOT EXISTS ix_job_results_next_attempt "
+            "ON job_results (next_attempt)",
+        ],
+    ),
+    Migration(
+        6,
+        "Record the S3 key of uploaded structure files",
+        [
+            # The jobs of a batch made from one file share its upload
+            "ALTER TABLE structures ADD COLUMN IF NOT EXISTS file_key varchar",
+        ],
+    ),
+]
+
+
+def current_version(engine: Engine = db_engine.engine) -> int:
+    """Gets the latest migration applied to the database
+
+    Args:
+        engine (Engine): Engine of the database
+
+    Returns:
+        int: Version of the latest migration, 0 if none were applied
+    """
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, MIGRATIONS_TABLE_NAME):
+            return 0
+        version = conn.execute(
+            text(f"SELECT max(version) FROM {MIGRATIONS_TABLE_NAME}")
+        ).scalar()
+    return version or 0
+
+
+def apply_migrations(engine: Engine = db_engine.engine) -> List[int]:
+    """Applies the migrations that are not in the database yet
+
+    Every migration runs in its own transaction together with its record in the
+    schema_migrations table.
+
+    Args:
+        engine (Engine): Engine of the database
+
+    Returns:
+        List[int]: Versions of the migrations that were applied
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE_NAME} ("
+                "version integer PRIMARY KEY, "
+                "description text NOT NULL, "
+                "applied timestamp NOT NULL DEFAULT now())"
+            )
+        )
+
+    applied = []
+    for migration in MIGRATIONS:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+            already_applied = conn.execute(
+                text(f"SELECT 1 FROM {MIGRATIONS_TABLE_NAME} WHERE version = :version"),
+                {"version": migration.version},
+            ).first()
+            if already_applied:
+                continue
+            for statement in migration.statements:
+                conn.execute(text(statement))
+            conn.execute(
+                text(
+                    f"INSERT INTO {MIGRATIONS_TABLE_NAME} (version, description) "
+                    "VALUES (:version, :description)"
+                ),
+                {"version": migration.version, "description": migration.description},
+            )
+        applied.append(migration.version)
+    return applied
+
+
+def hot_queries(email: str = "user@example.com") -> Dict[str, object]:
+    """Builds the queries that run most often, as issued by the *_management modules and the poller
+
+    get_completed_jobs_count_async is not included, it reads job_status_counts by
+    primary key.
+
+    Args:
+        email (str): email to filter on
+
+    Returns:
+        Dict[str, object]: Statement for each query, keyed by the function that issues it
+    """
+    completed = [JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED]
+    active = [JobStatus.RUNNING, JobStatus.SUBMITTED]
+    after = (datetime(2024, 1, 1), UUID(int=0))
+    return {
+        "get_paginated_completed_jobs_async": select(Job)
+        .filter(
+            Job.userid == email,
+            job_status_in(completed),
+            tuple_(FINISHED_SORT_KEY, Job.id) < tuple_(*after),
+        )
+        .order_by(FINISHED_SORT_KEY.desc(), Job.id.desc())
+        .limit(5),
+        "get_all_running_jobs_async": select(Job).filter(
+            Job.userid == email, job_status_in(active)
+        ),
+        "process_running_jobs": select(Job).filter(job_status_in(active)),
+        "get_paginated_structures_async": select(Structure)
+        .filter(tuple_(Structure.created, Structure.id) < tuple_(*after))
+        .order_by(Structure.created.desc(), Structure.id.desc())
+        .limit(50),
+    }
+
+
+def explain_hot_queries(engine: Engine = db_engine.engine) -> Dict[str, Optional[str]]:
+    """Runs EXPLAIN on the generic plan of every hot query to find the index it scans
+
+    The queries run through asyncpg as prepared statements, whose plan PostgreSQL
+    may cache without looking at the parameters. So each query is compiled like
+    asyncpg would, prepared with its $n parameters and explained with
+    plan_cache_mode = force_generic_plan. Sequential scans are disabled for the
+    EXPLAIN, so a small table still shows whether the planner can use an index at all.
+
+    Args:
+        engine (Engine): Engine of the database
+
+    Returns:
+        Dict[str, Optional[str]]: Name of the migration index scanned by each query,
+            None if the query does not use one
+    """
+    indexes = {}
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        conn.execute(text("SET LOCAL plan_cache_mode = force_generic_plan"))
+        for name, statement in hot_queries().items():
+            compiled = statement.compile(
+                dialect=asyncpg_dialect(), compile_kwargs={"render_postcompile": True}
+            )
+            parameters = tuple(
+                _sql_value(compiled.params[key]) for key in compiled.positiontup
+            )
+            conn.exec_driver_sql(f"PREPARE hot_query AS {compiled}")
+            execute = "EXECUTE hot_query"
+            if parameters:
+                execute += f"({', '.join(['%s'] * len(parameters))})"
+            plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {execute}", parameters).scalar()
+            conn.exec_driver_sql("DEALLOCATE hot_query")
+            indexes[name] = _scanned_index(plan[0]["Plan"])
+        transaction.rollback()
+    return indexes
+
+
+def _sql_value(value):
+    # Parameters of EXECUTE are passed as text literals and typed by the PREPARE
+    if isinstance(value, JobStatus):
+        return value.value
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def _scanned_index(plan: dict) -> Optional[str]:
+    if plan.get("Index Name", "").startswith("ix_"):
+        return plan["Index Name"]
+    for child in plan.get("Plans", []):
+        index = _scanned_index(child)
+        if index:
+            return index
+    return None
+
+
+if __name__ == "__main__":
+    applied = apply_migrations()
+    print(f"Applied migrations: {applied or 'none'}, schema version {current_version()}")
+    if "--check" in sys.argv:
+        indexes = explain_hot_queries()
+        for name, index in indexes.items():
+            print(f"{name}: {index or 'NO INDEX SCAN'}")
+        sys.exit(0 if all(indexes.values()) else 1)
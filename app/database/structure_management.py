@@ -1,21 +1,26 @@
 from .db_engine import db_engine
+from ..metrics import DB_OPERATION_SECONDS, timed
 
 from .db_tables import Structure
-from sqlalchemy.orm import Session
+from sqlalchemy import Row, select, tuple_
 from sqlalchemy.exc import SQLAlchemyError
 
 import uuid
+from datetime import datetime
 from ..models import StructureModel, StructureOrigin
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 
+STRUCTURE_MODEL_COLUMNS = tuple(Structure.__table__.c[name] for name in StructureModel.model_fields)
 
-def post_structure(
+
+@timed(DB_OPERATION_SECONDS)
+async def post_structure_async(
     job_id: uuid.uuid4,
     user_id: str,
     structure_name: str,
     structure_origin: StructureOrigin,
 ) -> bool:
-    """Create new Structure entry
+    """Create new Structure entry without blocking the event loop
 
     Args:
         job_id (uuid.uuid4): Job ID
@@ -26,7 +31,7 @@ def post_structure(
     Returns:
         bool: Returns True if successful or False on fail
     """
-    with Session(db_engine.engine) as session:
+    async with db_engine.async_session() as session:
         try:
             structure = Structure(
                 id=uuid.uuid4(),
@@ -36,17 +41,17 @@ def post_structure(
                 source=structure_origin,
             )
             session.add(structure)
-            session.commit()
+            await session.commit()
             return True
         except SQLAlchemyError as e:
-            print("error")
-            session.rollback()
+            await session.rollback()
             print(f"Error: {str(e)}")
             return False
 
 
-def get_structure_by_job_id(job_id: uuid.uuid4) -> StructureModel:
-    """Gets a structure from Job ID
+@timed(DB_OPERATION_SECONDS)
+async def get_structure_by_job_id_async(job_id: uuid.uuid4) -> StructureModel:
+    """Gets a structure from Job ID without blocking the event loop
 
     Args:
         job_id (uuid.uuid4): Job ID
@@ -54,18 +59,63 @@ def get_structure_by_job_id(job_id: uuid.uuid4) -> StructureModel:
     Returns:
         StructureModel: Structure
     """
-    with Session(db_engine.engine) as session:
-        structure = session.query(Structure).filter_by(jobid=job_id).first()
+    async with db_engine.async_session() as session:
+        structure = await session.scalar(select(Structure).filter_by(jobid=job_id).limit(1))
     return structure
 
 
-def get_all_structure() -> list[StructureModel]:
-    """Gets all structures
+@timed(DB_OPERATION_SECONDS)
+async def get_all_structure_async() -> list[StructureModel]:
+    """Gets all structures without blocking the event loop
 
     Returns:
         list[StructureModel]: Array of structures
     """
-    with Session(db_engine.engine) as session:
-        structures = session.query(Structure).all()
+    async with db_engine.async_session() as session:
+        structures = (await session.scalars(select(Structure))).all()
+
+    return structures
+
+
+def stream_all_structures_async() -> AsyncIterator[Row]:
+    """Streams all structures from a server-side cursor, see DB_Engine.stream
+
+    Returns:
+        AsyncIterator[Row]: Rows with the StructureModel columns
+    """
+    return db_engine.stream(select(*STRUCTURE_MODEL_COLUMNS))
+
+
+@timed(DB_OPERATION_SECONDS)
+async def get_paginated_structures_async(
+    limit: int,
+    email: Optional[str] = None,
+    after: Optional[Tuple[datetime, uuid.UUID]] = None,
+) -> list[StructureModel]:
+    """Gets a page of structures, newest first, without blocking the event loop
+
+    Structures are ordered by created time then id. With ``after`` the page starts
+    right after that (created, id) key, so every page costs the same.
+
+    Args:
+        limit (int): How many entries to fetch
+        email (str, optional): Only get the structures of this user
+        after (Tuple[datetime, uuid.UUID], optional): Key of the last structure of the previous page
+
+    Returns:
+        list[StructureModel]: Array of structures
+    """
+    query = (
+        select(Structure)
+        .order_by(Structure.created.desc(), Structure.id.desc())
+        .limit(limit)
+    )
+    if email is not None:
+        query = query.filter(Structure.userid == email)
+    if after is not None:
+        query = query.filter(tuple_(Structure.created, Structure.id) < tuple_(*after))
+
+    async with db_engine.async_session() as session:
+        structures = (await session.scalars(query)).all()
 
-    return structures
\ No newline at end of file
+    return structures
@@ -1,42 +1,108 @@
+import asyncio
+import io
+import json
 import unittest
+import unittest.mock
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import UploadFile
+from sqlalchemy import delete, event, select, text
+from sqlalchemy.orm import Session
 
 from ..db_engine import db_engine
-from ..user_management import check_user_exists, add_new_user, remove_user, update_user
+from ..user_management import (
+    check_user_exists_async,
+    add_new_user_async,
+    remove_user_async,
+    update_user_async,
+)
 from ..calculation_management import (
     get_all_available_basis_sets,
     get_all_available_calculations,
     get_all_available_methods,
-    get_all_available_solvent_effects
+    get_all_available_solvent_effects,
+    get_all_available_methods_async,
+    get_calculation_options_catalog_async,
+    invalidate_calculation_options_cache,
+)
+from ..db_tables import Job, Job_Outbox, Structure, User, check_schema
+from ..job_management import (
+    claim_outbox_jobs_async,
+    finish_outbox_jobs_async,
+    get_completed_jobs_count_async,
+    get_all_running_jobs_async,
+    get_paginated_completed_jobs_async,
+    job_columns,
+    post_new_jobs_async,
+    reconcile_job_status_counts,
+    retry_outbox_jobs_async,
+    stream_all_completed_jobs_async,
+    update_job_async,
+    update_jobs_async,
 )
-from ..db_tables import User
-from ...models import UserModel
+from ..migrations import MIGRATIONS, apply_migrations, current_version, explain_hot_queries
+from ...models import CreateJobDTO, JobStatus, StructureOrigin, UpdateJobDTO, UserModel
+from ...util import ndjson_response
+
+
+def setUpModule():
+    apply_migrations()
 
 
 class TestDB(unittest.TestCase):
     def test_db_engine(self):
         db_engine.validate_connection()
 
-    def test_check_user_does_not_exists(self):
-        self.assertFalse(check_user_exists("this_user_does_not_exist"))
+    def test_pool_stats(self):
+        checkouts = db_engine.pool_stats()["sync"]["checkouts"]
+        db_engine.validate_connection()
 
-    def test_add_and_remove_user(self):
-        username_for_test = "test_user@test_domain.com"
-        if check_user_exists(username_for_test):
-            self.assertTrue(remove_user(username_for_test))
+        pool_stats = db_engine.pool_stats()["sync"]
+        self.assertEqual(pool_stats["checkouts"], checkouts + 1)
+        self.assertEqual(pool_stats["checked_out"], 0)
+        self.assertGreaterEqual(pool_stats["wait_seconds_max"], 0)
 
-        self.assertTrue(add_new_user(username_for_test))
-        self.assertTrue(remove_user(username_for_test))
+    def test_declared_tables_match_database(self):
+        self.assertEqual(check_schema(), {})
 
-    def test_patch_user(self):
-        user_model_for_test = UserModel(email="testuser@testdomain.com")
-        user_for_test = "testuser@testdomain.com"
+    def test_check_schema_reports_column_differences(self):
+        with db_engine.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE job_tags ALTER COLUMN tag TYPE text"))
+            connection.execute(text("ALTER TABLE job_tags ALTER COLUMN jobid SET NOT NULL"))
+        try:
+            differences = check_schema()
+        finally:
+            with db_engine.engine.begin() as connection:
+                connection.execute(text("ALTER TABLE job_tags ALTER COLUMN tag TYPE varchar"))
+                connection.execute(text("ALTER TABLE job_tags ALTER COLUMN jobid DROP NOT NULL"))
+
+        self.assertEqual(
+            differences,
+            {
+                "job_tags": {
+                    "missing": [],
+                    "undeclared": [],
+                    "types": {"tag": {"declared": "VARCHAR", "database": "TEXT"}},
+                    "nullable": {"jobid": {"declared": True, "database": False}},
+                    "primary_key": {},
+                }
+            },
+        )
+
+    def test_migrations(self):
+        self.assertEqual(current_version(), MIGRATIONS[-1].version)
+        self.assertEqual(apply_migrations(), [])
 
-        if check_user_exists(user_for_test):
-            self.assertTrue(remove_user(user_for_test))
+    def test_hot_queries_use_indexes(self):
+        for name, index in explain_hot_queries().items():
+            self.assertIsNotNone(index, f"{name} does not scan an index")
 
-        self.assertFalse(update_user(user_model_for_test))
-        self.assertTrue(add_new_user(user_for_test))
-        self.assertTrue(update_user(user_model_for_test))
+    def test_hot_queries_use_partial_indexes_with_generic_plans(self):
+        indexes = explain_hot_queries()
+        self.assertEqual(indexes["get_paginated_completed_jobs_async"], "ix_jobs_userid_finished_id")
+        self.assertEqual(indexes["process_running_jobs"], "ix_jobs_active_status")
 
     def test_get_available_calculations(self):
         available_calculations = [
@@ -110,6 +176,478 @@ class TestDB(unittest.TestCase):
 
         self.assertEqual(available_solvent_effects_as_dict, available_solvent_effects)
 
+    def test_calculation_options_are_cached(self):
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        invalidate_calculation_options_cache()
+        event.listen(db_engine.engine, "before_cursor_execute", count_statement)
+        try:
+            first = get_all_available_methods()
+            self.assertEqual(get_all_available_methods(), first)
+            self.assertEqual(len(statements), 1)
+
+            invalidate_calculation_options_cache()
+            get_all_available_methods()
+            self.assertEqual(len(statements), 2)
+        finally:
+            event.remove(db_engine.engine, "before_cursor_execute", count_statement)
+
+
+class TestAsyncDB(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        # Pooled asyncpg connections belong to the event loop of a single test
+        await db_engine.async_engine.dispose()
+
+    async def test_add_and_remove_user(self):
+        username_for_test = "testasyncuser@testdomain.com"
+        if await check_user_exists_async(username_for_test):
+            self.assertTrue(await remove_user_async(username_for_test))
+
+        self.assertTrue(await add_new_user_async(username_for_test))
+        self.assertTrue(await check_user_exists_async(username_for_test))
+        self.assertTrue(await update_user_async(UserModel(email=username_for_test)))
+        self.assertTrue(await remove_user_async(username_for_test))
+        self.assertFalse(await check_user_exists_async(username_for_test))
+
+    async def test_check_user_does_not_exists(self):
+        self.assertFalse(await check_user_exists_async("this_user_does_not_exist"))
+
+    async def test_patch_user(self):
+        user_model_for_test = UserModel(email="testuser@testdomain.com")
+        user_for_test = "testuser@testdomain.com"
+
+        if await check_user_exists_async(user_for_test):
+            self.assertTrue(await remove_user_async(user_for_test))
+
+        self.assertFalse(await update_user_async(user_model_for_test))
+        self.assertTrue(await add_new_user_async(user_for_test))
+        self.assertTrue(await update_user_async(user_model_for_test))
+
+    async def test_job_status_counts(self):
+        email = "testcounts@testdomain.com"
+        job_ids = [uuid.uuid4() for _ in range(3)]
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(id=job_id, userid=email, job_name="job", status=JobStatus.COMPLETED)
+                for job_id in job_ids
+            )
+            session.commit()
+
+        try:
+            self.assertEqual(await get_completed_jobs_count_async(email, "All"), 3)
+
+            with Session(db_engine.engine) as session:
+                session.get(Job, job_ids[0]).status = JobStatus.FAILED
+                session.delete(session.get(Job, job_ids[1]))
+                session.commit()
+
+            self.assertEqual(await get_completed_jobs_count_async(email, "All"), 2)
+            self.assertEqual(await get_completed_jobs_count_async(email, "Completed"), 1)
+            self.assertEqual(await get_completed_jobs_count_async(email, "Failed"), 1)
+
+            with Session(db_engine.engine) as session:
+                session.execute(
+                    text("UPDATE job_status_counts SET count = 10 WHERE userid = :email"),
+                    {"email": email},
+                )
+                session.commit()
+
+            self.assertGreater(reconcile_job_status_counts(), 0)
+            self.assertEqual(await get_completed_jobs_count_async(email, "All"), 2)
+            self.assertEqual(reconcile_job_status_counts(), 0)
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_bulk_update_jobs_saves_round_trips(self):
+        email = "testbulkupdate@testdomain.com"
+        job_ids = [uuid.uuid4() for _ in range(1200)]
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(id=job_id, userid=email, job_name="job", status=JobStatus.SUBMITTED)
+                for job_id in job_ids
+            )
+            session.commit()
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        started = datetime.now()
+        event.listen(db_engine.async_engine.sync_engine, "before_cursor_execute", count_statement)
+        try:
+            for job_id in job_ids[:10]:
+                await update_job_async(
+                    job_id, UpdateJobDTO(status=JobStatus.RUNNING, started=started)
+                )
+            statements_per_job = len(statements) / 10
+
+            statements.clear()
+            updated = await update_jobs_async(
+                {
+                    job_id: UpdateJobDTO(status=JobStatus.RUNNING, started=started)
+                    for job_id in job_ids
+                },
+                batch_size=500,
+            )
+            bulk_statements = len(statements)
+        finally:
+            event.remove(db_engine.async_engine.sync_engine, "before_cursor_execute", count_statement)
+            with Session(db_engine.engine) as session:
+                running = session.query(Job).filter(
+                    Job.userid == email, Job.status == JobStatus.RUNNING
+                ).count()
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+        # The first 10 jobs already had these values
+        self.assertEqual(sorted(updated), sorted(job_ids[10:]))
+        self.assertEqual(running, len(job_ids))
+        # 3 statements for 1200 jobs, where update_job_async needs a SELECT and an UPDATE each
+        self.assertEqual(bulk_statements, 3)
+        self.assertEqual(statements_per_job, 2)
+        print(
+            f"\nupdate_jobs_async: {bulk_statements} statements for {len(job_ids)} jobs, "
+            f"update_job_async: {int(statements_per_job * len(job_ids))}"
+        )
+
+    async def test_stream_completed_jobs_as_ndjson(self):
+        email = "teststream@testdomain.com"
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(id=uuid.uuid4(), userid=email, job_name=f"job {i}", status=JobStatus.COMPLETED)
+                for i in range(2500)
+            )
+            session.commit()
+
+        try:
+            response = ndjson_response(stream_all_completed_jobs_async(email))
+            chunks = [chunk async for chunk in response.body_iterator]
+            jobs = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+
+            self.assertEqual(response.media_type, "application/x-ndjson")
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(len(jobs), 2500)
+            self.assertEqual({job["userid"] for job in jobs}, {email})
+            self.assertEqual(db_engine.pool_stats()["async"]["checked_out"], 0)
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_listing_leaves_out_heavy_parameters(self):
+        email = "testfields@testdomain.com"
+        parameters = {"calculation": "energy", "job_structure": "C 0 0 0\n" * 1000}
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add(Job(id=uuid.uuid4(), userid=email, job_name="job", parameters=parameters))
+            session.commit()
+
+        try:
+            [job] = await get_all_running_jobs_async(email)
+            self.assertEqual(job.parameters, {"calculation": "energy"})
+
+            [job] = await get_all_running_jobs_async(email, ["job_name", "status"])
+            self.assertEqual(job._asdict(), {"job_name": "job", "status": "SUBMITTED"})
+
+            [job] = await get_all_running_jobs_async(email, ["parameters.job_structure"])
+            self.assertEqual(job._asdict(), {"parameters": parameters})
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+        with self.assertRaises(ValueError):
+            job_columns(["job_name", "password"])
+
+    async def test_post_new_jobs_in_one_transaction(self):
+        email = "testbatch@testdomain.com"
+        jobs = [
+            (
+                uuid.uuid4(),
+                CreateJobDTO(
+                    job_name=f"job {i}",
+                    parameters={"source": StructureOrigin.CALCULATED, "method": "b3lyp"},
+                ),
+                None,
+            )
+            for i in range(50)
+        ]
+        try:
+            statements = []
+            listener = lambda *args: statements.append(args)
+            event.listen(db_engine.async_engine.sync_engine, "before_cursor_execute", listener)
+            try:
+                self.assertTrue(await post_new_jobs_async(email, jobs))
+            finally:
+                event.remove(db_engine.async_engine.sync_engine, "before_cursor_execute", listener)
+
+            with Session(db_engine.engine) as session:
+                names = session.scalars(select(Job.job_name).filter(Job.userid == email)).all()
+            self.assertEqual(sorted(names), sorted(f"job {i}" for i in range(50)))
+            self.assertLess(len(statements), 5)
+
+            # A duplicate ID fails the whole batch
+            new_job_id = uuid.uuid4()
+            self.assertFalse(
+                await post_new_jobs_async(email, [(new_job_id, jobs[1][1], None), jobs[0]])
+            )
+            with Session(db_engine.engine) as session:
+                self.assertIsNone(session.get(Job, new_job_id))
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_completed_job_count_matches_the_pages(self):
+        email = "testfilters@testdomain.com"
+        statuses = [JobStatus.COMPLETED, JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.RUNNING]
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(id=uuid.uuid4(), userid=email, job_name="job", status=status)
+                for status in statuses
+            )
+            session.commit()
+
+        try:
+            for filter, expected in (("All", 3), ("Completed", 1), ("Failed", 1), ("Cancelled", 1)):
+                page = await get_paginated_completed_jobs_async(email, 10, 0, filter)
+                self.assertEqual(len(page), expected, filter)
+                self.assertEqual(await get_completed_jobs_count_async(email, filter), expected, filter)
+
+            with self.assertRaisesRegex(ValueError, "Unknown filter"):
+                await get_completed_jobs_count_async(email, "Running")
+            with self.assertRaisesRegex(ValueError, "Unknown filter"):
+                await get_paginated_completed_jobs_async(email, 10, 0, "Running")
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_jobs_of_one_file_share_its_upload(self):
+        email = "testupload@testdomain.com"
+        files = [UploadFile(file=io.BytesIO(b"pdb"), filename=f"{name}.pdb") for name in "ab"]
+        jobs = [
+            (
+                uuid.uuid4(),
+                CreateJobDTO(
+                    job_name=f"job {i}", parameters={"source": StructureOrigin.UPLOADED}
+                ),
+                files[i % 2],
+            )
+            for i in range(6)
+        ]
+        try:
+            with unittest.mock.patch(
+                "app.database.job_management.upload_to_s3", return_value=True
+            ) as upload_to_s3:
+                self.assertTrue(await post_new_jobs_async(email, jobs))
+
+            self.assertCountEqual(
+                [call.args for call in upload_to_s3.call_args_list],
+                [(files[0], jobs[0][0]), (files[1], jobs[1][0])],
+            )
+            with Session(db_engine.engine) as session:
+                keys = dict(
+                    session.execute(
+                        select(Structure.jobid, Structure.file_key).filter(Structure.userid == email)
+                    ).all()
+                )
+            self.assertEqual(
+                keys,
+                {
+                    job_id: f"{jobs[i % 2][0]}/{'ab'[i % 2]}.pdb"
+                    for i, (job_id, _, _) in enumerate(jobs)
+                },
+            )
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Structure).where(Structure.userid == email))
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_jobs_are_not_created_when_an_upload_fails(self):
+        email = "testuploadfailure@testdomain.com"
+        files = [UploadFile(file=io.BytesIO(b"pdb"), filename=f"{name}.pdb") for name in "ab"]
+        jobs = [
+            (
+                uuid.uuid4(),
+                CreateJobDTO(job_name="job", parameters={"source": StructureOrigin.UPLOADED}),
+                file,
+            )
+            for file in files
+        ]
+        try:
+            with unittest.mock.patch(
+                "app.database.job_management.upload_to_s3", side_effect=[True, False]
+            ):
+                self.assertFalse(await post_new_jobs_async(email, jobs))
+
+            with Session(db_engine.engine) as session:
+                self.assertEqual(
+                    session.scalars(select(Job.id).filter(Job.userid == email)).all(), []
+                )
+                self.assertEqual(
+                    session.scalars(select(Structure.id).filter(Structure.userid == email)).all(),
+                    [],
+                )
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Structure).where(Structure.userid == email))
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_outbox_entries_are_claimed_once(self):
+        email = "testoutbox@testdomain.com"
+        job_ids = [uuid.uuid4() for _ in range(5)]
+        jobs = [
+            (
+                job_id,
+                CreateJobDTO(
+                    job_name="job",
+                    parameters={"source": StructureOrigin.CALCULATED, "id": str(job_id)},
+                ),
+                None,
+            )
+            for job_id in job_ids
+        ]
+        try:
+            self.assertTrue(await post_new_jobs_async(email, jobs))
+
+            first, second = await asyncio.gather(
+                claim_outbox_jobs_async(3, lease=60), claim_outbox_jobs_async(3, lease=60)
+            )
+            claimed = [job.jobid for job in first] + [job.jobid for job in second]
+            self.assertEqual(sorted(claimed), sorted(job_ids))
+            self.assertEqual({job.attempts for job in first + second}, {1})
+            self.assertEqual(first[0].parameters["id"], str(first[0].jobid))
+            # Leased to the first callers
+            self.assertEqual(await claim_outbox_jobs_async(5, lease=60), [])
+
+            await retry_outbox_jobs_async(job_ids[:2], "timed out", delay=0, max_delay=0)
+            retried = await claim_outbox_jobs_async(5, lease=60)
+            self.assertEqual(sorted(job.jobid for job in retried), sorted(job_ids[:2]))
+            self.assertEqual({job.attempts for job in retried}, {2})
+
+            await finish_outbox_jobs_async({job_ids[0]: None, job_ids[1]: "Unknown basis set"})
+            with Session(db_engine.engine) as session:
+                outbox = session.scalars(select(Job_Outbox.jobid)).all()
+                statuses = dict(
+                    session.execute(select(Job.id, Job.status).filter(Job.userid == email)).all()
+                )
+            self.assertNotIn(job_ids[0], outbox)
+            self.assertNotIn(job_ids[1], outbox)
+            self.assertEqual(statuses[job_ids[0]], JobStatus.SUBMITTED)
+            self.assertEqual(statuses[job_ids[1]], JobStatus.FAILED)
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_keyset_pagination_of_completed_jobs(self):
+        email = "testkeyset@testdomain.com"
+        now = datetime.now()
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(
+                    id=uuid.uuid4(),
+                    userid=email,
+                    job_name=f"job {i}",
+                    status=JobStatus.COMPLETED,
+                    finished=now - timedelta(minutes=i) if i < 4 else None,
+                )
+                for i in range(5)
+            )
+            session.commit()
+
+        try:
+            names = []
+            after = None
+            while True:
+                page = await get_paginated_completed_jobs_async(email, 2, 0, "All", after)
+                names += [job.job_name for job in page]
+                if len(page) < 2:
+                    break
+                after = (page[-1].finished, page[-1].id)
+
+            self.assertEqual(names, [f"job {i}" for i in range(5)])
+        finally:
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_completed_jobs_route_pages_with_the_cursor_header(self):
+        from ...main import app
+        from ...util import token_auth
+
+        email = "testkeysetroute@testdomain.com"
+        now = datetime.now()
+        with Session(db_engine.engine) as session:
+            session.execute(delete(Job).where(Job.userid == email))
+            session.add_all(
+                Job(
+                    id=uuid.uuid4(),
+                    userid=email,
+                    job_name=f"job {i}",
+                    status=JobStatus.COMPLETED,
+                    finished=now - timedelta(minutes=i),
+                )
+                for i in range(3)
+            )
+            session.commit()
+
+        app.dependency_overrides[token_auth] = lambda: {}
+        try:
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                params = {"email": email, "filter": "All", "limit": 2}
+                first = await client.get("/jobs/completed", params=params)
+                second = await client.get(
+                    "/jobs/completed",
+                    params={**params, "cursor": first.headers["X-Next-Cursor"]},
+                )
+                for limit in (0, -1):
+                    invalid = await client.get("/jobs/completed", params={**params, "limit": limit})
+                    self.assertEqual(invalid.status_code, 422)
+                invalid = await client.get("/jobs/completed", params={**params, "offset": -1})
+                self.assertEqual(invalid.status_code, 422)
+
+            self.assertEqual([job["job_name"] for job in first.json()["data"]], ["job 0", "job 1"])
+            self.assertEqual([job["job_name"] for job in second.json()["data"]], ["job 2"])
+            self.assertNotIn("X-Next-Cursor", second.headers)
+        finally:
+            del app.dependency_overrides[token_auth]
+            with Session(db_engine.engine) as session:
+                session.execute(delete(Job).where(Job.userid == email))
+                session.commit()
+
+    async def test_calculation_options_catalog(self):
+        catalog = await get_calculation_options_catalog_async()
+
+        self.assertEqual(
+            sorted(catalog), ["basis_sets", "calculations", "methods", "solvent_effects"]
+        )
+        self.assertEqual(catalog["methods"][0].name, "Hartree-Fock")
+
+    async def test_get_available_methods(self):
+        available_methods_response = await get_all_available_methods_async()
+
+        self.assertEqual(
+            [item.name for item in available_methods_response],
+            ["Hartree-Fock", "Moller-Plesset (MP2)", "Density Functional Theory (DFT)"],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,16 +1,20 @@
 from datetime import datetime
-from typing import List
+from typing import AsyncIterator, List
 
-from sqlalchemy.orm import Session
+from sqlalchemy import Row, select
 from sqlalchemy.exc import SQLAlchemyError
 
 from .db_engine import db_engine
+from ..metrics import DB_OPERATION_SECONDS, timed
 from .db_tables import User
 from ..models import UserModel
 
+USER_MODEL_COLUMNS = tuple(User.__table__.c[name] for name in UserModel.model_fields)
 
-def check_user_exists(email: str) -> bool:
-    """Checks if user exists in DB
+
+@timed(DB_OPERATION_SECONDS)
+async def check_user_exists_async(email: str) -> bool:
+    """Checks if user exists in DB without blocking the event loop
 
     Args:
         email (str): Email to look for
@@ -18,13 +22,16 @@ def check_user_exists(email: str) -> bool:
     Returns:
         bool: Returns True if user exists and False if does not
     """
-    with Session(db_engine.engine) as session:
-        exists = session.query(User.email).filter_by(email=email).first() is not None
+    async with db_engine.async_session() as session:
+        exists = (
+            await session.scalar(select(User.email).filter_by(email=email).limit(1))
+        ) is not None
     return exists
 
 
-def add_new_user(email: str) -> bool:
-    """Create new User
+@timed(DB_OPERATION_SECONDS)
+async def add_new_user_async(email: str) -> bool:
+    """Create new User without blocking the event loop
 
     Args:
         email (str): Email
@@ -33,20 +40,21 @@ def add_new_user(email: str) -> bool:
         bool: Returns True if success or False if fail
     """
     lastlogin = datetime.now()
-    with Session(db_engine.engine) as session:
+    async with db_engine.async_session() as session:
         try:
             user = User(email=email, lastlogin=lastlogin, active=True, admin=False)
             session.add(user)
-            session.commit()
+            await session.commit()
 
             return True
         except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             return f"Error: {str(e)}"
 
 
-def remove_user(email: str) -> bool:
-    """Remove a User from DB
+@timed(DB_OPERATION_SECONDS)
+async def remove_user_async(email: str) -> bool:
+    """Remove a User from DB without blocking the event loop
 
     Args:
         email (str): Email to remove
@@ -54,31 +62,41 @@ def remove_user(email: str) -> bool:
     Returns:
         bool: Returns True if success or False if fail
     """
-    with Session(db_engine.engine) as session:
-        user_record = session.get(User, email)
-        session.delete(user_record)
-        session.flush()
-        session.commit()
+    async with db_engine.async_session() as session:
+        user_record = await session.get(User, email)
+        await session.delete(user_record)
+        await session.commit()
 
     return True
 
 
-def get_all_users() -> List[UserModel]:
-    """Gets all Users
+@timed(DB_OPERATION_SECONDS)
+async def get_all_users_async() -> List[UserModel]:
+    """Gets all Users without blocking the event loop
 
     Returns:
         List[UserModel]: Array of Users
     """
-    with Session(db_engine.engine) as session:
-        users = session.query(User).all()
+    async with db_engine.async_session() as session:
+        users = (await session.scalars(select(User))).all()
 
     return users
 
 
-def update_user(
+def stream_all_users_async() -> AsyncIterator[Row]:
+    """Streams all Users from a server-side cursor, see DB_Engine.stream
+
+    Returns:
+        AsyncIterator[Row]: Rows with the UserModel columns
+    """
+    return db_engine.stream(select(*USER_MODEL_COLUMNS))
+
+
+@timed(DB_OPERATION_SECONDS)
+async def update_user_async(
     user: UserModel,
 ) -> bool:
-    """Updates a User
+    """Updates a User without blocking the event loop
 
     Args:
         user (UserModel): User Model
@@ -86,17 +104,17 @@ def update_user(
     Returns:
         bool: Returns True if success or False if fail
     """
-    with Session(db_engine.engine) as session:
+    async with db_engine.async_session() as session:
         try:
-            update_user = session.query(User).filter_by(email=user.email).first()
+            update_user = await session.get(User, user.email)
 
             if not update_user:
                 return False
 
             update_user.lastlogin = user.lastlogin
-            session.commit()
+            await session.commit()
 
             return True
         except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             return f"Error: {str(e)}"
@@ -1,14 +1,34 @@
+import hmac
 import os
 from contextlib import asynccontextmanager
 
-from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic_settings import BaseSettings
 
-from .cluster.cluster import interaction_with_cluster
-from .routers import calculations, jobs, structures, users
+from .cluster.breaker import CLOSED, HALF_OPEN, OPEN
+from .cluster.channel import get_async_cluster_client
+from .cluster.dispatcher import get_submission_dispatcher
+from .cluster.poller import get_cluster_poller
+from .cluster.results import get_result_pipeline
+from .cluster.worker import get_cluster_worker
+from .database.db_engine import db_engine
+from .metrics import (
+    CLUSTER_BREAKER_STATE,
+    CLUSTER_CALLS,
+    CLUSTER_WORKER_LEADER,
+    CONTENT_TYPE,
+    DB_POOL_CONNECTIONS,
+    POLL_ACTIVE_JOBS,
+    POLL_INTERVAL_SECONDS,
+    RESULT_JOBS,
+    SUBMISSIONS_IN_FLIGHT,
+    MetricsMiddleware,
+    registry,
+)
+from .routers import calculations, cluster, jobs, structures, users
+from .util import token_auth
 
 dotenv_path = os.getcwd()+"/.env"
 load_dotenv(dotenv_path)
@@ -20,28 +40,99 @@ settings = Settings()
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    scheduler = BackgroundScheduler()
-    # TODO: Consider the need to dynamically adjust interval settings
-    scheduler.add_job(interaction_with_cluster, 'interval', hours=2)
-    scheduler.start()
+    # The worker runs on the app's event loop, its cluster calls overlap with requests.
+    # Only the worker holding the leader lock runs the poller, the dispatcher and the
+    # result pipeline, set CLUSTER_WORKER_IN_APP=0 to run them with
+    # python -m app.cluster.worker instead.
+    worker = None
+    if os.environ.get("CLUSTER_WORKER_IN_APP", "1") != "0":
+        worker = get_cluster_worker()
+        worker.start()
     yield
-    scheduler.shutdown()
+    if worker is not None:
+        await worker.stop()
+    await get_async_cluster_client().close()
 
 app = FastAPI(lifespan=lifespan)
 
+app.add_middleware(MetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[os.environ.get("FE_URL")],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(users.router)
 app.include_router(calculations.router)
 app.include_router(jobs.router)
 app.include_router(structures.router)
+app.include_router(cluster.router)
 
 @app.get("/")
 async def root():
     return 'hello world'
+
+@app.get("/status/db-pool")
+async def db_pool_status(token: str = Depends(token_auth)):
+    return db_engine.pool_stats()
+
+@app.get("/status/cluster-poller")
+async def cluster_poller_status(token: str = Depends(token_auth)):
+    # Only the leader polls, the poller of any other process sits idle
+    if not get_cluster_worker().is_leader:
+        return {"is_leader": False}
+    return {"is_leader": True, **get_cluster_poller().stats()}
+
+@app.get("/status/cluster-client")
+async def cluster_client_status(token: str = Depends(token_auth)):
+    return get_async_cluster_client().stats()
+
+@app.get("/status/cluster-worker")
+async def cluster_worker_status(token: str = Depends(token_auth)):
+    return get_cluster_worker().stats()
+
+@app.get("/status/job-outbox")
+async def job_outbox_status(token: str = Depends(token_auth)):
+    return await get_submission_dispatcher().stats()
+
+@app.get("/status/result-pipeline")
+async def result_pipeline_status(token: str = Depends(token_auth)):
+    return await get_result_pipeline().stats()
+
+def collect_component_stats():
+    for engine, stats in db_engine.pool_stats().items():
+        for state in ("checked_in", "checked_out"):
+            DB_POOL_CONNECTIONS.set(stats[state], engine=engine, state=state)
+    client = get_async_cluster_client().stats()
+    for state in ("in_flight", "waiting"):
+        CLUSTER_CALLS.set(client[state], state=state)
+    CLUSTER_BREAKER_STATE.set({CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[client["breaker"]["state"]])
+    is_leader = get_cluster_worker().is_leader
+    if is_leader:
+        poller = get_cluster_poller()
+        POLL_INTERVAL_SECONDS.set(poller.interval)
+        POLL_ACTIVE_JOBS.set(poller.active_jobs)
+    else:
+        POLL_INTERVAL_SECONDS.remove()
+        POLL_ACTIVE_JOBS.remove()
+    SUBMISSIONS_IN_FLIGHT.set(get_submission_dispatcher().in_flight)
+    pipeline = get_result_pipeline()
+    RESULT_JOBS.set(pipeline.queued(), state="queued")
+    RESULT_JOBS.set(pipeline.in_flight, state="in_flight")
+    CLUSTER_WORKER_LEADER.set(int(is_leader))
+
+registry.add_collector(collect_component_stats)
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    # Scrapers send METRICS_TOKEN as a bearer token when it is set
+    token = os.environ.get("METRICS_TOKEN")
+    if token and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(registry.render(), media_type=CONTENT_TYPE)
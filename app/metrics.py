@@ -0,0 +1,315 @@
+"""Counters and latency histograms exported at /metrics in the Prometheus text format
+
+Code records into the module level metrics below, for example
+
+    with CLUSTER_CALL_SECONDS.time(action="check"):
+        ...
+
+METRICS_ENABLED selects when anything is recorded: "1" always, "0" never and
+"auto" (the default) from the first scrape of /metrics on, so a process nobody
+scrapes only pays for one attribute check per hook. Every process keeps its own
+metrics, each uvicorn worker has to be scraped separately.
+"""
+import bisect
+import functools
+import inspect
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Upper bounds of the latency buckets in seconds, from a cached token check to an
+# ssh call to a busy cluster
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Metrics of the process and whether they are being recorded"""
+
+    def __init__(self, mode: str = "auto"):
+        self.mode = mode
+        self.enabled = mode == "1"
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Adds a function that sets gauges from other state just before a scrape"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Renders every metric, and starts recording if METRICS_ENABLED is auto"""
+        if self.mode == "auto":
+            self.enabled = True
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"Error: collecting metrics failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(os.environ.get("METRICS_ENABLED", "auto").strip().lower())
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    """A count that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Gauge(Counter):
+    """A value that is set, usually by a collector just before a scrape"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def remove(self, **labels):
+        """Leaves the value out of the scrapes until it is set again"""
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class Histogram(_Metric):
+    """Counts observations in buckets, with their sum"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        if not registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager that observes how long its block takes"""
+        if not registry.enabled:
+            return _null_timer
+        return _Timer(self, labels)
+
+    def _render_value(self, key, counts):
+        labels = _format_labels(self.labelnames, key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            bucket_labels = _format_labels(
+                self.labelnames + ("le",), key + (_format_value(float(bound)),)
+            )
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def timed_call(function: Callable, *args) -> Tuple[float, object]:
+    """Calls a function and also returns how long it took, for work done in another process"""
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+class MetricsMiddleware:
+    """ASGI middleware that observes the latency of every HTTP request by route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not registry.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template, a label per job id would never stop growing
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=route,
+                status=str(status_code),
+            )
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to answer HTTP requests", ("method", "route", "status")
+)
+TOKEN_AUTH_SECONDS = Histogram("token_auth_duration_seconds", "Time to verify bearer tokens")
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds", "Time waiting for a database connection from the pool", ("engine",)
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Time of single SQL statements", ("engine", "statement")
+)
+DB_OPERATION_SECONDS = Histogram(
+    "db_operation_duration_seconds",
+    "Time of database operations of the *_management modules",
+    ("operation",),
+)
+CLUSTER_CALL_SECONDS = Histogram(
+    "cluster_call_duration_seconds", "Time of calls to the cluster script", ("action",)
+)
+CLUSTER_CALL_FAILURES = Counter(
+    "cluster_call_failures_total", "Calls to the cluster script that failed", ("action",)
+)
+S3_SECONDS = Histogram("s3_operation_duration_seconds", "Time of S3 operations", ("operation",))
+CONVERSION_SECONDS = Histogram(
+    "structure_conversion_duration_seconds", "Time openbabel takes to convert a structure"
+)
+POLL_SECONDS = Histogram("cluster_poll_duration_seconds", "Time of a poller cycle")
+POLL_JOBS_UPDATED = Counter(
+    "cluster_poll_jobs_updated_total", "Jobs whose status the poller changed"
+)
+
+# Set from the stats of the components when /metrics is scraped
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Database connections by pool state", ("engine", "state")
+)
+CLUSTER_CALLS = Gauge("cluster_calls", "Cluster calls running or waiting for a slot", ("state",))
+CLUSTER_BREAKER_STATE = Gauge(
+    "cluster_breaker_state", "Circuit breaker of the cluster calls, 0 closed, 1 half open, 2 open"
+)
+POLL_INTERVAL_SECONDS = Gauge("cluster_poll_interval_seconds", "Current interval of the poller")
+POLL_ACTIVE_JOBS = Gauge("cluster_poll_active_jobs", "Active jobs seen by the last poll")
+SUBMISSIONS_IN_FLIGHT = Gauge("job_submissions_in_flight", "Jobs being sent to the cluster")
+RESULT_JOBS = Gauge("result_pipeline_jobs", "Jobs in the result pipeline", ("state",))
+CLUSTER_WORKER_LEADER = Gauge(
+    "cluster_worker_leader", "1 while this process runs the poller and the dispatcher"
+)
+
+
+def timed(histogram: Histogram):
+    """Decorates a function so that its calls are observed with its name as operation"""
+
+    def decorator(function):
+        labels = {"operation": function.__name__}
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -23,6 +23,13 @@ class CalculationOptionModel(BaseModel):
     id: int
     name: str
 
+
+class CalculationOptionsCatalogModel(BaseModel):
+    calculations: List[CalculationOptionModel]
+    basis_sets: List[CalculationOptionModel]
+    methods: List[CalculationOptionModel]
+    solvent_effects: List[CalculationOptionModel]
+
 class JobStatus(str, Enum):
     SUBMITTED = "SUBMITTED"
     RUNNING = "RUNNING"
@@ -57,6 +64,36 @@ class CreateJobDTO(BaseModel):
     parameters: Optional[Dict[str, Any]] = None
 
 
+class BatchJobItemModel(BaseModel):
+    index: int
+    job_name: str
+    id: Optional[UUID] = None
+    status: str
+    error: Optional[str] = None
+
+
+class BatchJobResultModel(BaseModel):
+    submitted: int
+    failed: int
+    jobs: List[BatchJobItemModel]
+
+
+class ClusterJobStatusModel(BaseModel):
+    status: Optional[JobStatus] = None
+    started: Optional[datetime] = None
+    finished: Optional[datetime] = None
+    error_message: Optional[str] = None
+
+
+class ClusterCallbackModel(BaseModel):
+    jobs: Dict[UUID, ClusterJobStatusModel]
+
+
+class ClusterCallbackResultModel(BaseModel):
+    received: int
+    updated: int
+
+
 class UpdateJobDTO(BaseModel):
     started: Optional[datetime] = None
     finished: Optional[datetime] = None
@@ -77,3 +114,4 @@ class StructureModel(BaseModel):
     jobid: UUID
     created: datetime
     userid: EmailStr
+    file_key: Optional[str] = None
@@ -1,17 +1,20 @@
-from fastapi import APIRouter, Depends, FastAPI, Response, status, Body, HTTPException
+from fastapi import APIRouter, Depends, FastAPI, Request, Response, status, Body, HTTPException
 from fastapi.security import HTTPBearer
 from ..database.calculation_management import (
-    get_all_available_basis_sets,
-    get_all_available_calculations,
-    get_all_available_methods,
-    get_all_available_solvent_effects
+    CALCULATION_OPTIONS_CACHE_TTL,
+    get_all_available_basis_sets_async,
+    get_all_available_calculations_async,
+    get_all_available_methods_async,
+    get_all_available_solvent_effects_async,
+    get_calculation_options_catalog_async
 )
 
 from ..models import (
     JwtErrorModel,
-    CalculationOptionModel
+    CalculationOptionModel,
+    CalculationOptionsCatalogModel
 )
-from ..util import VerifyToken, token_auth
+from ..util import VerifyToken, token_auth, cached_json_response
 from typing import Union
 
 router = APIRouter(
@@ -22,15 +25,20 @@ router = APIRouter(
 
 token_auth_schema = HTTPBearer()
 
+# Calculation options rarely change, so responses carry an ETag and Cache-Control
+# and the browser revalidates them with If-None-Match
+
 # TODO: Add authentication back in
 @router.get(
     "/get-available-calculations",
     response_model=Union[list[CalculationOptionModel], JwtErrorModel],
 )
 async def get_available_calculations(
-    response: Response
+    request: Request
 ):
-    return get_all_available_calculations()
+    return cached_json_response(
+        request, await get_all_available_calculations_async(), CALCULATION_OPTIONS_CACHE_TTL
+    )
 
 
 @router.get(
@@ -38,21 +46,37 @@ async def get_available_calculations(
     response_model=Union[list[CalculationOptionModel], JwtErrorModel],
 )
 async def get_available_basis_sets(
-    response: Response
+    request: Request
 ):
-    return get_all_available_basis_sets()
+    return cached_json_response(
+        request, await get_all_available_basis_sets_async(), CALCULATION_OPTIONS_CACHE_TTL
+    )
 
 
 @router.get(
     "/get-available-methods",
     response_model=Union[list[CalculationOptionModel], JwtErrorModel],
 )
-async def get_available_methods(response: Response):
-    return get_all_available_methods()
+async def get_available_methods(request: Request):
+    return cached_json_response(
+        request, await get_all_available_methods_async(), CALCULATION_OPTIONS_CACHE_TTL
+    )
 
 @router.get(
     "/get-solvent-effects",
     response_model=Union[list[CalculationOptionModel], JwtErrorModel],
 )
-async def get_solvent_effects(response: Response):
-    return get_all_available_solvent_effects()
+async def get_solvent_effects(request: Request):
+    return cached_json_response(
+        request, await get_all_available_solvent_effects_async(), CALCULATION_OPTIONS_CACHE_TTL
+    )
+
+
+@router.get(
+    "/catalog",
+    response_model=Union[CalculationOptionsCatalogModel, JwtErrorModel],
+)
+async def get_catalog(request: Request):
+    return cached_json_response(
+        request, await get_calculation_options_catalog_async(), CALCULATION_OPTIONS_CACHE_TTL
+    )
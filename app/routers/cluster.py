@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import ValidationError
+
+from ..cluster.cluster import apply_status_updates
+from ..models import ClusterCallbackModel, ClusterCallbackResultModel, UpdateJobDTO
+from ..util import cluster_callback_auth
+
+router = APIRouter(
+    prefix="/cluster",
+    tags=["cluster"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.post("/callback", response_model=ClusterCallbackResultModel)
+async def cluster_callback(body: bytes = Depends(cluster_callback_auth)):
+    """Applies job status changes pushed by the cluster
+
+    The body is {"jobs": {job_id: {"status", "started", "finished", "error_message"}}},
+    signed with CLUSTER_CALLBACK_SECRET (see cluster_callback_auth). The changes go
+    through the same path as the poller's, so a repeated or late callback changes
+    nothing. Results of finished jobs are collected by the result pipeline.
+    """
+    try:
+        callback = ClusterCallbackModel.model_validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid status updates: {e}")
+    updates = {
+        job_id: UpdateJobDTO(**job.model_dump()) for job_id, job in callback.jobs.items()
+    }
+    updated = await apply_status_updates(updates)
+    return ClusterCallbackResultModel(received=len(updates), updated=len(updated))
@@ -7,36 +7,60 @@ from fastapi import (
     File,
     UploadFile,
     Form,
+    Query,
+    Request,
 )
 from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer
 from ..database.job_management import (
-    get_all_jobs,
-    get_all_running_jobs,
-    get_all_completed_jobs,
-    get_paginated_completed_jobs,
-    get_completed_jobs_count,
-    post_new_job,
-    update_job,
-    remove_job,
-    get_job_by_id,
+    get_all_jobs_async,
+    get_all_running_jobs_async,
+    get_all_completed_jobs_async,
+    get_paginated_completed_jobs_async,
+    get_completed_jobs_count_async,
+    post_new_jobs_async,
+    update_job_async,
+    remove_job_async,
+    get_job_by_id_async,
+    stream_all_jobs_async,
+    stream_all_completed_jobs_async,
+    job_columns,
 )
-from ..database.structure_management import get_structure_by_job_id
+from ..database.structure_management import get_structure_by_job_id_async
 
+import io
+import itertools
 import json
+import os
 import uuid
 
 from ..models import (
+    BatchJobItemModel,
+    BatchJobResultModel,
     JobModel,
     JwtErrorModel,
     PaginatedJobModel,
     CreateJobDTO,
     UpdateJobDTO
 )
-from ..util import token_auth, download_from_s3, read_from_s3, convert_file_to_xyz
-from ..cluster.cluster import cancel_job, submit_job
-from typing import Union, Any
+from ..util import (
+    MAX_PAGE_SIZE,
+    token_auth,
+    download_from_s3,
+    read_from_s3,
+    convert_files_to_xyz_async,
+    decode_structure_file,
+    encode_cursor,
+    decode_cursor,
+    json_response,
+    ndjson_response,
+    wants_ndjson,
+)
+from ..cluster.cluster import cancel_job
+from ..cluster.dispatcher import notify_jobs_queued
+from typing import List, Union, Any, Optional
 from uuid import UUID
+from datetime import datetime
 import logging
 import sys
 
@@ -48,46 +72,69 @@ router = APIRouter(
 
 token_auth_schema = HTTPBearer()
 
+# Most jobs one POST /jobs/batch may create
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", 500))
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def job_fields(fields: Optional[str] = None) -> Optional[List[str]]:
+    """Reads the comma separated JobModel fields to return, e.g. ?fields=id,job_name,status
+
+    parameters comes without its large keys (the job structure), add e.g.
+    parameters.job_structure to the fields to get one of them back.
+    """
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    try:
+        job_columns(names)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return names
+
+
 # TODO: Add authentication back in
 @router.get("/", response_model=Union[list[JobModel], JwtErrorModel])
 async def get_jobs(
     response: Response,
+    request: Request,
+    fields: Optional[List[str]] = Depends(job_fields),
     token: str = Depends(token_auth)
     ):
-    jobs = get_all_jobs()
-
-    job_dicts = [job.__dict__ for job in jobs]
+    # Accept: application/x-ndjson streams one job per line instead of a JSON list
+    if wants_ndjson(request):
+        return ndjson_response(stream_all_jobs_async(fields))
+    jobs = await get_all_jobs_async(fields)
 
-    return job_dicts
+    return json_response(jobs)
 
 
 @router.get("/in-progress", response_model=Union[list[JobModel], JwtErrorModel])
 async def get_in_progress_jobs(
     email: str,
     response: Response,
+    fields: Optional[List[str]] = Depends(job_fields),
     token: str = Depends(token_auth)
 ):
-    jobs = get_all_running_jobs(email)
+    jobs = await get_all_running_jobs_async(email, fields)
 
-    job_dicts = [job.__dict__ for job in jobs]
-
-    return job_dicts
+    return json_response(jobs)
 
 
 @router.get("/all-completed", response_model=Union[list[JobModel], JwtErrorModel])
 async def get_complete_jobs(
     email: str,
     response: Response,
+    request: Request,
+    fields: Optional[List[str]] = Depends(job_fields),
     token: str = Depends(token_auth),
 ):
-    jobs = get_all_completed_jobs(email)
-
-    job_dicts = [job.__dict__ for job in jobs]
+    if wants_ndjson(request):
+        return ndjson_response(stream_all_completed_jobs_async(email, fields))
+    jobs = await get_all_completed_jobs_async(email, fields)
 
-    return job_dicts
+    return json_response(jobs)
 
 
 @router.get("/completed", response_model=Union[PaginatedJobModel, JwtErrorModel])
@@ -95,19 +142,34 @@ async def get_paginated_complete_jobs(
     email: str,
     response: Response,
     filter: str,
-    limit: int = 5,
-    offset: int = 0,
+    limit: int = Query(5, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = Depends(job_fields),
     token: str = Depends(token_auth),
 ):
-    total_count = get_completed_jobs_count(email, filter)
-    data = get_paginated_completed_jobs(email, limit, offset, filter)
-    return {
+    # The cursor of the next page is sent in the X-Next-Cursor header, like for
+    # the structures, and is absent on the last page. Offset is only used when no
+    # cursor is given
+    after = decode_cursor(cursor, datetime.fromisoformat, UUID) if cursor else None
+    try:
+        total_count = await get_completed_jobs_count_async(email, filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    data = await get_paginated_completed_jobs_async(
+        email, limit + 1, offset, filter, after, fields
+    )
+    headers = {}
+    if len(data) > limit:
+        data = data[:limit]
+        headers["X-Next-Cursor"] = encode_cursor([data[-1].finished, data[-1].id])
+    return json_response({
         "offset": offset,
         "limit": limit,
         "total_count": total_count,
         "filter": filter,
         "data": data,
-    }
+    }, headers=headers)
 
 
 @router.post("/", response_model=Union[JobModel, JwtErrorModel])
@@ -122,18 +184,107 @@ async def create_new_job(
     job = CreateJobDTO(job_name=job_name, parameters=json.loads(parameters))
     db_job_id = uuid.uuid4()
     job.parameters["id"] = str(db_job_id)
-    try:
-        input_file_string = file.file.read().decode(encoding="utf-8")
-        input_file_string = input_file_string.replace("\n", " ")
-        job.parameters["job_structure"] = convert_file_to_xyz(input_file_string)
-    except Exception as e:
+    if file is None:
+        raise HTTPException(status_code=400, detail="Job was not submitted")
+    content = await file.read()
+    # Converted in a worker process, openbabel would block the event loop
+    structure, = await convert_files_to_xyz_async([decode_structure_file(content)])
+    if structure is None:
         raise HTTPException(status_code=400, detail="Job was not submitted")
+    job.parameters["job_structure"] = structure
+    # Read again from the start for the S3 upload
+    await file.seek(0)
+    # Saved with its job_outbox entry, the dispatcher sends it to the cluster
+    if await post_new_jobs_async(email, [(db_job_id, job, file)]):
+        notify_jobs_queued()
+        return JSONResponse(content=job.parameters, status_code=200)
     else:
-        if submit_job(job):
-            post_new_job(email, job, db_job_id,file)
-            return JSONResponse(content=job.parameters, status_code=200)
-        else:
-            raise HTTPException(status_code=500, detail="Job failed on the cluster")
+        raise HTTPException(status_code=500, detail="Job could not be saved")
+
+
+@router.post("/batch", response_model=Union[BatchJobResultModel, JwtErrorModel])
+async def create_new_jobs(
+    response: Response,
+    email: str = Form(...),
+    job_name: str = Form(...),
+    parameters: str = Form(...),
+    grid: str = Form(None),
+    files: List[UploadFile] = File(...),
+    token: str = Depends(token_auth)
+):
+    """Creates a job for every structure file and every combination of grid values
+
+    grid is a JSON object of parameter name to the values to try, e.g.
+    {"method": ["b3lyp", "pbe0"], "basis_set": ["6-31g", "cc-pvdz"]}. The structures
+    are converted in parallel and the jobs are saved and queued for the cluster in one
+    transaction. The response reports every job, with status 207 if some of them
+    could not be created.
+    """
+    try:
+        base_parameters = json.loads(parameters)
+        grid_values = json.loads(grid) if grid else {}
+        if not isinstance(base_parameters, dict) or not isinstance(grid_values, dict):
+            raise ValueError
+        if not all(isinstance(values, list) and values for values in grid_values.values()):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid parameters or grid")
+    combinations = [
+        dict(zip(grid_values, values)) for values in itertools.product(*grid_values.values())
+    ]
+    if len(files) * len(combinations) > BATCH_MAX_JOBS:
+        raise HTTPException(
+            status_code=400, detail=f"A batch can create at most {BATCH_MAX_JOBS} jobs"
+        )
+
+    contents = [await file.read() for file in files]
+    structures = await convert_files_to_xyz_async(
+        [decode_structure_file(content) for content in contents]
+    )
+
+    items = []
+    jobs = []
+    for file, content, structure in zip(files, contents, structures):
+        # Uploaded once and shared by the jobs of every grid combination
+        upload = UploadFile(file=io.BytesIO(content), filename=file.filename)
+        for combination in combinations:
+            labels = [file.filename] + [f"{name}={value}" for name, value in combination.items()]
+            item = BatchJobItemModel(
+                index=len(items),
+                job_name=f"{job_name} ({', '.join(filter(None, labels))})",
+                status="FAILED",
+            )
+            items.append(item)
+            if structure is None:
+                item.error = "Structure could not be converted"
+                continue
+            item.id = uuid.uuid4()
+            job = CreateJobDTO(
+                job_name=item.job_name,
+                parameters={
+                    **base_parameters,
+                    **combination,
+                    "id": str(item.id),
+                    "job_structure": structure,
+                },
+            )
+            jobs.append((item, job, upload))
+
+    # The dispatcher sends the queued jobs to the cluster in submit_batch calls
+    if jobs and await post_new_jobs_async(
+        email, [(item.id, job, file) for item, job, file in jobs]
+    ):
+        for item, _, _ in jobs:
+            item.status = "SUBMITTED"
+        notify_jobs_queued()
+    else:
+        for item, _, _ in jobs:
+            item.error = "Job could not be saved"
+
+    submitted = sum(item.status == "SUBMITTED" for item in items)
+    if submitted < len(items):
+        response.status_code = 207
+    return BatchJobResultModel(submitted=submitted, failed=len(items) - submitted, jobs=items)
 
 
 @router.patch("/{job_id}", response_model=Union[bool, JwtErrorModel])
@@ -143,9 +294,9 @@ async def patch_job(
     token: str = Depends(token_auth)
     ):
     cancel_job_data = {"id":str(job_id)}
-    cancel_result = cancel_job(cancel_job_data)
+    cancel_result = await cancel_job(cancel_job_data)
     if cancel_result:
-        res = update_job(job_id, job)
+        res = await update_job_async(job_id, job)
         if not res:
             raise HTTPException(status_code=404, detail="Job not found")
         else:
@@ -162,7 +313,7 @@ async def delete_job(
     token: str = Depends(token_auth)
     ):
 
-    return remove_job(job_id)
+    return await remove_job_async(job_id)
 
 @router.patch("/cancel/{job_id}", response_model=Union[bool, JwtErrorModel])
 async def cancel_running_job(
@@ -170,7 +321,7 @@ async def cancel_running_job(
     token: str = Depends(token_auth)
     ):
     cancel_job_data = {"id":str(job_id)}
-    cancel_result = cancel_job(cancel_job_data)
+    cancel_result = await cancel_job(cancel_job_data)
     if cancel_result:
         return True
     else:
@@ -207,7 +358,7 @@ async def download_all(
 #     response: Response,
 #     token: str = Depends(token_auth)
 # ):
-#     structure = get_structure_by_job_id(job_id)
+#     structure = await get_structure_by_job_id_async(job_id)
 
 #     return download_from_s3(file_name, structure.id)
 
@@ -224,7 +375,7 @@ async def download_all(
 
 @router.get("/job-info/{job_id}", response_model=Union[JobModel, JwtErrorModel])
 async def get_job(job_id: UUID):
-    job = get_job_by_id(job_id)
+    job = await get_job_by_id_async(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return job
@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, Response 
+from fastapi import APIRouter, Depends, Query, Request, Response
 from fastapi.security import HTTPBearer
 from ..database.structure_management import(
-    get_all_structure
+    get_all_structure_async,
+    get_paginated_structures_async,
+    stream_all_structures_async,
 )
 
 from ..models import JwtErrorModel, StructureModel
-from ..util import token_auth
-from typing import Union
+from ..util import (
+    MAX_PAGE_SIZE,
+    token_auth,
+    encode_cursor,
+    decode_cursor,
+    ndjson_response,
+    wants_ndjson,
+)
+from typing import Optional, Union
+from uuid import UUID
+from datetime import datetime
 
 router = APIRouter(
     prefix="/structures",
@@ -18,5 +29,28 @@ token_auth_schema = HTTPBearer()
 
 
 @router.get("/", response_model=Union[list[StructureModel], JwtErrorModel])
-async def get_structures(response: Response, token: str = Depends(token_auth)):
-    return get_all_structure()
+async def get_structures(
+    response: Response,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    email: Optional[str] = None,
+    token: str = Depends(token_auth),
+):
+    if limit is None and cursor is None and email is None:
+        # Accept: application/x-ndjson streams one structure per line
+        if wants_ndjson(request):
+            return ndjson_response(stream_all_structures_async())
+        return await get_all_structure_async()
+
+    # Paginated, newest first. The cursor of the next page is sent in the
+    # X-Next-Cursor header and is absent on the last page.
+    limit = limit or 50
+    after = decode_cursor(cursor, datetime.fromisoformat, UUID) if cursor else None
+    structures = await get_paginated_structures_async(limit + 1, email, after)
+    if len(structures) > limit:
+        structures = structures[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            [structures[-1].created, structures[-1].id]
+        )
+    return structures
@@ -1,14 +1,15 @@
 from fastapi import APIRouter, Depends, FastAPI, Response, status, Body, HTTPException, Request
 from fastapi.security import HTTPBearer
 from ..database.user_management import (
-    check_user_exists,
-    add_new_user,
-    get_all_users,
-    update_user,
+    check_user_exists_async,
+    add_new_user_async,
+    get_all_users_async,
+    stream_all_users_async,
+    update_user_async,
 )
 
 from ..models import UserModel, JwtErrorModel
-from ..util import VerifyToken, token_auth
+from ..util import VerifyToken, ndjson_response, token_auth, wants_ndjson
 from typing import Union
 import json
 import logging
@@ -28,7 +29,10 @@ async def get_users(
     request: Request , 
     token: str = Depends(token_auth)
     ):
-    return get_all_users()
+    # Accept: application/x-ndjson streams one user per line
+    if wants_ndjson(request):
+        return ndjson_response(stream_all_users_async())
+    return await get_all_users_async()
 
 
 @router.get("/user-exists", response_model=Union[bool, JwtErrorModel])
@@ -38,7 +42,7 @@ async def get_user_exists(
     response: Response , 
     token: str = Depends(token_auth)
 ):
-    return check_user_exists(email)
+    return await check_user_exists_async(email)
 
 
 @router.post("/", response_model=Union[bool, JwtErrorModel])
@@ -47,11 +51,11 @@ async def create_user(
     response: Response, 
     token: str = Depends(token_auth)
 ):
-    user_exists = check_user_exists(user.email)
+    user_exists = await check_user_exists_async(user.email)
     if user_exists:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    return add_new_user(user.email)
+    return await add_new_user_async(user.email)
 
 
 @router.patch("/", response_model=Union[bool, JwtErrorModel])
@@ -60,8 +64,8 @@ async def patch_user(
     response: Response, 
     token: str = Depends(token_auth)
 ):
-    res = update_user(user)
+    res = await update_user_async(user)
     if not res:
         raise HTTPException(status_code=404, detail="User not found")
     else:
-        return update_user(user)
\ No newline at end of file
+        return await update_user_async(user)
\ No newline at end of file
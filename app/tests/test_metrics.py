@@ -0,0 +1,107 @@
+import unittest
+
+import httpx
+from fastapi import FastAPI
+
+from .. import metrics
+from ..metrics import Counter, Histogram, MetricsMiddleware, registry
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.enabled = registry.enabled
+        self.mode = registry.mode
+
+    def tearDown(self):
+        registry.enabled = self.enabled
+        registry.mode = self.mode
+
+
+class TestMetrics(MetricsTestCase):
+    def test_histogram_is_rendered_with_cumulative_buckets(self):
+        registry.enabled = True
+        histogram = Histogram("test_histogram_seconds", "Test", ("action",), buckets=(0.1, 1))
+        histogram.observe(0.05, action="check")
+        histogram.observe(0.5, action="check")
+        histogram.observe(5, action="check")
+
+        lines = histogram.render()
+        self.assertEqual(
+            lines,
+            [
+                "# HELP test_histogram_seconds Test",
+                "# TYPE test_histogram_seconds histogram",
+                'test_histogram_seconds_bucket{action="check",le="0.1"} 1',
+                'test_histogram_seconds_bucket{action="check",le="1.0"} 2',
+                'test_histogram_seconds_bucket{action="check",le="+Inf"} 3',
+                'test_histogram_seconds_sum{action="check"} 5.55',
+                'test_histogram_seconds_count{action="check"} 3',
+            ],
+        )
+
+    def test_nothing_is_recorded_before_the_first_scrape(self):
+        registry.mode = "auto"
+        registry.enabled = False
+        counter = Counter("test_scrape_total", "Test", ("action",))
+        counter.inc(action="check")
+        with Histogram("test_scrape_seconds", "Test").time():
+            pass
+        self.assertNotIn("test_scrape_total{", registry.render())
+
+        counter.inc(action="check")
+        self.assertIn('test_scrape_total{action="check"} 1', registry.render())
+
+    def test_labels_are_escaped(self):
+        registry.enabled = True
+        counter = Counter("test_escape_total", "Test", ("route",))
+        counter.inc(route='a"b\\c\nd')
+        self.assertEqual(counter.render()[2], 'test_escape_total{route="a\\"b\\\\c\\nd"} 1')
+
+
+class TestMetricsMiddleware(MetricsTestCase, unittest.IsolatedAsyncioTestCase):
+    async def test_requests_are_observed_by_route_template(self):
+        registry.enabled = True
+        app = FastAPI()
+        app.add_middleware(MetricsMiddleware)
+
+        @app.get("/items/{item_id}")
+        async def item(item_id: int):
+            return {"id": item_id}
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            for item_id in range(3):
+                self.assertEqual((await client.get(f"/items/{item_id}")).status_code, 200)
+            self.assertEqual((await client.get("/missing")).status_code, 404)
+
+        rendered = "\n".join(metrics.HTTP_REQUEST_SECONDS.render())
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="200"} 3',
+            rendered,
+        )
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"} 1',
+            rendered,
+        )
+
+
+class TestComponentStats(MetricsTestCase, unittest.IsolatedAsyncioTestCase):
+    async def test_poller_gauges_are_only_exported_by_the_leader(self):
+        from ..cluster.worker import get_cluster_worker
+        from ..main import collect_component_stats
+
+        registry.enabled = True
+        worker = get_cluster_worker()
+        worker.is_leader = True
+        collect_component_stats()
+        self.assertEqual(len(metrics.POLL_INTERVAL_SECONDS.render()), 3)
+
+        worker.is_leader = False
+        collect_component_stats()
+        self.assertEqual(len(metrics.POLL_INTERVAL_SECONDS.render()), 2)
+        self.assertEqual(len(metrics.POLL_ACTIVE_JOBS.render()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import unittest
+import unittest.mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from ..util import (
+    JWKSCache,
+    VerifiedTokenCache,
+    VerifyToken,
+    convert_files_to_xyz_async,
+    get_jwks_cache,
+    ndjson_response,
+    verified_token_cache,
+)
+
+
+def make_signing_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+    return private_key, jwk
+
+
+class FakeJWKSServer:
+    """Serves a JWKS document on localhost and counts how often it is fetched"""
+
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.fail = False
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests += 1
+                if fake.fail:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps(fake.jwks).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/.well-known/jwks.json"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestJWKSCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key, cls.jwk = make_signing_key("key-1")
+        cls.rotated_private_key, cls.rotated_jwk = make_signing_key("key-2")
+
+    def setUp(self):
+        self.server = FakeJWKSServer({"keys": [self.jwk]})
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_keys_are_fetched_once(self):
+        cache = JWKSCache(self.server.url)
+
+        for _ in range(20):
+            self.assertEqual(cache.get_signing_key("key-1").key_id, "key-1")
+
+        self.assertEqual(self.server.requests, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        cache = JWKSCache(self.server.url, min_refetch_interval=0)
+        cache.get_signing_key("key-1")
+
+        self.server.jwks = {"keys": [self.jwk, self.rotated_jwk]}
+        self.assertEqual(cache.get_signing_key("key-2").key_id, "key-2")
+        self.assertEqual(self.server.requests, 2)
+
+        with self.assertRaises(jwt.exceptions.PyJWKClientError):
+            cache.get_signing_key("no-such-key")
+        self.assertEqual(self.server.requests, 3)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(self.server.url, min_refetch_interval=60)
+        cache.get_signing_key("key-1")
+
+        for _ in range(5):
+            with self.assertRaises(jwt.exceptions.PyJWKClientError):
+                cache.get_signing_key("no-such-key")
+
+        self.assertEqual(self.server.requests, 1)
+
+    def test_expired_keys_refresh_in_background(self):
+        cache = JWKSCache(self.server.url, ttl=0, min_refetch_interval=0)
+        cache.get_signing_key("key-1")
+
+        self.server.jwks = {"keys": [self.jwk, self.rotated_jwk]}
+        self.assertEqual(cache.get_signing_key("key-1").key_id, "key-1")
+
+        deadline = time.monotonic() + 5
+        while "key-2" not in cache._keys and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn("key-2", cache._keys)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_stale_keys_are_served_while_refresh_fails(self):
+        cache = JWKSCache(self.server.url, ttl=0, min_refetch_interval=0)
+        cache.get_signing_key("key-1")
+
+        self.server.fail = True
+        self.assertFalse(cache.refresh())
+        for _ in range(3):
+            self.assertEqual(cache.get_signing_key("key-1").key_id, "key-1")
+
+    def test_failed_background_refresh_is_rate_limited(self):
+        cache = JWKSCache(self.server.url, ttl=0, min_refetch_interval=60)
+        cache.get_signing_key("key-1")
+        # The keys have expired and the last fetch was long enough ago
+        cache._last_attempt -= 60
+
+        self.server.fail = True
+        for _ in range(20):
+            self.assertEqual(cache.get_signing_key("key-1").key_id, "key-1")
+            time.sleep(0.01)
+
+        deadline = time.monotonic() + 5
+        while cache._background_refresh.locked() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_no_keys_available(self):
+        self.server.fail = True
+        cache = JWKSCache(self.server.url)
+
+        with self.assertRaises(jwt.exceptions.PyJWKClientConnectionError):
+            cache.get_signing_key("key-1")
+
+    def test_cache_is_shared_by_process(self):
+        self.assertIs(get_jwks_cache(self.server.url), get_jwks_cache(self.server.url))
+
+    def auth0_settings(self):
+        return unittest.mock.patch.dict(
+            os.environ,
+            {
+                "AUTH0_JWKS_URL": self.server.url,
+                "AUTH0_AUDIENCE": "test-audience",
+                "AUTH0_ISSUER": "https://test-issuer/",
+                "AUTH0_ALGO": "RS256",
+            },
+        )
+
+    def test_verify_token(self):
+        verified_token_cache.clear()
+        with self.auth0_settings():
+            token = jwt.encode(
+                {
+                    "sub": "test_user@test_domain.com",
+                    "aud": "test-audience",
+                    "iss": "https://test-issuer/",
+                    "exp": int(time.time()) + 60,
+                },
+                self.private_key,
+                algorithm="RS256",
+                headers={"kid": "key-1"},
+            )
+
+            for _ in range(3):
+                payload = VerifyToken(token).verify()
+                self.assertEqual(payload["sub"], "test_user@test_domain.com")
+
+            self.assertEqual(self.server.requests, 1)
+
+    def test_verified_token_skips_signature_check(self):
+        verified_token_cache.clear()
+        with self.auth0_settings():
+            token = jwt.encode(
+                {
+                    "aud": "test-audience",
+                    "iss": "https://test-issuer/",
+                    "exp": int(time.time()) + 60,
+                },
+                self.private_key,
+                algorithm="RS256",
+                headers={"kid": "key-1"},
+            )
+            self.assertNotIn("status", VerifyToken(token).verify())
+
+            with unittest.mock.patch("jwt.decode") as decode:
+                for _ in range(5):
+                    self.assertNotIn("status", VerifyToken(token).verify())
+                decode.assert_not_called()
+
+            self.assertEqual(verified_token_cache.stats()["hits"], 5)
+
+
+class TestVerifiedTokenCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = VerifiedTokenCache()
+        payload = {"sub": "test_user", "exp": time.time() + 60}
+
+        self.assertIsNone(cache.get("token"))
+        cache.put("token", payload)
+        self.assertEqual(cache.get("token"), payload)
+        self.assertEqual(cache.get("token"), payload)
+
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_entry_is_evicted_at_expiry(self):
+        cache = VerifiedTokenCache()
+        cache.put("token", {"exp": time.time() - 1})
+
+        self.assertIsNone(cache.get("token"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_tokens_without_expiry_are_not_cached(self):
+        cache = VerifiedTokenCache()
+        cache.put("token", {"sub": "test_user"})
+
+        self.assertIsNone(cache.get("token"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = VerifiedTokenCache(max_size=2)
+        expires = time.time() + 60
+        cache.put("first", {"exp": expires})
+        cache.put("second", {"exp": expires})
+        cache.get("first")
+        cache.put("third", {"exp": expires})
+
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertIsNotNone(cache.get("third"))
+
+
+class TestNDJSONResponse(unittest.IsolatedAsyncioTestCase):
+    async def test_rows_are_sent_one_per_line(self):
+        async def rows():
+            for i in range(3):
+                yield {"id": i, "name": f"row {i}"}
+
+        response = ndjson_response(rows())
+        body = b"".join([chunk async for chunk in response.body_iterator])
+
+        self.assertEqual(
+            [json.loads(line) for line in body.splitlines()],
+            [{"id": i, "name": f"row {i}"} for i in range(3)],
+        )
+
+    async def test_rows_are_closed_when_client_goes_away(self):
+        closed = asyncio.Event()
+
+        async def rows():
+            try:
+                while True:
+                    yield {"payload": "x" * 1024}
+            finally:
+                closed.set()
+
+        body_iterator = ndjson_response(rows()).body_iterator
+        await body_iterator.__anext__()
+        await body_iterator.aclose()
+
+        self.assertTrue(closed.is_set())
+
+
+class TestConvertFiles(unittest.IsolatedAsyncioTestCase):
+    async def test_structures_are_converted_in_worker_processes(self):
+        pdb = (
+            "HEADER    SMALL MOLECULE\n"
+            "ATOM      1  C1  ETN     1       0.000   0.000   0.000  1.00  0.00           C\n"
+            "ATOM      2  O   ETN     1       1.540   0.000   0.000  1.00  0.00           O\n"
+            "END\n"
+        )
+
+        structures = await convert_files_to_xyz_async([pdb, "not a structure", pdb])
+
+        self.assertEqual(structures[0].split("\n")[0], "2")
+        self.assertIsNone(structures[1])
+        self.assertEqual(structures[2], structures[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,49 @@
+import asyncio
+import base64
+import hashlib
+import hmac
 import json
 import logging
+import multiprocessing
 import os
-import subprocess
+import threading
+import time
+import urllib.request
 import jwt
 import boto3
+import orjson
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, List, Optional
 from uuid import UUID
 
 
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from fastapi import Depends, status, HTTPException, File
+from fastapi import Depends, status, HTTPException, File, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
 
 from openbabel import openbabel
 
+from .cluster.channel import (
+    CircuitOpenError,
+    ClusterBusyError,
+    ClusterError,
+    get_async_cluster_client,
+)
+from .metrics import (
+    CLUSTER_CALL_FAILURES,
+    CLUSTER_CALL_SECONDS,
+    CONVERSION_SECONDS,
+    S3_SECONDS,
+    TOKEN_AUTH_SECONDS,
+    timed_call,
+)
+
 
 dotenv_path = os.getcwd()+"/.env"
 load_dotenv(dotenv_path)
@@ -30,6 +58,9 @@ def set_up():
         "ALGORITHMS": os.environ.get("AUTH0_ALGO"),
         "ISSUER": os.environ.get("AUTH0_ISSUER")
     }
+    config["JWKS_URL"] = os.environ.get(
+        "AUTH0_JWKS_URL", f'https://{config["DOMAIN"]}/.well-known/jwks.json'
+    )
     return config
 
 
@@ -37,12 +68,242 @@ token_auth_schema = HTTPBearer()
 
 
 def token_auth(token: str = Depends(token_auth_schema)):
-    result = VerifyToken(token.credentials).verify()
+    with TOKEN_AUTH_SECONDS.time():
+        result = VerifyToken(token.credentials).verify()
     if result.get("status"):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result)
     return result
 
 
+# Signature and timestamp headers of cluster callbacks
+CLUSTER_SIGNATURE_HEADER = "X-Cluster-Signature"
+CLUSTER_TIMESTAMP_HEADER = "X-Cluster-Timestamp"
+
+
+def sign_cluster_callback(body: bytes, timestamp: str, secret: str) -> str:
+    """Signs a cluster callback the way cluster_callback_auth checks it
+
+    Args:
+        body (bytes): Request body
+        timestamp (str): Unix time the request was sent, also sent as X-Cluster-Timestamp
+        secret (str): CLUSTER_CALLBACK_SECRET shared with the cluster
+
+    Returns:
+        str: Hex HMAC-SHA256 of the timestamp, a dot and the body
+    """
+    return hmac.new(
+        secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256
+    ).hexdigest()
+
+
+async def cluster_callback_auth(request: Request) -> bytes:
+    """Checks the signature of a request sent by the cluster
+
+    The cluster signs each request with CLUSTER_CALLBACK_SECRET. Requests older than
+    CLUSTER_CALLBACK_MAX_AGE seconds (300) are refused so a captured request cannot
+    be replayed later.
+
+    Returns:
+        bytes: The verified request body
+    """
+    secret = os.environ.get("CLUSTER_CALLBACK_SECRET")
+    if not secret:
+        raise HTTPException(status_code=503, detail="Cluster callbacks are not configured")
+    timestamp = request.headers.get(CLUSTER_TIMESTAMP_HEADER, "")
+    signature = request.headers.get(CLUSTER_SIGNATURE_HEADER, "")
+    try:
+        age = abs(time.time() - float(timestamp))
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    if age > float(os.environ.get("CLUSTER_CALLBACK_MAX_AGE", 300)):
+        raise HTTPException(status_code=401, detail="Signature has expired")
+    body = await request.body()
+    if not hmac.compare_digest(sign_cluster_callback(body, timestamp, secret), signature):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    return body
+
+
+class JWKSCache:
+    """Process-wide cache of the signing keys published at a JWKS url
+
+    Keys are looked up by 'kid'. Once the keys are older than ``ttl`` seconds they
+    are refreshed in a background thread while the current keys keep being served.
+    An unknown 'kid' triggers one immediate refetch, and a failed refresh keeps the
+    stale keys. Both kinds of fetch happen at most once every
+    ``min_refetch_interval`` seconds, so a JWKS endpoint that is down is not hit by
+    every request.
+    """
+
+    def __init__(self, jwks_url, ttl=600, min_refetch_interval=30, timeout=5):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._background_refresh = threading.Lock()
+
+    def get_signing_key_from_jwt(self, token):
+        # Raises jwt.exceptions.DecodeError if the token header is malformed
+        header = jwt.get_unverified_header(token)
+        return self.get_signing_key(header.get("kid"))
+
+    def get_signing_key(self, kid):
+        if self._fetched_at is None:
+            self._refetch()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        signing_key = self._keys.get(kid)
+        if signing_key is None and self._refetch():
+            signing_key = self._keys.get(kid)
+
+        if signing_key is None:
+            if not self._keys:
+                raise jwt.exceptions.PyJWKClientConnectionError(
+                    f"Fail to fetch data from the url, err: no keys available from {self.jwks_url}"
+                )
+            raise jwt.exceptions.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"'
+            )
+        return signing_key
+
+    def refresh(self) -> bool:
+        """Fetches the JWKS and replaces the cached keys
+
+        Returns:
+            bool: True if the keys were refreshed, False if the old keys were kept
+        """
+        with self._lock:
+            return self._fetch_keys()
+
+    def _attempted_recently(self, last_attempt) -> bool:
+        return (
+            last_attempt is not None
+            and time.monotonic() - last_attempt < self.min_refetch_interval
+        )
+
+    def _refetch(self) -> bool:
+        last_attempt = self._last_attempt
+        if self._attempted_recently(last_attempt):
+            return False
+        with self._lock:
+            # Another thread refetched while this one was waiting for the lock
+            if self._last_attempt != last_attempt:
+                return True
+            return self._fetch_keys()
+
+    def _fetch_keys(self) -> bool:
+        self._last_attempt = time.monotonic()
+        try:
+            with urllib.request.urlopen(self.jwks_url, timeout=self.timeout) as response:
+                jwk_set = jwt.PyJWKSet.from_dict(json.load(response))
+        except (OSError, ValueError, jwt.exceptions.PyJWKError) as e:
+            logging.warning(f"Could not refresh JWKS from {self.jwks_url}: {e}")
+            return False
+
+        self._keys = {
+            key.key_id: key
+            for key in jwk_set.keys
+            if key.key_id and key.public_key_use in ("sig", None)
+        }
+        self._fetched_at = time.monotonic()
+        return True
+
+    def _refresh_in_background(self):
+        # A failed refresh leaves the keys expired, wait before trying again
+        if self._attempted_recently(self._last_attempt):
+            return
+        # Only one background refresh at a time, without blocking the caller
+        if not self._background_refresh.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._background_refresh.release()
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+
+
+_jwks_caches = {}
+_jwks_caches_lock = threading.Lock()
+
+
+def get_jwks_cache(jwks_url: str) -> JWKSCache:
+    """Returns the JWKS cache shared by the whole process for the given url"""
+    with _jwks_caches_lock:
+        if jwks_url not in _jwks_caches:
+            _jwks_caches[jwks_url] = JWKSCache(
+                jwks_url,
+                ttl=int(os.environ.get("JWKS_CACHE_TTL", 600)),
+                min_refetch_interval=int(os.environ.get("JWKS_MIN_REFETCH_INTERVAL", 30)),
+            )
+        return _jwks_caches[jwks_url]
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified token payloads
+
+    Entries are keyed by the SHA-256 digest of the token, so raw tokens are never
+    kept in memory, and are evicted once the token's 'exp' has passed. Tokens
+    without an 'exp' claim are not cached.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and time.time() >= entry[0]:
+                del self._entries[digest]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, token, payload):
+        expires = payload.get("exp")
+        if not isinstance(expires, (int, float)):
+            return
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[digest] = (expires, dict(payload))
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+
+verified_token_cache = VerifiedTokenCache(int(os.environ.get("TOKEN_CACHE_SIZE", 1024)))
+
+
 class VerifyToken:
     """Does all the token verification using PyJWT"""
 
@@ -51,12 +312,32 @@ class VerifyToken:
         self.permissions = permissions
         self.scopes = scopes
         self.config = set_up()
-        # This gets the JWKS from a given URL and does processing so you can use any of
-        # the keys available
-        jwks_url = f'https://{self.config["DOMAIN"]}/.well-known/jwks.json'
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        # The JWKS is shared by every request in the process, so the keys are only
+        # fetched over the network when they expire or an unknown 'kid' shows up
+        self.jwks_client = get_jwks_cache(self.config["JWKS_URL"])
 
     def verify(self):
+        # A token that was already verified skips the signature check until it expires
+        payload = verified_token_cache.get(self.token)
+        if payload is None:
+            payload = self._decode()
+            if payload.get("status") == "error":
+                return payload
+            verified_token_cache.put(self.token, payload)
+
+        if self.scopes:
+            result = self._check_claims(payload, "scope", str, self.scopes.split(" "))
+            if result.get("error"):
+                return result
+
+        if self.permissions:
+            result = self._check_claims(payload, "permissions", list, self.permissions)
+            if result.get("error"):
+                return result
+
+        return payload
+
+    def _decode(self):
         # This gets the 'kid' from the passed token
         try:
             self.signing_key = self.jwks_client.get_signing_key_from_jwt(self.token).key
@@ -76,16 +357,6 @@ class VerifyToken:
         except Exception as e:
             return {"status": "error", "message": str(e)}
 
-        if self.scopes:
-            result = self._check_claims(payload, "scope", str, self.scopes.split(" "))
-            if result.get("error"):
-                return result
-
-        if self.permissions:
-            result = self._check_claims(payload, "permissions", list, self.permissions)
-            if result.get("error"):
-                return result
-
         return payload
 
     def _check_claims(self, payload, claim_name, claim_type, expected_value):
@@ -146,6 +417,84 @@ def convert_file_to_xyz(input_file_string) -> str:
     except Exception as e:
         print(e)
 
+def decode_structure_file(content: bytes) -> str:
+    """Reads an uploaded structure file for convert_file_to_xyz
+
+    Line endings are made "\\n", openbabel reads the file line by line.
+
+    Args:
+        content (bytes): The uploaded file
+
+    Returns:
+        str: The structure, empty if the file is not UTF-8
+    """
+    try:
+        input_file_string = content.decode(encoding="utf-8")
+    except UnicodeDecodeError:
+        return ""
+    return input_file_string.replace("\r\n", "\n").replace("\r", "\n")
+
+
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
+
+
+def get_conversion_pool() -> ProcessPoolExecutor:
+    """Gets the process pool that converts structures, CONVERSION_WORKERS processes
+
+    openbabel holds the GIL while it converts, so conversions only run in parallel
+    in separate processes. They are spawned rather than forked from the server.
+    """
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            _conversion_pool = ProcessPoolExecutor(
+                max_workers=int(os.environ.get("CONVERSION_WORKERS", os.cpu_count() or 1)),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _conversion_pool
+
+
+async def convert_files_to_xyz_async(input_file_strings: List[str]) -> List[Optional[str]]:
+    """Converts many structures to xyz in parallel, see convert_file_to_xyz
+
+    Args:
+        input_file_strings (List[str]): Structures to convert
+
+    Returns:
+        List[Optional[str]]: The xyz of each structure, None if it could not be converted
+            or has no atoms
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_conversion_pool()
+    # Timed in the worker process, so the time waiting for a free worker is left out
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(pool, timed_call, convert_file_to_xyz, string)
+            for string in input_file_strings
+        ),
+        return_exceptions=True,
+    )
+    structures = []
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Error: {str(result)}")
+        else:
+            seconds, result = result
+            CONVERSION_SECONDS.observe(seconds)
+        # The first line of an xyz file is the number of atoms
+        if isinstance(result, str) and result.split("\n", 1)[0].strip() not in ("", "0"):
+            structures.append(result)
+        else:
+            structures.append(None)
+    return structures
+
+
+def structure_file_key(structure_id: UUID, filename: str) -> str:
+    """Gets the S3 key upload_to_s3 stores a structure file under"""
+    return str(structure_id) + "/" + filename
+
+
 # TODO: use openbabel to convert file type for consistency *.xyz
 def upload_to_s3(file: File, structure_id: UUID):
     my_config = Config(
@@ -155,14 +504,33 @@ def upload_to_s3(file: File, structure_id: UUID):
     s3 = boto3.client("s3")
     
     try:
-        response = s3.upload_fileobj(
-            # TODO: decide the value of the third parameter (directly upload the file or use a folder)
-            file.file, os.environ.get("S3_BUCKET"), str(structure_id) + "/" + file.filename
-        )
+        with S3_SECONDS.time(operation="upload"):
+            response = s3.upload_fileobj(
+                # TODO: decide the value of the third parameter (directly upload the file or use a folder)
+                file.file, os.environ.get("S3_BUCKET"), structure_file_key(structure_id, file.filename)
+            )
     except ClientError as e:
         logging.error(e)
         return False
-    
+    return True
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Gets the S3 client shared by the process
+
+    Building a client takes tens of milliseconds, clients are safe to share between
+    threads.
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client("s3")
+        return _s3_client
+
+
 def create_presigned_post(object_name, fields=None, conditions=None, expiration=3600):
     """Generate a presigned URL S3 POST request to upload a file
     :param bucket_name: string
@@ -177,13 +545,14 @@ def create_presigned_post(object_name, fields=None, conditions=None, expiration=
     """
 
     # Generate a presigned S3 POST URL
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     try:
-        response = s3_client.generate_presigned_post(os.environ.get("S3_BUCKET"),
-                                                     object_name,
-                                                     Fields=fields,
-                                                     Conditions=conditions,
-                                                     ExpiresIn=expiration)
+        with S3_SECONDS.time(operation="presign_post"):
+            response = s3_client.generate_presigned_post(os.environ.get("S3_BUCKET"),
+                                                         object_name,
+                                                         Fields=fields,
+                                                         Conditions=conditions,
+                                                         ExpiresIn=expiration)
     except ClientError as e:
         logging.error(e)
         return None
@@ -191,6 +560,134 @@ def create_presigned_post(object_name, fields=None, conditions=None, expiration=
     # The response contains the presigned URL and required fields
     return response       
 
+
+def create_presigned_multipart_upload(
+    object_name: str, size: int, part_size: int, expiration: int = 3600
+) -> dict:
+    """Starts a multipart upload and presigns a PUT url for each part
+
+    Args:
+        object_name (str): Key of the object
+        size (int): Size of the file in bytes
+        part_size (int): Size of each part but the last, at least 5 MiB for S3
+        expiration (int): Seconds the urls stay valid
+
+    Returns:
+        dict: upload_id, part_size and the urls of the parts in order
+    """
+    s3_client = get_s3_client()
+    bucket = os.environ.get("S3_BUCKET")
+    with S3_SECONDS.time(operation="create_multipart_upload"):
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=object_name)["UploadId"]
+    part_count = max(1, -(-size // part_size))
+    urls = [
+        s3_client.generate_presigned_url(
+            "upload_part",
+            Params={
+                "Bucket": bucket,
+                "Key": object_name,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            },
+            ExpiresIn=expiration,
+        )
+        for part_number in range(1, part_count + 1)
+    ]
+    return {"upload_id": upload_id, "part_size": part_size, "urls": urls}
+
+
+def complete_multipart_upload(object_name: str, upload_id: str, parts: List[dict]):
+    """Joins the uploaded parts into the object
+
+    Args:
+        object_name (str): Key of the object
+        upload_id (str): ID from create_presigned_multipart_upload
+        parts (List[dict]): PartNumber and ETag of every part
+    """
+    with S3_SECONDS.time(operation="complete_multipart_upload"):
+        get_s3_client().complete_multipart_upload(
+            Bucket=os.environ.get("S3_BUCKET"),
+            Key=object_name,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                    for part in sorted(parts, key=lambda part: part["PartNumber"])
+                ]
+            },
+        )
+
+
+def abort_multipart_upload(object_name: str, upload_id: str):
+    """Discards the parts of a multipart upload that will not be completed"""
+    try:
+        with S3_SECONDS.time(operation="abort_multipart_upload"):
+            get_s3_client().abort_multipart_upload(
+                Bucket=os.environ.get("S3_BUCKET"), Key=object_name, UploadId=upload_id
+            )
+    except ClientError as e:
+        logging.error(e)
+
+
+# ID of the bucket lifecycle rule added by ensure_multipart_lifecycle_rule
+MULTIPART_LIFECYCLE_RULE_ID = "abort-incomplete-multipart-uploads"
+
+
+def ensure_multipart_lifecycle_rule(days: int = 1) -> bool:
+    """Adds a lifecycle rule to the bucket that discards incomplete multipart uploads
+
+    The other rules of the bucket are kept.
+
+    Args:
+        days (int): Days after which the parts of an upload that was never completed
+            or aborted are deleted
+
+    Returns:
+        bool: True if the rule was added or changed, False if it was already in place
+    """
+    bucket = os.environ.get("S3_BUCKET")
+    s3 = get_s3_client()
+    try:
+        rules = s3.get_bucket_lifecycle_configuration(Bucket=bucket)["Rules"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
+        rules = []
+    rule = {
+        "ID": MULTIPART_LIFECYCLE_RULE_ID,
+        "Filter": {"Prefix": ""},
+        "Status": "Enabled",
+        "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": days},
+    }
+    if rule in rules:
+        return False
+    rules = [other for other in rules if other.get("ID") != MULTIPART_LIFECYCLE_RULE_ID]
+    s3.put_bucket_lifecycle_configuration(
+        Bucket=bucket, LifecycleConfiguration={"Rules": rules + [rule]}
+    )
+    return True
+
+
+def get_s3_object_size(object_name: str) -> Optional[int]:
+    """Gets the size of an object in the bucket
+
+    Args:
+        object_name (str): Key of the object
+
+    Returns:
+        Optional[int]: Size in bytes, None if there is no such object
+    """
+    try:
+        with S3_SECONDS.time(operation="head_object"):
+            response = get_s3_client().head_object(
+                Bucket=os.environ.get("S3_BUCKET"), Key=object_name
+            )
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return response["ContentLength"]
+
 # NOTE: route for downloading disabled for now
 #       files in s3 should all be in .xyz from the upload fn
 def download_from_s3(file_name: str, structure_id: UUID):
@@ -221,31 +718,171 @@ def read_from_s3(file_name: str, structure_id: UUID):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Most rows a page of the paginated listings may ask for
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: list) -> str:
+    """Encodes the sort key of the last row of a page into an opaque cursor
+
+    Args:
+        values (list): Sort key values, in order
+
+    Returns:
+        str: URL safe cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """Decodes a cursor made by encode_cursor
+
+    Args:
+        cursor (str): Cursor from a previous page
+        *types: Function converting each value back to its type, None values stay None
+
+    Returns:
+        list: Sort key values, in order
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("wrong number of values")
+        return [None if value is None else convert(value) for convert, value in zip(types, values)]
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def cached_json_response(request: Request, content, max_age: int) -> Response:
+    """Builds a JSON response that browsers cache and then revalidate with its ETag
+
+    Args:
+        request (Request): Request, its If-None-Match header is compared with the ETag
+        content: Content to serialise
+        max_age (int): Seconds the browser may use the response without revalidating
+
+    Returns:
+        Response: The JSON response, or an empty 304 Not Modified if the browser
+            already has this content
+    """
+    body = json.dumps(jsonable_encoder(content), separators=(",", ":")).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(max_age)}"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _to_json(value):
+    # asyncpg returns its own UUID subclass, orjson only serialises uuid.UUID itself
+    if isinstance(value, UUID):
+        return str(value)
+    if hasattr(value, "_asdict"):
+        return value._asdict()
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def json_response(content, status_code: int = 200, headers: dict = None) -> Response:
+    """Serialises content straight to JSON bytes with orjson
+
+    Returning the Response skips the validation against the route's response_model,
+    so use it for content that is already shaped like the model, such as database
+    rows of the model's columns.
+
+    Args:
+        content: Content to serialise, may contain rows, pydantic models, UUIDs and datetimes
+        status_code (int): HTTP status code
+        headers (dict, optional): Extra response headers
+
+    Returns:
+        Response: The JSON response
+    """
+    return Response(
+        # Row keys are str subclasses, which orjson only accepts with OPT_NON_STR_KEYS
+        content=orjson.dumps(content, default=_to_json, option=orjson.OPT_NON_STR_KEYS),
+        status_code=status_code,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Encoded rows are sent in chunks of about this many bytes
+NDJSON_CHUNK_SIZE = 64 * 1024
+
+
+def wants_ndjson(request: Request) -> bool:
+    """Checks if the client asked for newline delimited JSON with its Accept header"""
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(rows: AsyncIterator) -> StreamingResponse:
+    """Streams rows as newline delimited JSON, one object per line
+
+    Rows are encoded as they arrive, so memory does not grow with the number of rows
+    and the first ones are sent before the query has finished.
+
+    Args:
+        rows (AsyncIterator): Rows to send, such as DB_Engine.stream() results
+
+    Returns:
+        StreamingResponse: The NDJSON response
+    """
+    async def encode():
+        chunk = bytearray()
+        try:
+            async for row in rows:
+                chunk += orjson.dumps(
+                    row, default=_to_json, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+                )
+                if len(chunk) >= NDJSON_CHUNK_SIZE:
+                    yield bytes(chunk)
+                    chunk.clear()
+            if chunk:
+                yield bytes(chunk)
+        finally:
+            # Releases the database cursor and connection when the client goes away
+            if hasattr(rows, "aclose"):
+                await rows.aclose()
+
+    return StreamingResponse(encode(), media_type=NDJSON_MEDIA_TYPE)
+
+
 def item_to_dict(item):
     return {c.name: getattr(item, c.name) for c in item.__table__.columns}
 
-def cluster_call(action: str, parameters: dict):
-    """communicate with the scripts on the compute cluster"""
-    command_data = {
-        "action": action,
-        "parameters": parameters
-    }
-    json_data = json.dumps(command_data)
-    main_exec_path = os.environ.get("CLUSTER_LOC")
-    ssh_command = ["ssh", "cluster", "python3", main_exec_path]
-    # ssh_command = ["python3", main_exec_path]
-    try:
-        process = subprocess.Popen(
-            ssh_command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        stdout, stderr = process.communicate(input=json_data)
-        if process.returncode != 0:
-            raise HTTPException(status_code=500, detail=stderr)
-        return json.loads(stdout)
-    except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
\ No newline at end of file
+
+async def cluster_call_async(action: str, parameters: dict, timeout: float = None):
+    """communicate with the scripts on the compute cluster without blocking the event loop
+
+    Calls go through the persistent cluster agent channel when one is configured
+    (CLUSTER_AGENT_LOC or CLUSTER_AGENT_COMMAND), otherwise every call starts the
+    cluster script over a new ssh connection.
+
+    At most CLUSTER_MAX_CONCURRENCY calls run at a time, the others wait for a slot.
+    While the cluster is failing the calls are refused at once with a 503, as are
+    calls that found no free slot within the deadline of their action.
+
+    Args:
+        action (str): Action of the cluster script
+        parameters (dict): Parameters of the action
+        timeout (float, optional): Seconds to wait for the result, the deadline of the
+            action if None
+
+    Returns:
+        The JSON output of the cluster script
+    """
+    with CLUSTER_CALL_SECONDS.time(action=action):
+        try:
+            return await get_async_cluster_client().call(action, parameters, timeout)
+        except (CircuitOpenError, ClusterBusyError) as e:
+            CLUSTER_CALL_FAILURES.inc(action=action)
+            raise HTTPException(status_code=503, detail=str(e))
+        except ClusterError as e:
+            CLUSTER_CALL_FAILURES.inc(action=action)
+            raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,124 @@
+"""Benchmark of the job listing endpoints with 10k jobs
+
+Compares the old read path (ORM objects, job.__dict__, response_model validation)
+with the column-projected rows serialised by orjson, then times the endpoints.
+Needs the same database settings as the app. Run from the repository root with:
+
+    python -m benchmarks.bench_job_listing [--jobs 10000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Union
+
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from app.database.db_engine import db_engine
+from app.database.db_tables import Job
+from app.database.job_management import get_all_completed_jobs_async
+from app.main import app
+from app.models import JobModel, JobStatus, JwtErrorModel
+from app.util import json_response, token_auth
+
+EMAIL = "benchjoblisting@example.com"
+
+
+def seed(count: int):
+    now = datetime.now()
+    with Session(db_engine.engine) as session:
+        session.execute(delete(Job).where(Job.userid == EMAIL))
+        session.add_all(
+            Job(
+                id=uuid.uuid4(),
+                userid=EMAIL,
+                job_name=f"job {i}",
+                submitted=now - timedelta(minutes=i + 10),
+                started=now - timedelta(minutes=i + 5),
+                finished=now - timedelta(minutes=i),
+                status=JobStatus.COMPLETED,
+                parameters={"calculation": "energy", "method": "b3lyp", "basis_set": "6-31g"},
+            )
+            for i in range(count)
+        )
+        session.commit()
+
+
+def clean_up():
+    with Session(db_engine.engine) as session:
+        session.execute(delete(Job).where(Job.userid == EMAIL))
+        session.commit()
+
+
+async def orm_path() -> bytes:
+    async with db_engine.async_session() as session:
+        jobs = (
+            await session.scalars(
+                select(Job).filter(
+                    Job.userid == EMAIL,
+                    Job.status.in_([JobStatus.FAILED, JobStatus.CANCELLED, JobStatus.COMPLETED]),
+                )
+            )
+        ).all()
+    job_dicts = [job.__dict__ for job in jobs]
+    adapter = TypeAdapter(Union[list[JobModel], JwtErrorModel])
+    return adapter.dump_json(adapter.validate_python(job_dicts))
+
+
+async def row_path() -> bytes:
+    return json_response(await get_all_completed_jobs_async(EMAIL)).body
+
+
+def best_of(repeat: int, run) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    seed(args.jobs)
+    try:
+        loop = asyncio.new_event_loop()
+        orm_body = loop.run_until_complete(orm_path())
+        row_body = loop.run_until_complete(row_path())
+        assert len(json.loads(orm_body)) == len(json.loads(row_body)) == args.jobs
+
+        print(f"{args.jobs} jobs, best of {args.repeat}")
+        orm = best_of(args.repeat, lambda: loop.run_until_complete(orm_path()))
+        rows = best_of(args.repeat, lambda: loop.run_until_complete(row_path()))
+        print(f"  ORM objects + response_model: {orm * 1000:8.1f} ms")
+        print(f"  JobModel columns + orjson:    {rows * 1000:8.1f} ms  ({orm / rows:.1f}x)")
+        loop.run_until_complete(db_engine.async_engine.dispose())
+        loop.close()
+
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("apscheduler").setLevel(logging.WARNING)
+        app.dependency_overrides[token_auth] = lambda: "benchmark"
+        # One event loop for all requests, the async engine's connections belong to it
+        with TestClient(app) as client:
+            for path in ("/jobs/all-completed", "/jobs/in-progress", "/jobs/completed"):
+                params = {"email": EMAIL, "filter": "All", "limit": 50}
+                elapsed = best_of(
+                    args.repeat, lambda: client.get(path, params=params).raise_for_status()
+                )
+                print(f"  GET {path:<22} {elapsed * 1000:8.1f} ms")
+    finally:
+        clean_up()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""End-to-end load test of job submission, polling and result collection
+
+Submits jobs through POST /jobs/ from many concurrent clients while others keep
+reading GET /jobs/in-progress, waits until the cluster has finished every job and
+reports the throughput, the p50/p99 latency of both routes and what the poller
+cost in cluster calls and database statements, from /metrics.
+
+By default the app runs in this process against the cluster simulator
+(app/cluster/simulator.py), with the database settings of the app. Any SIMULATOR_*,
+CLUSTER_* or RESULT_* variable already set is kept. With --url a running backend is
+tested instead, its metrics need METRICS_ENABLED=1 to cover the whole run. Run from
+the repository root with:
+
+    python -m benchmarks.load_test [--jobs 2000] [--concurrency 50] [--url URL --token TOKEN]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
+
+import httpx
+
+EMAIL = "benchloadtest@example.com"
+
+PDB = (
+    "HEADER    SMALL MOLECULE\n"
+    "ATOM      1  C1  ETN     1       0.000   0.000   0.000  1.00  0.00           C\n"
+    "ATOM      2  O   ETN     1       1.540   0.000   0.000  1.00  0.00           O\n"
+    "END\n"
+)
+
+# A cluster that answers like one behind ssh and jobs that take seconds, not hours
+SIMULATED_CLUSTER = {
+    "SIMULATOR_LATENCY": "uniform:0.05:0.2",
+    "SIMULATOR_QUEUE_TIME": "exponential:2",
+    "SIMULATOR_DURATION": "lognormal:10:0.5",
+    "CLUSTER_POLL_MIN_INTERVAL": "2",
+    "CLUSTER_POLL_YOUNG_JOB_AGE": "30",
+    "RESULT_VERIFY_UPLOADS": "0",
+    "METRICS_ENABLED": "1",
+    # Presigning works offline, the simulator does not upload
+    "AWS_ACCESS_KEY_ID": "loadtest",
+    "AWS_SECRET_ACCESS_KEY": "loadtest",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "S3_BUCKET": "loadtest",
+}
+
+METRIC_LINE = re.compile(r"^(\w+?)(_sum|_count)(\{[^}]*\})? (\S+)$")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def histogram_totals(metrics: str) -> Dict[Tuple[str, str], List[float]]:
+    """Reads the count and sum of every histogram series from /metrics
+
+    Returns:
+        Dict[Tuple[str, str], List[float]]: [count, sum] by metric name and labels
+    """
+    totals = defaultdict(lambda: [0.0, 0.0])
+    for line in metrics.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, suffix, labels, value = match.groups()
+            totals[(name, labels or "")][0 if suffix == "_count" else 1] = float(value)
+    return totals
+
+
+def difference(after, before) -> Dict[Tuple[str, str], List[float]]:
+    return {
+        key: [value[0] - before.get(key, [0, 0])[0], value[1] - before.get(key, [0, 0])[1]]
+        for key, value in after.items()
+    }
+
+
+@asynccontextmanager
+async def in_process_client():
+    """Starts the app in this process against the cluster simulator"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    state = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    state.close()
+    os.environ.setdefault("SIMULATOR_STATE", state.name)
+    os.environ.setdefault(
+        "CLUSTER_AGENT_COMMAND",
+        f"{sys.executable} {root}/app/cluster/agent.py {root}/app/cluster/simulator.py",
+    )
+    for name, value in SIMULATED_CLUSTER.items():
+        os.environ.setdefault(name, value)
+
+    # Imported once the environment is set, the metrics read it on import
+    from app.main import app
+    from app.util import token_auth
+
+    app.dependency_overrides[token_auth] = lambda: "loadtest"
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=None
+            ) as client:
+                yield client
+    finally:
+        await clean_up()
+        os.unlink(state.name)
+
+
+async def clean_up():
+    from sqlalchemy import delete
+
+    from app.database.db_engine import db_engine
+    from app.database.db_tables import Job
+
+    async with db_engine.async_session() as session:
+        await session.execute(delete(Job).where(Job.userid == EMAIL))
+        await session.commit()
+    await db_engine.async_engine.dispose()
+
+
+async def submit_jobs(client, count: int, concurrency: int, latencies: List[float]) -> int:
+    remaining = iter(range(count))
+    failures = 0
+
+    async def submitter():
+        nonlocal failures
+        for i in remaining:
+            start = time.perf_counter()
+            response = await client.post(
+                "/jobs/",
+                data={
+                    "email": EMAIL,
+                    "job_name": f"load test {i}",
+                    "parameters": json.dumps({"source": "CALCULATED", "calculation": "energy"}),
+                },
+                files={"file": ("molecule.pdb", PDB)},
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+
+    await asyncio.gather(*(submitter() for _ in range(concurrency)))
+    return failures
+
+
+async def read_jobs(client, readers: int, stop: asyncio.Event, latencies: List[float]):
+    async def reader():
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = await client.get(
+                "/jobs/in-progress", params={"email": EMAIL, "fields": "id,status"}
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(reader() for _ in range(readers)))
+
+
+async def wait_until_done(client, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = await client.get("/jobs/in-progress", params={"email": EMAIL, "fields": "id"})
+        if not response.json():
+            return True
+        await asyncio.sleep(1)
+    return False
+
+
+async def run(client, args, metrics_headers: dict):
+    before = histogram_totals((await client.get("/metrics", headers=metrics_headers)).text)
+    submit_latencies, read_latencies = [], []
+    stop = asyncio.Event()
+    readers = asyncio.create_task(read_jobs(client, args.readers, stop, read_latencies))
+
+    start = time.perf_counter()
+    failures = await submit_jobs(client, args.jobs, args.concurrency, submit_latencies)
+    submitted = time.perf_counter() - start
+    done = await wait_until_done(client, args.timeout)
+    finished = time.perf_counter() - start
+    stop.set()
+    await readers
+
+    costs = difference(
+        histogram_totals((await client.get("/metrics", headers=metrics_headers)).text), before
+    )
+
+    print(f"{args.jobs} jobs, {args.concurrency} submitting and {args.readers} reading clients")
+    print(
+        f"  submitted in {submitted:.1f} s, {args.jobs / submitted:.1f} jobs/s, {failures} failed"
+    )
+    if done:
+        print(f"  all finished after {finished:.1f} s, {args.jobs / finished:.1f} jobs/s")
+    else:
+        print(f"  not finished after {args.timeout:.0f} s")
+    routes = (("POST /jobs/", submit_latencies), ("GET /jobs/in-progress", read_latencies))
+    for route, latencies in routes:
+        if latencies:
+            print(
+                f"  {route:<22} p50 {percentile(latencies, 0.5) * 1000:8.1f} ms"
+                f"  p99 {percentile(latencies, 0.99) * 1000:8.1f} ms  ({len(latencies)} requests)"
+            )
+
+    polls = costs.get(("cluster_poll_duration_seconds", ""), [0, 0])
+    print(f"  poller: {polls[0]:.0f} polls, {polls[1]:.1f} s in total")
+    for (name, labels), (count, seconds) in sorted(costs.items()):
+        if name == "cluster_call_duration_seconds" and count:
+            print(f"    cluster call {labels:<26} {count:6.0f} calls {seconds:8.1f} s")
+    statements = sum(
+        count for (name, _), (count, _) in costs.items() if name == "db_query_duration_seconds"
+    )
+    print(f"    {statements:.0f} SQL statements in total")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--readers", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the jobs")
+    parser.add_argument("--url", help="Backend to test instead of an in-process app")
+    parser.add_argument("--token", help="Bearer token for --url")
+    parser.add_argument("--metrics-token", help="METRICS_TOKEN of the backend, if it has one")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    metrics_headers = {}
+    if args.metrics_token:
+        metrics_headers["Authorization"] = f"Bearer {args.metrics_token}"
+    if args.url:
+        headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+        async with httpx.AsyncClient(base_url=args.url, headers=headers, timeout=None) as client:
+            await run(client, args, metrics_headers)
+    else:
+        async with in_process_client() as client:
+            await run(client, args, metrics_headers)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())